@@ -0,0 +1,407 @@
+"""Alarm playback.
+
+The alarm sound is resolved and loaded once at startup. A single long-lived
+AudioWorker thread keeps it looping until stop(). A VolumeEnforcer thread
+beside it re-asserts the system volume every volume_interval seconds, so a
+slow or hung osascript never holds up the next loop of the sound.
+
+Backends:
+  - NSSoundBackend: decodes the file into memory once through AppKit (needs
+    pyobjc) and loops it gaplessly in-process - no forks while alarming.
+  - AfplayBackend: one afplay process at a time, respawned the moment the
+    previous one finishes. Used when pyobjc isn't installed.
+  - SinkBackend: keeps the file bytes in memory and "plays" them into a sink
+    file (or nowhere) for a fixed duration per loop. For testing on Linux.
+
+Select a backend with MACSENTINEL_AUDIO=nssound|afplay|null|file:<path>.
+"""
+import os
+import subprocess
+import threading
+import time
+
+import metrics
+from capabilities import capabilities
+from logs import get_logger
+from process_manager import processes
+
+
+log = get_logger('alarm')
+
+ALARM_RESTARTS = metrics.Counter('macsentinel_alarm_restarts_total',
+                                 'Times the alarm sound was started again after a loop ended',
+                                 ['backend'])
+ALARM_FAILURES = metrics.Counter('macsentinel_alarm_failures_total',
+                                 'Failed alarm playback attempts', ['backend'])
+ALARM_CONSECUTIVE_FAILURES = metrics.Gauge('macsentinel_alarm_consecutive_failures',
+                                           'Alarm playback failures since the last good loop')
+
+
+class PlaybackError(Exception):
+    """A playback iteration failed"""
+
+
+def resolve_alarm_sound():
+    """Find the alarm sound file once at startup"""
+    base_dir = os.path.dirname(os.path.abspath(__file__))
+    candidates = [
+        os.path.join(base_dir, 'static', 'sounds', 'alarm.mp3'),
+        # Also try relative to current working directory
+        os.path.abspath(os.path.join('static', 'sounds', 'alarm.mp3')),
+    ]
+    for candidate in candidates:
+        if os.path.isfile(candidate) and os.access(candidate, os.R_OK):
+            return candidate
+
+    log.error('Alarm sound file not found', tried=candidates, cwd=os.getcwd())
+    return None
+
+
+def set_volume_max(timeout=2.0):
+    """Set System volume to maximum and unmute"""
+    try:
+        # Set volume to max and unmute, then the alternative method, in one osascript
+        result = processes.run(
+            ['osascript',
+             '-e', 'set volume output volume 100 without output muted',
+             '-e', 'set volume without output muted'],
+            timeout=timeout
+        )
+        result.check_returncode()
+        return True
+    except Exception as e:
+        log.warning('Error setting volume', error=str(e))
+        return False
+
+
+class VolumeEnforcer:
+    """Calls set_volume_max every interval seconds in its own thread while the alarm plays"""
+
+    def __init__(self, interval=10.0, timeout=2.0):
+        self.interval = interval
+        self.timeout = timeout
+        self.enforcements = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Start enforcing unless already running; returns the Event that stops this run"""
+        if self._thread is not None and not self._stop_event.is_set():
+            return self._stop_event
+        # A new event each time: a stopped thread still inside osascript exits on its own
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(self._stop_event,),
+                                        daemon=True, name='volume-enforcer')
+        self._thread.start()
+        return self._stop_event
+
+    def stop(self):
+        """Doesn't wait: an osascript in flight is killed by its timeout at the latest"""
+        self._stop_event.set()
+        self._thread = None
+
+    def _run(self, stop_event):
+        while not stop_event.is_set():
+            self.enforcements += 1
+            set_volume_max(self.timeout)
+            if stop_event.wait(self.interval):
+                break
+
+
+class NSSoundBackend:
+    """Loops the sound in-process through AppKit's NSSound"""
+
+    name = 'nssound'
+
+    def __init__(self, path):
+        from AppKit import NSSound  # optional dependency (pyobjc)
+        from Foundation import NSData
+        data = NSData.dataWithContentsOfFile_(path)
+        if data is None:
+            raise OSError(f'Could not read {path}')
+        self._sound = NSSound.alloc().initWithData_(data)
+        if self._sound is None:
+            raise OSError(f'Could not decode {path}')
+        self._stopped = threading.Event()
+        self.path = path
+        self.spawns = 0
+
+    def play(self, loop):
+        self._stopped.clear()
+        self._sound.setLoops_(loop)
+        if not self._sound.play():
+            raise PlaybackError('NSSound refused to play')
+
+    def wait(self, timeout):
+        if self._stopped.wait(timeout):
+            return True
+        return not self._sound.isPlaying()
+
+    def stop(self):
+        self._stopped.set()
+        self._sound.stop()
+
+
+class AfplayBackend:
+    """Runs one afplay at a time"""
+
+    name = 'afplay'
+
+    def __init__(self, path, player=None):
+        # shutil imports the compression modules: only load it off the startup path
+        import shutil
+        player = player or shutil.which('afplay')
+        if player is None:
+            raise OSError('afplay not found')
+        # Note: -l flag doesn't exist in this afplay version, so we loop manually
+        self.command = [player, '-v', '1', path]
+        self.path = path
+        self.spawns = 0
+        self._lock = threading.Lock()
+        self._process = None
+
+    @property
+    def pid(self):
+        process = self._process
+        return process.pid if process is not None else None
+
+    def play(self, loop):
+        # Don't capture stdout so sound can play
+        process = processes.spawn(
+            self.command,
+            essential=True,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.PIPE
+        )
+        with self._lock:
+            previous, self._process = self._process, process
+        self.spawns += 1
+        if previous is not None and previous.poll() is None:
+            previous.terminate()
+
+    def wait(self, timeout):
+        process = self._process
+        if process is None:
+            return True
+        try:
+            returncode = process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            return False
+        with self._lock:
+            if self._process is process:
+                self._process = None
+        if returncode > 0:
+            _, stderr_output = process.communicate()
+            error_msg = stderr_output.decode('utf-8') if stderr_output else "Unknown error"
+            raise PlaybackError(error_msg.strip())
+        return True
+
+    def stop(self):
+        with self._lock:
+            process, self._process = self._process, None
+        if process is None:
+            return
+        try:
+            process.terminate()
+            process.wait(timeout=1)
+            log.info('Alarm stopped', pid=process.pid)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            log.info('Alarm force killed', pid=process.pid)
+        except Exception as e:
+            log.error('Error stopping alarm process', error=str(e))
+
+
+class SinkBackend:
+    """Plays the in-memory sound into a sink file, or nowhere"""
+
+    def __init__(self, path, sink=None, duration=1.0):
+        with open(path, 'rb') as f:
+            self._data = f.read()
+        self.name = 'file' if sink else 'null'
+        self.path = path
+        self.sink = sink
+        self.duration = duration
+        self.spawns = 0
+        self._stopped = threading.Event()
+        self._ends_at = None
+
+    def play(self, loop):
+        self._stopped.clear()
+        if self.sink:
+            with open(self.sink, 'ab') as f:
+                f.write(self._data)
+        self._ends_at = time.monotonic() + self.duration
+
+    def wait(self, timeout):
+        if self._ends_at is None:
+            return True
+        remaining = self._ends_at - time.monotonic()
+        if self._stopped.wait(max(0.0, min(timeout, remaining))):
+            return True
+        return time.monotonic() >= self._ends_at
+
+    def stop(self):
+        self._stopped.set()
+        self._ends_at = None
+
+
+def create_audio_backend(path, spec=None):
+    """Build the playback backend named by spec or MACSENTINEL_AUDIO"""
+    if path is None:
+        return None
+    spec = spec or os.environ.get('MACSENTINEL_AUDIO', '')
+    if spec == 'null':
+        return SinkBackend(path)
+    if spec.startswith('file:'):
+        return SinkBackend(path, sink=spec[len('file:'):])
+    if spec == 'afplay':
+        return AfplayBackend(path)
+    try:
+        return NSSoundBackend(path)
+    except Exception as e:
+        if spec == 'nssound':
+            raise
+        if spec:
+            log.warning('Unknown MACSENTINEL_AUDIO, using the default backend', value=spec)
+        try:
+            return AfplayBackend(path)
+        except OSError:
+            log.warning('No alarm playback available (afplay not found)', nssound_error=str(e))
+            return None
+
+
+class AudioWorker:
+    """Keeps the alarm sound playing in one long-lived thread"""
+
+    def __init__(self, backend, volume_interval=10.0, max_failures=10, retry_delay=1.0):
+        self.backend = backend
+        self.volume = VolumeEnforcer(volume_interval)
+        self.max_failures = max_failures
+        self.retry_delay = retry_delay
+        self.loops = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        # Per run, like VolumeEnforcer's: set by stop() or when the run ends,
+        # so a worker thread join() gave up on can't be revived by start()
+        self._stop_event = threading.Event()
+        self._stop_event.set()
+        self._thread = None
+        self._loop = True
+
+    @property
+    def is_playing(self):
+        return (self._thread is not None and self._thread.is_alive()
+                and not self._stop_event.is_set())
+
+    def start(self, loop=True):
+        """Start playback now; the worker thread keeps it going
+
+        Raises if the first playback can't be started.
+        """
+        if self.is_playing:
+            return False
+        stop_event = threading.Event()
+        with self._lock:
+            self._stop_event = stop_event
+            self._loop = loop
+        try:
+            self.backend.play(loop=loop)
+        except Exception:
+            stop_event.set()
+            raise
+        self.loops = 1
+        # Volume first thing, then every volume_interval, off the playback thread
+        volume_stop = self.volume.start()
+        # Started before it is published, so join() never sees an unstarted thread
+        thread = threading.Thread(target=self._run, args=(stop_event, volume_stop), daemon=True,
+                                  name='audio-worker')
+        thread.start()
+        self._thread = thread
+        return True
+
+    def keep_looping(self):
+        """Make a run started with loop=False loop until stop(); False if there is none"""
+        with self._lock:
+            if self._loop or not self.is_playing:
+                return False
+            self._loop = True
+            return True
+
+    def stop(self):
+        """Stop playback; call join() to wait for the worker thread to exit"""
+        self._stop_event.set()
+        self.volume.stop()
+        self.backend.stop()
+
+    def join(self, timeout=1.0):
+        """Wait for the worker thread; it stays the current one until it has exited"""
+        thread = self._thread
+        if thread is None or thread is threading.current_thread():
+            return
+        thread.join(timeout=timeout)
+        if not thread.is_alive() and self._thread is thread:
+            self._thread = None
+
+    def _run(self, stop_event, volume_stop):
+        restarts = ALARM_RESTARTS.labels(backend=self.backend.name)
+        failures = ALARM_FAILURES.labels(backend=self.backend.name)
+        consecutive_failures = 0
+        ALARM_CONSECUTIVE_FAILURES.set(0)
+        while not stop_event.is_set():
+            try:
+                ended = self.backend.wait(timeout=1.0)
+            except PlaybackError as e:
+                consecutive_failures += 1
+                self.failures += 1
+                failures.inc()
+                ALARM_CONSECUTIVE_FAILURES.set(consecutive_failures)
+                log.warning('Alarm playback failed', attempt=consecutive_failures, error=str(e))
+                if consecutive_failures == 1:
+                    # The output device may have gone away; look again
+                    capabilities.invalidate('audio_outputs')
+                if consecutive_failures >= self.max_failures:
+                    log.error('Alarm playback failed too many times, stopping retries')
+                    break
+                # Wait longer before retrying after failure
+                if stop_event.wait(self.retry_delay):
+                    break
+                ended = True
+            else:
+                if ended and consecutive_failures:
+                    consecutive_failures = 0
+                    ALARM_CONSECUTIVE_FAILURES.set(0)
+            if not ended or stop_event.is_set():
+                continue
+            with self._lock:
+                if not self._loop:
+                    # Checked under the lock, so keep_looping() either comes first or finds us done
+                    stop_event.set()
+                    break
+            try:
+                self.backend.play(loop=True)
+                self.loops += 1
+                restarts.inc()
+            except Exception as e:
+                consecutive_failures += 1
+                self.failures += 1
+                failures.inc()
+                ALARM_CONSECUTIVE_FAILURES.set(consecutive_failures)
+                log.error('Error in alarm loop', error=str(e))
+                if consecutive_failures >= self.max_failures or stop_event.wait(self.retry_delay):
+                    break
+        # Played once, or gave up: nothing left to be loud for, and the next
+        # trigger starts a new run
+        stop_event.set()
+        volume_stop.set()
+
+    def stats(self):
+        return {
+            'backend': self.backend.name,
+            'playing': self.is_playing,
+            'loops': self.loops,
+            'failures': self.failures,
+            'spawns': self.backend.spawns,
+            'volume_enforcements': self.volume.enforcements,
+        }
@@ -0,0 +1,145 @@
+"""Static assets with content-hashed URLs, long-lived caching and precompression.
+
+AssetManifest reads static/ once at startup. Every file gets a fingerprinted
+name with a short hash of its contents (css/style.css -> css/style.1a2b3c4d5e.css).
+Text assets get gzip variants, plus brotli ones when the optional `brotli`
+package is installed, and each variant is kept only if it is smaller.
+
+serve() answers a request for either name:
+  - a fingerprinted name can never change, so it is cached for a year as
+    `immutable`
+  - the plain name gets `no-cache`, so browsers revalidate it
+Both carry an ETag and answer If-None-Match with 304. Uncompressed files go
+through send_file, which also handles Range requests (seeking in the alarm
+sound, for example).
+"""
+import gzip
+import hashlib
+import mimetypes
+import os
+from collections import namedtuple
+
+from flask import Response, abort, send_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+
+# Preferred first
+ENCODINGS = ('br', 'gzip') if brotli is not None else ('gzip',)
+
+# path: file on disk; variants: {encoding: bytes}, only where smaller than the original
+Asset = namedtuple('Asset', 'name url_name path digest mimetype size variants')
+
+
+def fingerprint(name, digest):
+    """css/style.css -> css/style.<digest>.css"""
+    root, ext = os.path.splitext(name)
+    return f'{root}.{digest}{ext}'
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=11)
+    # mtime=0 keeps the output (and so its ETag) stable across restarts
+    return gzip.compress(data, compresslevel=9, mtime=0)
+
+
+def accepted_encodings(header):
+    """Content codings an Accept-Encoding header allows, without those at q=0"""
+    accepted = set()
+    for part in (header or '').split(','):
+        name, *params = part.split(';')
+        quality = 1.0
+        for param in params:
+            key, _, value = param.strip().partition('=')
+            if key == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    pass
+        name = name.strip().lower()
+        if name and quality > 0:
+            accepted.add(name)
+    return accepted
+
+
+class AssetManifest:
+    """Every file under a static directory, hashed and precompressed once"""
+
+    def __init__(self, root, digest_size=10):
+        self.root = root
+        self.assets = {}
+        self._by_url_name = {}
+        for directory, _, files in os.walk(root):
+            for filename in sorted(files):
+                path = os.path.join(directory, filename)
+                name = os.path.relpath(path, root).replace(os.sep, '/')
+                self._add(name, path, digest_size)
+
+    def _add(self, name, path, digest_size):
+        with open(path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()[:digest_size]
+        mimetype = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+        variants = {}
+        if mimetype.startswith(COMPRESSIBLE):
+            for encoding in ENCODINGS:
+                compressed = compress(data, encoding)
+                if len(compressed) < len(data):
+                    variants[encoding] = compressed
+        asset = Asset(name, fingerprint(name, digest), path, digest, mimetype, len(data), variants)
+        self.assets[name] = asset
+        self._by_url_name[asset.url_name] = asset
+
+    def url_name(self, name):
+        """The fingerprinted name for name, or name itself if it isn't an asset"""
+        asset = self.assets.get(name)
+        return asset.url_name if asset is not None else name
+
+    def lookup(self, requested):
+        """(asset, fingerprinted?) for a requested name, or (None, False)"""
+        asset = self._by_url_name.get(requested)
+        if asset is not None:
+            return asset, True
+        return self.assets.get(requested), False
+
+    def serve(self, request, requested):
+        """The response for GET /static/<requested>"""
+        asset, fingerprinted = self.lookup(requested)
+        if asset is None:
+            abort(404)
+        cache_control = IMMUTABLE if fingerprinted else REVALIDATE
+
+        accepted = accepted_encodings(request.headers.get('Accept-Encoding'))
+        encoding = next((e for e in ENCODINGS
+                         if e in asset.variants and (e in accepted or '*' in accepted)), None)
+        if encoding is not None:
+            response = Response(asset.variants[encoding], mimetype=asset.mimetype)
+            response.headers['Content-Encoding'] = encoding
+            response.set_etag(f'{asset.digest}-{encoding}')
+            response.make_conditional(request)
+        else:
+            response = send_file(asset.path, mimetype=asset.mimetype, conditional=True,
+                                 etag=asset.digest, max_age=None)
+        response.headers['Cache-Control'] = cache_control
+        if asset.variants:
+            response.vary.add('Accept-Encoding')
+        return response
+
+    def stats(self):
+        return {
+            name: {
+                'url': asset.url_name,
+                'bytes': asset.size,
+                'encodings': {encoding: len(data) for encoding, data in asset.variants.items()},
+            }
+            for name, asset in sorted(self.assets.items())
+        }
@@ -0,0 +1,74 @@
+"""Measure how long arming takes while capability probes are slow.
+
+Runs app.py in-process against the stand-in macOS commands
+(benchmarks/fakemac.py) with `system_profiler` and `pmset` slowed down, and
+times /api/arm until the sentinel reports ARMED - first while the startup
+probes are still running, then with the capability cache warm. Arming
+should take milliseconds either way and run no probes.
+
+    python benchmarks/bench_arm.py [--rounds 20] [--probe-delay 2.0]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+sys.path.insert(0, HERE)
+
+from fakemac import FakeMac  # noqa: E402
+
+
+def arm_once(client, state, armed_state):
+    started = time.perf_counter()
+    client.post('/api/arm')
+    if not state.wait_for(armed_state, timeout=5):
+        sys.exit('system did not arm')
+    elapsed = (time.perf_counter() - started) * 1000
+    client.post('/api/stop')
+    return elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--probe-delay', type=float, default=2.0,
+                        help='seconds each system_profiler and pmset call takes')
+    args = parser.parse_args()
+
+    fake = FakeMac()
+    fake.set_delay('system_profiler', args.probe_delay)
+    fake.set_delay('pmset', args.probe_delay)
+    os.environ.update(fake.env())
+    os.environ['MACSENTINEL_AUDIO'] = 'null'
+    # Host our own engine, whatever else runs on this machine
+    os.environ['MACSENTINEL_RUN_DIR'] = tempfile.mkdtemp()
+
+    import app
+    app.start()
+    from capabilities import capabilities
+    from sentinel import ARMED
+    client = app.app.test_client()
+    state = app.sentinel.state
+
+    cold = arm_once(client, state, ARMED)
+    if not capabilities.wait(timeout=args.probe_delay * 4 + 10):
+        sys.exit('capability probes did not finish')
+    probes_before = capabilities.probe_runs
+    warm = [arm_once(client, state, ARMED) for _ in range(args.rounds)]
+    probes_during = capabilities.probe_runs - probes_before
+
+    warm.sort()
+    print(f"arm while probing:   {cold:7.1f} ms")
+    print(f"arm with warm cache: p50 {warm[len(warm) // 2]:.1f} ms, max {warm[-1]:.1f} ms "
+          f"({args.rounds} rounds)")
+    print(f"probes run while arming: {probes_during}")
+    print(f"slow commands: {args.probe_delay:.1f} s each "
+          f"(startup probing took {sum(c['probe_ms'] for c in capabilities.snapshot()['capabilities'].values() if c['probed']):.0f} ms)")
+    app.sentinel.cleanup()
+
+
+if __name__ == '__main__':
+    main()
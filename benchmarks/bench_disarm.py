@@ -0,0 +1,78 @@
+"""Measure how long /api/stop takes, idle and while the alarm is sounding.
+
+Drives app.py in-process with the file lid source and the null audio
+backend, so it runs without a Mac. Exits non-zero if the slowest disarm is
+over --budget-ms.
+
+    python benchmarks/bench_disarm.py [--rounds 50] [--budget-ms 20]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=50)
+    parser.add_argument('--budget-ms', type=float, default=20.0)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    lid_path = os.path.join(tmp, 'lid')
+    open(lid_path, 'w').close()
+    os.environ['MACSENTINEL_LID_SOURCE'] = f'file:{lid_path}'
+    os.environ['MACSENTINEL_AUDIO'] = 'null'
+    # Host our own engine, whatever else runs on this machine
+    os.environ['MACSENTINEL_RUN_DIR'] = tempfile.mkdtemp()
+
+    import app
+    app.start()
+    from sentinel import ALARMING, ARMED
+    client = app.app.test_client()
+    state = app.sentinel.state
+
+    idle, alarming = [], []
+    for _ in range(args.rounds):
+        with open(lid_path, 'a') as f:
+            f.write('open\n')
+        client.post('/api/arm')
+        if not state.wait_for(ARMED, timeout=5):
+            sys.exit('system did not arm')
+        # Let the monitor pick up the baseline, then close the lid
+        time.sleep(0.1)
+        with open(lid_path, 'a') as f:
+            f.write(f'closed {time.time()}\n')
+        if not state.wait_for(ALARMING, timeout=5):
+            sys.exit('alarm did not trigger')
+
+        started = time.perf_counter()
+        client.post('/api/stop')
+        alarming.append((time.perf_counter() - started) * 1000)
+
+        started = time.perf_counter()
+        client.post('/api/stop')
+        idle.append((time.perf_counter() - started) * 1000)
+
+    for name, values in (('disarm while alarming', alarming), ('disarm while idle', idle)):
+        print(f"{name:>22}: p50 {percentile(values, 0.5):6.2f} ms  "
+              f"p99 {percentile(values, 0.99):6.2f} ms  max {max(values):6.2f} ms")
+
+    worst = max(alarming + idle)
+    if worst > args.budget_ms:
+        print(f"FAIL: slowest disarm took {worst:.2f} ms (budget {args.budget_ms} ms)")
+        sys.exit(1)
+    print(f"OK: every disarm finished within {args.budget_ms} ms")
+
+
+if __name__ == '__main__':
+    main()
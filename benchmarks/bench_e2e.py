@@ -0,0 +1,392 @@
+"""End-to-end benchmark: app.py over HTTP, with fake macOS commands on PATH.
+
+Starts `python -m macsentinel serve` in a subprocess with the stand-ins from fakemac.py first on
+PATH (ioreg lid source, afplay playback), then drives it the way the UI
+does:
+
+  1. lid close detection: arm, close the lid, watch /api/events for the
+     lid and alarm_started events, then /api/stop
+  2. armed idle: arm, let the post-arm fast sampling settle, then measure
+     forks and CPU over --idle-seconds
+  3. /api/test-alarm round trips
+  4. faults: ioreg stalls past its timeout, then afplay fails
+
+It reports detection, trigger and disarm latency percentiles, forks per
+minute and CPU seconds per armed hour, and writes them to a JSON file.
+Pass --baseline with an earlier result to see what got worse. Runs on Linux
+(CPU time comes from /proc).
+
+    python benchmarks/bench_e2e.py [--rounds 20] [--idle-seconds 30] [--settle-seconds 30]
+                                   [--output results.json] [--baseline old.json]
+"""
+import argparse
+import http.client
+import json
+import os
+import platform
+import queue
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+from fakemac import FakeMac  # noqa: E402
+
+# Result keys where a bigger number is worse, for --baseline
+LOWER_IS_BETTER = ('startup_ms', 'detection_latency_ms', 'trigger_latency_ms',
+                   'server_trigger_latency_ms', 'disarm_latency_ms', 'test_alarm_latency_ms',
+                   'forks_per_minute_armed', 'cpu_seconds_per_armed_hour')
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def summarize(values):
+    """Percentiles of a list of milliseconds"""
+    if not values:
+        return None
+    values = sorted(values)
+
+    def pick(fraction):
+        return round(values[min(len(values) - 1, int(len(values) * fraction))], 3)
+    return {'p50': pick(0.5), 'p90': pick(0.9), 'p99': pick(0.99),
+            'max': round(values[-1], 3), 'samples': len(values)}
+
+
+def cpu_times(pid):
+    """(own, reaped children) CPU seconds of pid, from /proc"""
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+    except OSError:
+        return None
+    ticks = os.sysconf('SC_CLK_TCK')
+    utime, stime, cutime, cstime = (int(v) for v in fields[11:15])
+    return (utime + stime) / ticks, (cutime + cstime) / ticks
+
+
+class Server:
+    """app.py running in a subprocess"""
+
+    def __init__(self, env, log_path):
+        self.port = free_port()
+        self.log = open(log_path, 'w')
+        started = time.perf_counter()
+        self.process = subprocess.Popen([sys.executable, '-m', 'macsentinel', 'serve',
+                                         '--port', str(self.port)],
+                                        cwd=ROOT, env=env, stdout=self.log,
+                                        stderr=subprocess.STDOUT)
+        deadline = time.monotonic() + 15
+        while True:
+            try:
+                if self.request('GET', '/api/health')[0] == 200:
+                    break
+            except OSError:
+                if self.process.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError(f'app.py did not start, see {log_path}')
+                time.sleep(0.02)
+        self.startup_ms = (time.perf_counter() - started) * 1000
+
+    def request(self, method, path):
+        """Return (status, parsed body, seconds)"""
+        connection = http.client.HTTPConnection('127.0.0.1', self.port, timeout=10)
+        try:
+            started = time.perf_counter()
+            connection.request(method, path)
+            response = connection.getresponse()
+            body = response.read()
+            elapsed = time.perf_counter() - started
+        finally:
+            connection.close()
+        if response.getheader('Content-Type', '').startswith('application/json'):
+            body = json.loads(body)
+        return response.status, body, elapsed
+
+    def status(self):
+        return self.request('GET', '/api/status')[1]
+
+    def wait_for_state(self, *states, timeout=10):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.status().get('state') in states:
+                return True
+            time.sleep(0.02)
+        return False
+
+    def metrics(self):
+        """Parsed /metrics samples: {'name{labels}': value}"""
+        text = self.request('GET', '/metrics')[1].decode()
+        samples = {}
+        for line in text.splitlines():
+            if line and not line.startswith('#'):
+                name, value = line.rsplit(' ', 1)
+                samples[name] = float(value)
+        return samples
+
+    def stop(self):
+        if self.process.poll() is None:
+            # SIGINT so the app's atexit cleanup runs
+            self.process.send_signal(signal.SIGINT)
+            try:
+                self.process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.log.close()
+
+
+class EventListener:
+    """Reads /api/events in a thread and queues (arrival time, kind, data)"""
+
+    def __init__(self, port):
+        self.events = queue.Queue()
+        self._connection = http.client.HTTPConnection('127.0.0.1', port)
+        self._connection.request('GET', '/api/events')
+        self._response = self._connection.getresponse()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def _run(self):
+        kind, data = 'message', ''
+        try:
+            for raw in self._response:
+                line = raw.decode().rstrip('\n')
+                if line.startswith('event:'):
+                    kind = line[6:].strip()
+                elif line.startswith('data:'):
+                    data += line[5:].strip()
+                elif not line:
+                    if data:
+                        self.events.put((time.perf_counter(), kind, json.loads(data)))
+                    kind, data = 'message', ''
+        except (OSError, ValueError):
+            pass
+
+    def wait_for(self, kind, timeout=10):
+        """Return (arrival time, data) of the next event of kind, or None"""
+        deadline = time.monotonic() + timeout
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            try:
+                arrived, event_kind, data = self.events.get(timeout=remaining)
+            except queue.Empty:
+                return None
+            if event_kind == kind:
+                return arrived, data
+
+    def drain(self):
+        while True:
+            try:
+                self.events.get_nowait()
+            except queue.Empty:
+                return
+
+    def close(self):
+        self._connection.close()
+
+
+def bench_detection(server, listener, fake, rounds):
+    detection, trigger, server_trigger, disarm = [], [], [], []
+    for _ in range(rounds):
+        fake.set_lid(False)
+        server.request('POST', '/api/arm')
+        if not server.wait_for_state('armed'):
+            raise RuntimeError('app did not arm')
+        time.sleep(0.3)
+        listener.drain()
+
+        flipped = time.perf_counter()
+        fake.set_lid(True)
+        lid = listener.wait_for('lid')
+        alarm = listener.wait_for('alarm_started')
+        if lid is not None:
+            detection.append((lid[0] - flipped) * 1000)
+        if alarm is not None:
+            trigger.append((alarm[0] - flipped) * 1000)
+            if alarm[1].get('latency_ms') is not None:
+                server_trigger.append(alarm[1]['latency_ms'])
+
+        _, _, elapsed = server.request('POST', '/api/stop')
+        disarm.append(elapsed * 1000)
+    fake.set_lid(False)
+    return {
+        'detection_latency_ms': summarize(detection),
+        'trigger_latency_ms': summarize(trigger),
+        'server_trigger_latency_ms': summarize(server_trigger),
+        'disarm_latency_ms': summarize(disarm),
+        'missed_detections': rounds - len(detection),
+    }
+
+
+def bench_idle(server, fake, seconds, settle):
+    server.request('POST', '/api/arm')
+    if not server.wait_for_state('armed'):
+        raise RuntimeError('app did not arm')
+    # Sampling is fast right after arming; an armed hour is mostly the quiet rate
+    time.sleep(settle)
+    calls_before = fake.calls()
+    cpu_before = cpu_times(server.process.pid)
+    started = time.monotonic()
+    time.sleep(seconds)
+    elapsed = time.monotonic() - started
+    cpu_after = cpu_times(server.process.pid)
+    calls = fake.calls() - calls_before
+    server.request('POST', '/api/stop')
+
+    result = {
+        'forks_per_minute_armed': round(sum(calls.values()) / elapsed * 60, 2),
+        'forks_by_command': dict(calls),
+        'cpu_seconds_per_armed_hour': None,
+    }
+    if cpu_before is not None and cpu_after is not None:
+        # Helper CPU only includes helpers that have exited and been reaped
+        result['cpu_seconds_per_armed_hour'] = {
+            'server': round((cpu_after[0] - cpu_before[0]) / elapsed * 3600, 2),
+            'helpers': round((cpu_after[1] - cpu_before[1]) / elapsed * 3600, 2),
+        }
+    return result
+
+
+def bench_test_alarm(server, rounds):
+    latencies = []
+    for _ in range(rounds):
+        _, body, elapsed = server.request('POST', '/api/test-alarm')
+        if body.get('success'):
+            latencies.append(elapsed * 1000)
+        server.request('POST', '/api/stop')
+    return {'test_alarm_latency_ms': summarize(latencies)}
+
+
+def bench_faults(server, listener, fake):
+    """ioreg stalls past its timeout, then the alarm player fails"""
+    before = server.metrics()
+    fake.set_lid(False)
+    server.request('POST', '/api/arm')
+    server.wait_for_state('armed')
+
+    fake.set_delay('ioreg', 1.0)
+    time.sleep(3)
+    fake.clear('ioreg')
+    time.sleep(1)
+    listener.drain()
+    fake.set_failure('afplay', 'AudioQueueStart failed')
+    fake.set_lid(True)
+    detected = listener.wait_for('lid', timeout=15) is not None
+    time.sleep(2)
+    server.request('POST', '/api/stop')
+    fake.clear('afplay')
+    fake.set_lid(False)
+
+    after = server.metrics()
+
+    def delta(name):
+        return after.get(name, 0) - before.get(name, 0)
+    return {'faults': {
+        'ioreg_timeouts': delta('macsentinel_ioreg_timeouts_total'),
+        'detected_after_ioreg_stall': detected,
+        'alarm_failures': delta('macsentinel_alarm_failures_total{backend="afplay"}'),
+    }}
+
+
+def compare(results, baseline, tolerance):
+    """Print how each lower-is-better number moved against the baseline"""
+    print(f"\nCompared with baseline ({baseline.get('timestamp')}):")
+    worse = 0
+    for key in LOWER_IS_BETTER:
+        new, old = results.get(key), baseline.get(key)
+        if isinstance(new, dict) and isinstance(old, dict):
+            pairs = [(f'{key}.{k}', new.get(k), old.get(k)) for k in ('p50', 'p99', 'server', 'helpers')]
+        else:
+            pairs = [(key, new, old)]
+        for name, a, b in pairs:
+            if not isinstance(a, (int, float)) or not isinstance(b, (int, float)) or not b:
+                continue
+            change = (a - b) / b
+            flag = ''
+            if change > tolerance:
+                flag = '  <-- worse'
+                worse += 1
+            print(f"  {name:>38}: {b:>10.2f} -> {a:>10.2f} ({change:+.0%}){flag}")
+    return worse
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--idle-seconds', type=float, default=30)
+    parser.add_argument('--settle-seconds', type=float, default=30,
+                        help='armed time before the idle measurement starts')
+    parser.add_argument('--output', default=os.path.join(BENCH_DIR, 'results', 'e2e.json'))
+    parser.add_argument('--baseline', help='earlier result JSON to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='relative slowdown reported as a regression (default 0.2)')
+    parser.add_argument('--no-faults', action='store_true')
+    args = parser.parse_args()
+
+    fake = FakeMac()
+    fake.set_afplay_duration(1.0)
+    env = fake.env()
+    env['MACSENTINEL_LID_SOURCE'] = 'ioreg'
+    env['MACSENTINEL_AUDIO'] = 'afplay'
+    env.pop('MACSENTINEL_ENGINE', None)
+    # Our own engine lease and socket, whatever else runs on this machine
+    env['MACSENTINEL_RUN_DIR'] = os.path.join(fake.root, 'run')
+    log_path = os.path.join(fake.root, 'app.log')
+
+    server = Server(env, log_path)
+    listener = EventListener(server.port)
+    results = {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'platform': platform.platform(),
+        'python': platform.python_version(),
+        'config': {'rounds': args.rounds, 'idle_seconds': args.idle_seconds,
+                   'settle_seconds': args.settle_seconds,
+                   'lid_source': 'ioreg', 'audio': 'afplay'},
+        'startup_ms': round(server.startup_ms, 1),
+    }
+    try:
+        results.update(bench_detection(server, listener, fake, args.rounds))
+        results.update(bench_idle(server, fake, args.idle_seconds, args.settle_seconds))
+        results.update(bench_test_alarm(server, args.rounds))
+        if not args.no_faults:
+            results.update(bench_faults(server, listener, fake))
+    finally:
+        listener.close()
+        server.stop()
+
+    for key in ('detection_latency_ms', 'trigger_latency_ms', 'server_trigger_latency_ms',
+                'disarm_latency_ms', 'test_alarm_latency_ms'):
+        value = results.get(key)
+        if value:
+            print(f"{key:>26}: p50 {value['p50']:8.2f}  p90 {value['p90']:8.2f}  "
+                  f"p99 {value['p99']:8.2f}  max {value['max']:8.2f}")
+    print(f"{'startup_ms':>26}: {results['startup_ms']}")
+    print(f"{'forks_per_minute_armed':>26}: {results['forks_per_minute_armed']} "
+          f"{results['forks_by_command']}")
+    print(f"{'cpu_seconds_per_armed_hour':>26}: {results['cpu_seconds_per_armed_hour']}")
+    if 'faults' in results:
+        print(f"{'faults':>26}: {results['faults']}")
+
+    os.makedirs(os.path.dirname(os.path.abspath(args.output)), exist_ok=True)
+    with open(args.output, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+    print(f"Results written to {args.output} (app log: {log_path})")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            if compare(results, json.load(f), args.tolerance):
+                sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
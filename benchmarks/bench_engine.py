@@ -0,0 +1,90 @@
+"""Compare the threaded Sentinel with the asyncio engine while armed and alarming.
+
+Reports thread count and context switches per second for each. Uses the
+file lid source and the null audio backend, so it runs without a Mac
+(context switch counts come from /proc and are Linux-only).
+
+    python benchmarks/bench_engine.py [--seconds 5]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+def context_switches():
+    """Voluntary + involuntary context switches summed over all our threads"""
+    total = 0
+    try:
+        for task in os.listdir('/proc/self/task'):
+            try:
+                with open(f'/proc/self/task/{task}/status') as f:
+                    total += sum(int(line.split(':', 1)[1]) for line in f if 'ctxt_switches' in line)
+            except OSError:
+                pass  # Thread exited while we were reading
+    except OSError:
+        return None
+    return total
+
+
+def measure(sentinel, lid_path, seconds):
+    with open(lid_path, 'w') as f:
+        f.write('open\n')
+    sentinel.arm()
+    time.sleep(0.5)
+    results = {}
+    for phase in ('armed', 'alarming'):
+        if phase == 'alarming':
+            with open(lid_path, 'a') as f:
+                f.write('closed\n')
+            time.sleep(0.5)
+        before = context_switches()
+        started = time.monotonic()
+        time.sleep(seconds)
+        elapsed = time.monotonic() - started
+        after = context_switches()
+        results[phase] = {
+            'threads': threading.active_count(),
+            'ctx_switches_per_s': (after - before) / elapsed if before is not None else None,
+        }
+    sentinel.disarm()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args()
+
+    lid_path = os.path.join(tempfile.mkdtemp(), 'lid')
+    os.environ['MACSENTINEL_LID_SOURCE'] = f'file:{lid_path}'
+    os.environ['MACSENTINEL_AUDIO'] = 'null'
+
+    from engine import AsyncEngine
+    from sentinel import Sentinel
+
+    threaded = Sentinel()
+    threaded_results = measure(threaded, lid_path, args.seconds)
+    threaded.cleanup()
+
+    # Same sampling rate as the file lid source used by the threaded sentinel
+    engine = AsyncEngine(pmset_command=['true'], sample_interval=0.05)
+    engine.start()
+    engine_results = measure(engine, lid_path, args.seconds)
+    engine.cleanup()
+
+    print(f"{'':>10} {'phase':>9} {'threads':>8} {'ctx switches/s':>15}")
+    for name, results in (('threaded', threaded_results), ('asyncio', engine_results)):
+        for phase, values in results.items():
+            rate = values['ctx_switches_per_s']
+            print(f"{name:>10} {phase:>9} {values['threads']:>8} "
+                  f"{rate if rate is None else round(rate, 1):>15}")
+
+
+if __name__ == '__main__':
+    main()
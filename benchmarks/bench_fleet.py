@@ -0,0 +1,187 @@
+"""Load generator for the fleet collector.
+
+Starts `python -m macsentinel collect` on a free port and has --agents
+simulated agents send gzip-compressed heartbeat batches (a few events each,
+as fleet.py sends them) from --concurrency threads, --rounds times over.
+Reports ingest throughput and latency, the collector's memory after each
+round (flat once every agent has been seen once), and how fast
+/api/fleet, /api/fleet/events and the dashboard answer with the whole
+fleet loaded. Then checks a real FleetAgent against a collector that is
+down: the agent's buffer has to stay at its limit however many events
+arrive.
+
+    python benchmarks/bench_fleet.py [--agents 2000] [--rounds 3] [--concurrency 32]
+"""
+import argparse
+import gzip
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+
+from events import EventBroadcaster  # noqa: E402
+from fleet import FleetAgent  # noqa: E402
+
+KINDS = ('armed', 'disarmed', 'lid', 'alarm_started', 'alarm_stopped')
+STATES = ('disarmed', 'armed', 'armed', 'armed', 'alarming')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def rss_kib(pid):
+    output = subprocess.run(['ps', '-o', 'rss=', '-p', str(pid)], capture_output=True, text=True).stdout
+    return int(output.strip() or 0)
+
+
+class SimulatedAgent:
+    def __init__(self, index):
+        self.id = f'mac-{index:05d}'
+        self.boot = uuid.uuid4().hex
+        self.seq = 0
+
+    def batch(self):
+        events = []
+        for _ in range(random.randint(0, 4)):
+            self.seq += 1
+            kind = random.choice(KINDS)
+            events.append({'seq': self.seq, 'time': time.time(), 'kind': kind,
+                           'data': {'armed': True, 'state': 'armed', 'closed': kind == 'lid'}})
+        state = random.choice(STATES)
+        body = {'agent': self.id, 'boot': self.boot, 'host': self.id, 'interval': 30.0,
+                'sent_at': time.time(), 'events': events, 'dropped': 0,
+                'status': {'armed': state != 'disarmed', 'state': state, 'trigger_latency_ms': 12.5}}
+        return gzip.compress(json.dumps(body, separators=(',', ':')).encode()), len(events)
+
+
+def post(port, body):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    started = time.perf_counter()
+    try:
+        connection.request('POST', '/api/ingest', body, {'Content-Type': 'application/json',
+                                                        'Content-Encoding': 'gzip'})
+        response = connection.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - started
+    finally:
+        connection.close()
+
+
+def get(port, path):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=10)
+    started = time.perf_counter()
+    try:
+        connection.request('GET', path)
+        response = connection.getresponse()
+        data = response.read()
+        return (time.perf_counter() - started) * 1000, len(data)
+    finally:
+        connection.close()
+
+
+def wait_until_up(port, process):
+    deadline = time.monotonic() + 20
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            sys.exit('collector exited')
+        try:
+            get(port, '/api/fleet?limit=1')
+            return
+        except OSError:
+            time.sleep(0.05)
+    sys.exit('collector did not start')
+
+
+def ingest_round(port, agents, concurrency):
+    """(seconds, latencies, events, errors) for one batch from every agent"""
+    batches = [agent.batch() for agent in agents]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        results = list(pool.map(lambda batch: post(port, batch[0]), batches))
+    elapsed = time.perf_counter() - started
+    errors = sum(1 for status, _ in results if status != 200)
+    return elapsed, [latency for _, latency in results], sum(n for _, n in batches), errors
+
+
+def agent_outage(events=100000, max_buffered=1000):
+    """Publish events to a FleetAgent whose collector is down; returns its stats"""
+    broadcaster = EventBroadcaster()
+    agent = FleetAgent(f'http://127.0.0.1:{free_port()}', broadcaster, lambda: {'state': 'armed'},
+                       interval=0.2, max_buffered=max_buffered, timeout=0.5)
+    agent.start()
+    for i in range(events):
+        broadcaster.publish('lid', closed=bool(i % 2))
+        if i % 1000 == 0:
+            time.sleep(0.001)  # Let the agent thread keep up, as real event rates would
+    time.sleep(1.0)
+    agent.stop()
+    return agent.stats()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--agents', type=int, default=2000)
+    parser.add_argument('--rounds', type=int, default=3)
+    parser.add_argument('--concurrency', type=int, default=32)
+    args = parser.parse_args()
+
+    port = free_port()
+    env = dict(os.environ)
+    env.pop('MACSENTINEL_FLEET_TOKEN', None)
+    collector = subprocess.Popen([sys.executable, '-m', 'macsentinel', 'collect', '--host', '127.0.0.1',
+                                  '--port', str(port)], cwd=ROOT, env=env,
+                                 stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_until_up(port, collector)
+        base_rss = rss_kib(collector.pid)
+        agents = [SimulatedAgent(i) for i in range(args.agents)]
+        print(f"{args.agents} agents, {args.concurrency} concurrent connections, "
+              f"collector idle at {base_rss / 1024:.1f} MiB\n")
+        failed = 0
+        for round_number in range(1, args.rounds + 1):
+            elapsed, latencies, events, errors = ingest_round(port, agents, args.concurrency)
+            failed += errors
+            print(f"round {round_number}: {len(latencies) / elapsed:7.0f} batches/s, "
+                  f"{events / elapsed:7.0f} events/s, p50 {percentile(latencies, 0.5) * 1000:5.1f} ms, "
+                  f"p99 {percentile(latencies, 0.99) * 1000:5.1f} ms, errors {errors}, "
+                  f"collector {rss_kib(collector.pid) / 1024:.1f} MiB")
+
+        print()
+        for path in ('/api/fleet?limit=100', '/api/fleet?state=alarming&limit=1000',
+                     '/api/fleet/events?limit=1000', '/api/fleet/mac-00001', '/'):
+            timings = [get(port, path) for _ in range(20)]
+            print(f"GET {path:<38} p50 {percentile([t for t, _ in timings], 0.5):6.1f} ms "
+                  f"({timings[0][1]} bytes)")
+    finally:
+        collector.terminate()
+        collector.wait()
+
+    stats = agent_outage()
+    print(f"\nagent with the collector down: {stats['buffered']} buffered (limit {stats['max_buffered']}), "
+          f"{stats['dropped']} dropped, {stats['consecutive_failures']} failed attempts")
+    if stats['buffered'] > stats['max_buffered'] or failed:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
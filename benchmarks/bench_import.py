@@ -0,0 +1,128 @@
+"""Import time of each entry point, and cold start to armed for the daemon.
+
+Each import is timed in a fresh interpreter, which also reports whether
+Flask got loaded along the way; only app.py should load it. Cold start
+runs `python -m macsentinel daemon --arm` with the stand-in macOS commands
+(benchmarks/fakemac.py) and a private run directory, and times it from
+launch until its engine socket reports "armed". Exits non-zero if the
+median cold start is over --budget-ms.
+
+    python benchmarks/bench_import.py [--rounds 10] [--budget-ms 100]
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, ROOT)
+sys.path.insert(0, HERE)
+
+from daemon import EngineClient, EngineUnavailable  # noqa: E402
+from fakemac import FakeMac  # noqa: E402
+
+MODULES = ('events', 'daemon', 'macsentinel', 'sentinel', 'app')
+
+PROBE = ("import sys, time; started = time.perf_counter(); import {module}; "
+         "print('import-time', (time.perf_counter() - started) * 1000, 'flask' in sys.modules)")
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+def import_time(module, env, rounds):
+    """(median ms, Flask loaded?) for importing module in a fresh interpreter"""
+    times, flask = [], False
+    for _ in range(rounds):
+        output = subprocess.run([sys.executable, '-c', PROBE.format(module=module)], cwd=ROOT,
+                                env=env, capture_output=True, text=True, check=True).stdout
+        line = next(line for line in output.splitlines() if line.startswith('import-time '))
+        _, elapsed, loaded = line.split()
+        times.append(float(elapsed))
+        flask = flask or loaded == 'True'
+    return median(times), flask
+
+
+def cold_start(env, client):
+    """ms from launching the daemon until it reports armed"""
+    started = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'macsentinel', 'daemon', '--arm'], cwd=ROOT,
+                               env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                if client.call('ping')['state'] == 'armed':
+                    return (time.perf_counter() - started) * 1000
+            except EngineUnavailable:
+                pass
+            if process.poll() is not None:
+                sys.exit('daemon exited before arming')
+            if time.perf_counter() - started > 10:
+                sys.exit('daemon did not arm within 10 s')
+            time.sleep(0.001)
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def process_time(env, argv):
+    """Wall-clock ms to run `python <argv>` to completion"""
+    started = time.perf_counter()
+    subprocess.run([sys.executable] + argv, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, check=True)
+    return (time.perf_counter() - started) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=10)
+    parser.add_argument('--budget-ms', type=float, default=100.0)
+    args = parser.parse_args()
+
+    fake = FakeMac()
+    env = fake.env()
+    env['MACSENTINEL_AUDIO'] = 'null'
+    env['MACSENTINEL_RUN_DIR'] = tempfile.mkdtemp()
+    # Off macOS, probing for IOKit runs ldconfig/gcc (ctypes.util.find_library)
+    env['MACSENTINEL_LID_SOURCE'] = 'ioreg'
+    env.pop('MACSENTINEL_ENGINE', None)
+    client = EngineClient(os.path.join(env['MACSENTINEL_RUN_DIR'], 'engine.sock'), timeout=1.0)
+
+    startup = median([process_time(env, ['-c', 'pass']) for _ in range(args.rounds)])
+    print(f"interpreter start and exit: {startup:.1f} ms\n")
+    print(f"{'import':>12} {'median':>9}  Flask")
+    for module in MODULES:
+        elapsed, flask = import_time(module, env, args.rounds)
+        print(f"{module:>12} {elapsed:6.1f} ms  {'yes' if flask else 'no'}")
+
+    starts = sorted(cold_start(env, client) for _ in range(args.rounds))
+    print(f"\ncold start to armed: p50 {median(starts):.1f} ms, max {starts[-1]:.1f} ms "
+          f"({args.rounds} rounds, budget {args.budget_ms:.0f} ms)")
+
+    daemon = subprocess.Popen([sys.executable, '-m', 'macsentinel', 'daemon'], cwd=ROOT, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                client.call('ping')
+                break
+            except EngineUnavailable:
+                time.sleep(0.01)
+        for argv in (['status'], ['arm'], ['disarm']):
+            times = [process_time(env, ['-m', 'macsentinel'] + argv) for _ in range(args.rounds)]
+            print(f"{'macsentinel ' + argv[0]:>20}: p50 {median(times):.1f} ms (whole process)")
+    finally:
+        daemon.terminate()
+        daemon.wait()
+
+    if median(starts) > args.budget_ms:
+        print(f"FAIL: median cold start over {args.budget_ms:.0f} ms")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,152 @@
+"""Event journal: recording cost, memory over time and query latency.
+
+Records --events events (a mix of kinds, with a rare `failure` one in a
+thousand) into a journal backed by segment files in a temporary directory,
+checking that memory stays flat while it does. Then runs /api/history-style
+queries against it: the newest page, a page from a random point in time,
+a page after a random sequence number, and the same with a kind filter
+(including the rare kind, which has to skip past most of the records).
+Each query runs a few times untimed first, so the first touches of the
+files don't land in the percentiles. Last, times record() - what every
+publish pays - while another thread runs the heaviest query in a loop.
+Exits non-zero if the p99 of any query is over --budget-ms, or that of
+record() under queries over --record-budget-ms.
+
+    python benchmarks/bench_journal.py [--events 1000000] [--queries 200] [--budget-ms 20]
+"""
+import argparse
+import os
+import random
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from journal import EventJournal  # noqa: E402
+
+COMMON = ('armed', 'disarmed', 'lid_opened', 'lid_closed', 'power', 'alarm_started', 'alarm_stopped')
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def fill(journal, events, start_time):
+    """Record `events` events a second apart; returns (µs per record, memory growth in bytes)"""
+    kinds = [random.choice(COMMON) for _ in range(997)] + ['failure']
+    timestamp = start_time
+    tracemalloc.start()
+    baseline = None
+    started = time.perf_counter()
+    for i in range(events):
+        if i == 10000:
+            baseline = tracemalloc.get_traced_memory()[0]
+        timestamp += 1.0
+        journal.record(kinds[i % len(kinds)], 'ioreg', 12.5 if i % 2 else None, timestamp=timestamp)
+    elapsed = time.perf_counter() - started
+    growth = tracemalloc.get_traced_memory()[0] - (baseline or 0)
+    tracemalloc.stop()
+    return elapsed / events * 1e6, growth
+
+
+def record_under_queries(journal, query, records, start_time):
+    """record() latencies (ms) while another thread keeps running query()"""
+    stop = threading.Event()
+    ran = [0]
+
+    def querying():
+        while not stop.is_set():
+            query()
+            ran[0] += 1
+
+    thread = threading.Thread(target=querying)
+    thread.start()
+    times = []
+    try:
+        for i in range(records):
+            started = time.perf_counter()
+            journal.record('lid_closed', 'iokit', 3.0, timestamp=start_time + i)
+            times.append((time.perf_counter() - started) * 1000)
+            time.sleep(0.0005)
+    finally:
+        stop.set()
+        thread.join()
+    return times, ran[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--events', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--budget-ms', type=float, default=20.0)
+    parser.add_argument('--record-budget-ms', type=float, default=1.0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        # Enough segments to keep everything, so queries reach into the files
+        segments = args.events // 65536 + 2
+        journal = EventJournal(directory, max_segments=segments)
+        journal.open()
+        start_time = time.time() - args.events
+        per_record, growth = fill(journal, args.events, start_time)
+        journal.flush(timeout=60)  # The writer thread catches up with the files
+        stats = journal.stats()
+        # tracemalloc itself slows recording down several times
+        print(f"recorded {args.events} events: {per_record:.2f} µs each (under tracemalloc), "
+              f"memory growth after the first 10k: {growth / 1024:.1f} KiB")
+        print(f"ring {stats['ring_bytes'] / 1024:.0f} KiB, files {stats['file_bytes'] / 2**20:.1f} MiB "
+              f"in {stats['segments']} segments\n")
+
+        end_time = start_time + args.events
+        queries = {
+            'newest 100': lambda: journal.query(),
+            'since=<random>': lambda: journal.query(since=random.uniform(start_time, end_time)),
+            'after=<random>': lambda: journal.query(after=random.randrange(args.events)),
+            'newest, kind=lid_closed': lambda: journal.query(kinds=['lid_closed']),
+            'since=<random>, kind=failure': lambda: journal.query(
+                since=random.uniform(start_time, end_time), kinds=['failure']),
+            'newest 1000, kind=failure': lambda: journal.query(kinds=['failure'], limit=1000),
+        }
+        worst = 0.0
+        print(f"{'query':>30} {'p50':>9} {'p99':>9}  events")
+        for name, query in queries.items():
+            for _ in range(5):
+                query()
+            times = []
+            for _ in range(args.queries):
+                started = time.perf_counter()
+                result = query()
+                times.append((time.perf_counter() - started) * 1000)
+            p99 = percentile(times, 0.99)
+            worst = max(worst, p99)
+            print(f"{name:>30} {percentile(times, 0.5):6.2f} ms {p99:6.2f} ms  {len(result['events'])}")
+
+        heaviest = queries['newest 1000, kind=failure']
+        times, ran = record_under_queries(journal, heaviest, 2000, end_time + 1)
+        record_p99 = percentile(times, 0.99)
+        print(f"\nrecord() while querying: p50 {percentile(times, 0.5) * 1000:.1f} µs, "
+              f"p99 {record_p99 * 1000:.1f} µs, max {max(times) * 1000:.1f} µs ({ran} queries ran meanwhile)")
+        journal.close()
+    finally:
+        shutil.rmtree(directory)
+
+    failed = False
+    if worst > args.budget_ms:
+        print(f"FAIL: a query p99 is over {args.budget_ms:.0f} ms")
+        failed = True
+    if record_p99 > args.record_budget_ms:
+        print(f"FAIL: record() p99 under queries is over {args.record_budget_ms:g} ms")
+        failed = True
+    if failed:
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,155 @@
+"""Clamshell probe: parser speed, strategy selection, re-checks.
+
+The parser and selection correctness tests are in tests/test_clamshell.py;
+this times them at realistic sizes.
+
+1. Runs the old line-by-line parser and find_clamshell_state() over
+   synthetic ioreg dumps (--dump-mb of registry entries, from
+   fakemac.ioreg_fixtures()), whole and fed in random chunks as the
+   streaming strategy sees it, and times both.
+2. Serves those dumps from FakeMac's ioreg and lets ClamshellProbe.select()
+   pick a strategy: it must pick a correct one, and a faster one than the
+   full dump the old check_lid_state() read.
+3. Breaks the chosen strategy's output and checks that sampling switches to
+   another strategy, re-runs selection in the background and reads the lid
+   correctly again.
+
+    python benchmarks/bench_lid_probe.py [--dump-mb 2] [--rounds 5]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from clamshell import (ClamshellProbe, ClamshellScanner, default_strategies,  # noqa: E402
+                       find_clamshell_state)
+from fakemac import FakeMac, ioreg_dump, ioreg_fixtures  # noqa: E402
+
+
+def old_parse_clamshell_state(text):
+    """How the lid state was parsed before the clamshell module"""
+    for line in text.split('\n'):
+        if 'AppleClamshellState' in line:
+            line_lower = line.lower()
+            if '= yes' in line_lower or '= 1' in line_lower:
+                return True
+            elif '= no' in line_lower or '= 0' in line_lower:
+                return False
+    return None
+
+
+def chunked(data, rng):
+    scanner = ClamshellScanner()
+    position = 0
+    while position < len(data):
+        size = rng.choice((1, 7, 19, 4096, 65536))
+        answer = scanner.feed(data[position:position + size])
+        if answer is not None:
+            return answer
+        position += size
+    return scanner.finish()
+
+
+def timed(function, argument, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        function(argument)
+    return (time.perf_counter() - started) / repeat * 1e6
+
+
+def check_parsers(size):
+    rng = random.Random(1)
+    failures = 0
+    print(f"{'fixture':>22} {'expected':>8} {'old':>6} {'new':>6} {'chunks':>6} "
+          f"{'old µs':>9} {'new µs':>9}")
+    for name, text, expected in ioreg_fixtures(size):
+        data = text.encode()
+        old, new = old_parse_clamshell_state(text), find_clamshell_state(data)
+        streamed = [chunked(data, rng) for _ in range(20)]
+        ok = new == expected and all(answer == expected for answer in streamed)
+        failures += not ok
+        repeat = 20
+        print(f"{name:>22} {expected!s:>8} {old!s:>6} {new!s:>6} {streamed[0]!s:>6} "
+              f"{timed(old_parse_clamshell_state, text, repeat):9.0f} "
+              f"{timed(find_clamshell_state, data, repeat):9.0f}{'' if ok else '  WRONG'}")
+    return failures
+
+
+def serve_dumps(fake, size):
+    for closed, value in ((True, 'Yes'), (False, 'No')):
+        fake.set_ioreg_output(closed, ioreg_dump(value, size))
+        fake.set_ioreg_output(closed, ioreg_dump(value, size, depth1=True), depth1=True)
+
+
+def check_selection(size, rounds):
+    fake = FakeMac()
+    os.environ.update(fake.env())
+    serve_dumps(fake, size)
+    fake.set_lid(True)
+    # Only the ioreg strategies: on a real Mac, IOKit would read the real lid
+    strategies = [strategy for strategy in default_strategies() if not strategy.native]
+    probe = ClamshellProbe(strategies, rounds=rounds, timeout=2.0)
+    report = probe.select()
+    print(f"\n{'strategy':>14} {'correct':>8} {'median':>10} {'max':>10}  error")
+    for name, result in report['results'].items():
+        median = '-' if result['median_ms'] is None else f"{result['median_ms']:.1f} ms"
+        worst = '-' if result['max_ms'] is None else f"{result['max_ms']:.1f} ms"
+        print(f"{name:>14} {result['correct']!s:>8} {median:>10} {worst:>10}  {result['error'] or ''}")
+    chosen = report['strategy']
+    print(f"chosen: {chosen} (ranking {', '.join(report['ranking'])})")
+    failures = 0
+    if chosen is None or chosen == 'ioreg':
+        print("FAIL: expected a strategy faster than the full dump")
+        failures += 1
+
+    # Samples follow the lid
+    for closed in (False, True, False):
+        fake.set_lid(closed)
+        if probe.sample() != closed:
+            print(f"FAIL: sample with the lid {'closed' if closed else 'open'} was wrong")
+            failures += 1
+
+    # Break the chosen strategy: its output loses the key
+    if chosen is not None:
+        shallow = '-d' in probe.strategies[chosen].argv
+        for closed in (True, False):
+            fake.set_ioreg_output(closed, ioreg_dump(None, size, depth1=shallow), depth1=shallow)
+        for _ in range(probe.recheck_after):
+            probe.sample()
+        switched_to = probe.strategy().name
+        deadline = time.monotonic() + 30
+        while probe.selections < 2 and time.monotonic() < deadline:
+            time.sleep(0.05)
+        fake.set_lid(True)
+        closed = probe.sample()
+        report = probe.report()
+        print(f"\nafter breaking {chosen}: switched to {switched_to} at once, re-selected "
+              f"{report['strategy']} (rechecks {report['rechecks']}, selections {report['selections']}), "
+              f"lid closed -> {closed}")
+        if switched_to == chosen or report['strategy'] == chosen or closed is not True:
+            print("FAIL: did not recover from a broken strategy")
+            failures += 1
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--dump-mb', type=float, default=2.0)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+    size = int(args.dump_mb * 2**20)
+
+    failures = check_parsers(size)
+    failures += check_selection(size, args.rounds)
+    if failures:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
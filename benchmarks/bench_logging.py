@@ -0,0 +1,155 @@
+"""Lid-close-to-alarm latency with a fast log sink and a deliberately slow one.
+
+Runs the threaded Sentinel on the file lid source with the null audio
+backend, closes the lid --rounds times and measures the time from writing
+"closed" to the alarm_started event. Each write to the slow sink takes
+--sink-delay seconds and holds it, like a stdout pipe nobody is draining.
+A background thread logs the same warning every millisecond throughout,
+as a failing afplay would.
+
+Three runs: the queued pipeline with a fast sink, the queued pipeline with
+the slow sink, and the slow sink written on the calling thread, which is
+what print() did. Exits non-zero if the slow sink moves the queued
+pipeline's p99 by more than --budget-ms.
+
+    python benchmarks/bench_logging.py [--rounds 20] [--sink-delay 0.25] [--budget-ms 50]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+
+
+class SlowSink:
+    """A file-like sink where every write blocks for delay seconds"""
+
+    def __init__(self, delay):
+        self.delay = delay
+        self.lock = threading.Lock()
+        self.writes = 0
+
+    def write(self, text):
+        with self.lock:
+            time.sleep(self.delay)
+            self.writes += 1
+
+    def flush(self):
+        pass
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def wait_for(condition, timeout=10):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def run(sentinel, lid_path, rounds):
+    """(lid close to alarm latencies, arm to monitoring latencies), in ms"""
+    import events
+    latencies, arm_times = [], []
+    for _ in range(rounds):
+        with open(lid_path, 'a') as f:
+            f.write('open\n')
+        started = time.monotonic()
+        sentinel.arm()
+        if not wait_for(lambda: sentinel.state.state == 'armed'
+                        and sentinel.detector.detector.initialized):
+            sentinel.disarm()
+            continue
+        arm_times.append((time.monotonic() - started) * 1000)
+        last_id = sentinel.broadcaster.last_id
+        started = time.monotonic()
+        with open(lid_path, 'a') as f:
+            f.write('closed\n')
+        deadline = started + 10
+        while time.monotonic() < deadline:
+            pending = sentinel.broadcaster.wait(last_id, timeout=0.01)
+            if any(event.kind == events.ALARM_STARTED for event in pending):
+                latencies.append((time.monotonic() - started) * 1000)
+                break
+            if pending:
+                last_id = pending[-1].id
+        sentinel.disarm()
+        time.sleep(0.1)
+    return latencies, arm_times
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--sink-delay', type=float, default=0.25)
+    parser.add_argument('--budget-ms', type=float, default=50.0)
+    args = parser.parse_args()
+
+    lid_path = os.path.join(tempfile.mkdtemp(), 'lid')
+    open(lid_path, 'w').close()
+    os.environ['MACSENTINEL_LID_SOURCE'] = f'file:{lid_path}'
+    os.environ['MACSENTINEL_AUDIO'] = 'null'
+    os.environ['MACSENTINEL_POWER_LOG'] = 'off'
+
+    import logs
+    from sentinel import Sentinel
+
+    pipeline = logs.pipeline
+    pipeline.sink = open(os.devnull, 'w')
+
+    noisy = logs.get_logger('alarm')
+    stop_noise = threading.Event()
+
+    def noise():
+        while not stop_noise.wait(0.001):
+            noisy.warning('Alarm playback failed', error='no output device')
+
+    sentinel = Sentinel()
+    sentinel.audio_loaded.wait(5)
+    results = {}
+    runs = (('queued, fast sink', open(os.devnull, 'w'), False),
+            ('queued, slow sink', SlowSink(args.sink_delay), False),
+            ('print, slow sink', SlowSink(args.sink_delay), True))
+    for name, sink, sync in runs:
+        pipeline.flush(timeout=30)
+        pipeline.sink, pipeline.sync = sink, sync
+        before = pipeline.stats()
+        stop_noise.clear()
+        noise_thread = threading.Thread(target=noise, daemon=True)
+        noise_thread.start()
+        latencies, arm_times = run(sentinel, lid_path, args.rounds)
+        stop_noise.set()
+        noise_thread.join()
+        after = pipeline.stats()
+        results[name] = (latencies, arm_times, {key: after[key] - before[key]
+                                                for key in ('written', 'suppressed', 'dropped')})
+    pipeline.sink = open(os.devnull, 'w')
+    sentinel.cleanup()
+
+    print(f"{'':>18} {'p50':>9} {'p99':>9} {'max':>9} {'alarms':>7} {'arm p50':>9} "
+          f"{'written':>8} {'suppressed':>11} {'dropped':>8}")
+    for name, (latencies, arm_times, counts) in results.items():
+        if not latencies:
+            print(f"{name:>18} no alarm within 10 s")
+            continue
+        print(f"{name:>18} {percentile(latencies, 0.5):6.1f} ms {percentile(latencies, 0.99):6.1f} ms "
+              f"{max(latencies):6.1f} ms {len(latencies):>4}/{args.rounds:<2} "
+              f"{percentile(arm_times, 0.5):6.1f} ms {counts['written']:>8} "
+              f"{counts['suppressed']:>11} {counts['dropped']:>8}")
+
+    fast, slow = results['queued, fast sink'][0], results['queued, slow sink'][0]
+    if len(slow) < args.rounds or percentile(slow, 0.99) - percentile(fast, 0.99) > args.budget_ms:
+        print(f"FAIL: the slow sink moved detection latency by more than {args.budget_ms:.0f} ms")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""Cost of recording a metric on the hot path.
+
+Times Counter.inc() and Histogram.observe() from one and from several
+threads, next to a plain lock-protected counter for comparison.
+
+    python benchmarks/bench_metrics.py [--ops 200000] [--threads 4]
+"""
+import argparse
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from metrics import Counter, Histogram, Registry  # noqa: E402
+
+
+class LockedCounter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self):
+        with self._lock:
+            self.value += 1
+
+
+def run(record, ops, threads):
+    """Return ns per op with `threads` threads each recording ops times"""
+    def worker():
+        for _ in range(ops):
+            record()
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return (time.perf_counter() - started) / (ops * threads) * 1e9
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--ops', type=int, default=200000)
+    parser.add_argument('--threads', type=int, default=4)
+    args = parser.parse_args()
+
+    registry = Registry()
+    counter = Counter('bench_total', 'bench', registry=registry)
+    histogram = Histogram('bench_seconds', 'bench', registry=registry)
+    locked = LockedCounter()
+    cases = [
+        ('locked counter', locked.inc),
+        ('Counter.inc', counter.inc),
+        ('Histogram.observe', lambda: histogram.observe(0.003)),
+    ]
+    print(f"{'':>18} {'1 thread':>10} {f'{args.threads} threads':>11}")
+    for name, record in cases:
+        single = run(record, args.ops, 1)
+        multi = run(record, args.ops, args.threads)
+        print(f"{name:>18} {single:>7.0f} ns {multi:>8.0f} ns")
+
+    expected = args.ops * (1 + args.threads)
+    print(f"counts: locked {locked.value}, Counter {counter.value:.0f} (expected {expected})")
+
+
+if __name__ == '__main__':
+    main()
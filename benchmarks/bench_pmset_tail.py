@@ -0,0 +1,184 @@
+"""Benchmark pmset log reading against large synthetic logs.
+
+The polling sides run a stand-in for `pmset -g log` (`cat` of the synthetic
+log) through processes.run(), as the monitor does, so each poll pays for
+the fork and for reading the whole log:
+  - legacy: decode all of it, keep the last 50 lines, substring-test each
+    one (what the app did before pmset_log.py)
+  - tailer: PmsetCommandTailer: find the cursor in the raw bytes and
+    decode and classify only the entries after it
+The command's own cost (run) is also timed alone, so what is left of each
+poll is the parsing.
+
+  - stream: PowerLogStream, the source the monitor races by default, on a
+    stand-in for `log stream` (`tail -f` of the same log): the time from
+    appending the new entries to the close reaching its callback. It reads
+    only what was appended, so it must not grow with the log; exits
+    non-zero if the largest log's median is more than --flat-factor times
+    the smallest's (plus a millisecond of scheduling noise).
+
+    python benchmarks/bench_pmset_tail.py [--sizes-mb 1 10 100]
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from pmset_log import PmsetCommandTailer, PowerLogStream, classify_lines  # noqa: E402
+from process_manager import processes  # noqa: E402
+
+
+SAMPLE_LINES = [
+    "{stamp} Assertions          \tPID 412(WindowServer) Released PreventUserIdleDisplaySleep \"com.apple.iohideventsystem.queue.tickle\" 00:00:01  id:0x0xd000b1e5 [System: PrevIdle DeclUser kDisp]",
+    "{stamp} Sleep               \tEntering Sleep state due to 'Clamshell Sleep':TCPKeepAlive=active Using AC (Charge:100%) 21 secs",
+    "{stamp} DarkWake            \tDarkWake from Deep Idle [CDNP] : due to NUB.SPMI0.SW3 SMC.OutboxNotEmpty/HID Activity Using AC (Charge:100%) 45 secs",
+    "{stamp} Wake                \tWake from Deep Idle [CDNVA] : due to UserActivity Assertion/ Using AC (Charge:100%)",
+    "{stamp} Notification        \tDisplay is turned on",
+    "{stamp} Notification        \tDisplay is turned off",
+    "{stamp} Kernel Idle sleep preventers: IODisplayWrangler",
+    "{stamp} Assertions          \tPID 98(powerd) Summary PreventUserIdleSystemSleep \"Powerd - Prevent sleep while display is on\" 00:00:00  id:0x0x9000b1e6",
+]
+CLOSE_LINE = "{stamp} Sleep               \tClamshell closed - display sleep requested"
+
+
+def legacy_check(text):
+    """What the app's pmset polling used to do with the log text"""
+    lines = text.strip().split('\n')
+    recent = lines[-50:] if len(lines) > 50 else lines
+    for line in recent:
+        line_lower = line.lower()
+        if 'clamshell' in line_lower:
+            if any(k in line_lower for k in ['close', 'closed', 'closing']):
+                if 'open' not in line_lower and 'wake' not in line_lower:
+                    return True
+        if 'display' in line_lower and 'sleep' in line_lower:
+            if 'wake' not in line_lower and 'woke' not in line_lower and 'waking' not in line_lower:
+                return True
+        if 'lid' in line_lower and ('close' in line_lower or 'closed' in line_lower):
+            if 'open' not in line_lower and 'wake' not in line_lower:
+                return True
+    return False
+
+
+def stamp(i):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(1700000000 + i)) + ' +0000'
+
+
+def write_log(path, size_bytes):
+    rng = random.Random(size_bytes)
+    i = 0
+    with open(path, 'w') as f:
+        written = 0
+        while written < size_bytes:
+            chunk = '\n'.join(rng.choice(SAMPLE_LINES).format(stamp=stamp(i + k)) for k in range(1000)) + '\n'
+            f.write(chunk)
+            written += len(chunk)
+            i += 1000
+    return i
+
+
+def append(path, start, count):
+    with open(path, 'a') as f:
+        for k in range(count - 1):
+            f.write(SAMPLE_LINES[k % len(SAMPLE_LINES)].format(stamp=stamp(start + k)) + '\n')
+        f.write(CLOSE_LINE.format(stamp=stamp(start + count)) + '\n')
+
+
+def median_ms(times):
+    times = sorted(times)
+    return times[len(times) // 2] * 1000
+
+
+def bench(size_mb, rounds, new_lines):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'pmset.log')
+        next_index = write_log(path, int(size_mb * 1024 * 1024))
+        command = ['cat', path]
+        tailer = PmsetCommandTailer(command)
+        tailer.poll()  # sets the cursor at the current end
+        closes = []
+        arrived = threading.Event()
+
+        def on_event(sample):
+            if sample.event.kind == 'clamshell_close':
+                closes.append(time.perf_counter())
+                arrived.set()
+
+        stream = PowerLogStream(on_event, command=['tail', '-n', '0', '-f', path])
+        stream.start()
+        time.sleep(0.2)  # tail has opened the log and seeked to its end
+
+        run_times, legacy_times, tail_times, stream_times = [], [], [], []
+        for _ in range(rounds):
+            arrived.clear()
+            started = time.perf_counter()
+            append(path, next_index, new_lines)
+            next_index += new_lines
+            assert arrived.wait(5), 'the stream missed the close'
+            stream_times.append(closes[-1] - started)
+
+            started = time.perf_counter()
+            processes.run(command)
+            run_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            legacy_found = legacy_check(processes.run(command, text=True).stdout)
+            legacy_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            events = tailer.poll()
+            tail_times.append(time.perf_counter() - started)
+
+            assert legacy_found and any(e.kind == 'clamshell_close' for e in events)
+
+        stream.stop()
+        assert stream.lines == rounds * new_lines
+
+        # Classifier throughput on its own
+        lines = [SAMPLE_LINES[k % len(SAMPLE_LINES)].format(stamp=stamp(k)) for k in range(100000)]
+        started = time.perf_counter()
+        classify_lines(lines)
+        classify_rate = len(lines) / (time.perf_counter() - started)
+
+    return {
+        'size_mb': size_mb,
+        'run_median_ms': median_ms(run_times),
+        'legacy_median_ms': median_ms(legacy_times),
+        'tailer_median_ms': median_ms(tail_times),
+        'stream_median_ms': median_ms(stream_times),
+        'classify_lines_per_s': classify_rate,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--sizes-mb', type=float, nargs='+', default=[1, 10, 100])
+    parser.add_argument('--rounds', type=int, default=20)
+    parser.add_argument('--new-lines', type=int, default=50)
+    parser.add_argument('--flat-factor', type=float, default=2.0)
+    args = parser.parse_args()
+
+    print(f"{'log size':>10} {'run alone':>12} {'legacy poll':>13} {'tailer poll':>13} "
+          f"{'stream':>10} {'classify/s':>14}")
+    results = []
+    for size_mb in args.sizes_mb:
+        result = bench(size_mb, args.rounds, args.new_lines)
+        results.append(result)
+        print(f"{result['size_mb']:>8g}MB {result['run_median_ms']:>10.2f}ms "
+              f"{result['legacy_median_ms']:>11.2f}ms {result['tailer_median_ms']:>11.2f}ms "
+              f"{result['stream_median_ms']:>8.2f}ms {result['classify_lines_per_s']:>14,.0f}")
+
+    smallest, largest = results[0]['stream_median_ms'], results[-1]['stream_median_ms']
+    if largest > smallest * args.flat_factor + 1.0:
+        print(f"FAIL: the stream got slower with the log ({smallest:.2f} ms -> {largest:.2f} ms)")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
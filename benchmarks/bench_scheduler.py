@@ -0,0 +1,121 @@
+"""Simulate a night of armed monitoring: fixed polling vs. PollScheduler.
+
+Runs on a virtual clock, so hours of sampling take well under a second. The
+night is mostly quiet, with a few bursts of lid activity and a stretch where
+every ioreg call times out. Reports wakeups (total and worst minute) and the
+detection latency of each lid close.
+
+    python benchmarks/bench_scheduler.py [--hours 8] [--budget 120] [--max-latency-ms 1000]
+"""
+import argparse
+import os
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from scheduler import PollScheduler  # noqa: E402
+
+
+SAMPLE_COST = 0.03    # a typical ioreg fork
+TIMEOUT_COST = 0.5    # check_lid_state's ioreg timeout
+
+
+class SimClock:
+    """Virtual monotonic clock, set by the simulation"""
+
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class FixedInterval:
+    """The old power_monitor_loop: one sample every interval, no matter what"""
+
+    def __init__(self, interval):
+        self.interval = interval
+
+    def reset(self):
+        pass
+
+    def next_delay(self, changed=False, failed=False, cost=0.0):
+        return self.interval
+
+
+def make_night(hours, seed):
+    """Return (lid_changes, timeout_windows) as lists of times in seconds"""
+    rng = random.Random(seed)
+    end = hours * 3600
+    changes = []
+    for _ in range(max(1, int(hours / 2))):
+        # A burst: the lid is opened and closed a few times within a minute
+        start = rng.uniform(600, end - 600)
+        for i in range(rng.randint(2, 4) * 2):
+            changes.append(start + i * rng.uniform(2, 10))
+    timeouts = [(end * 0.4, end * 0.4 + 300)]  # 5 minutes of ioreg timeouts
+    return sorted(changes), timeouts
+
+
+def simulate(scheduler, clock, hours, changes, timeouts):
+    end = hours * 3600
+    now = clock.now = 0.0
+    scheduler.reset()
+    wakeups = []
+    latencies = []
+    closed = False
+    pending = list(changes)
+    seen_closed = False
+    while now < end:
+        wakeups.append(now)
+        while pending and pending[0] <= now:
+            changed_at = pending.pop(0)
+            closed = not closed
+            if closed:
+                close_at = changed_at
+        failed = any(start <= now < stop for start, stop in timeouts)
+        cost = TIMEOUT_COST if failed else SAMPLE_COST
+        changed = False
+        if not failed and closed != seen_closed:
+            changed = True
+            seen_closed = closed
+            if closed:
+                latencies.append(now - close_at)
+        clock.now = now + cost
+        now += cost + scheduler.next_delay(changed=changed, failed=failed, cost=cost)
+
+    per_minute = [0] * (int(end // 60) + 1)
+    for t in wakeups:
+        per_minute[int(t // 60)] += 1
+    return len(wakeups), max(per_minute), latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--hours', type=float, default=8)
+    parser.add_argument('--budget', type=float, default=120, help='wakeups per minute')
+    parser.add_argument('--max-latency-ms', type=float, default=1000)
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    changes, timeouts = make_night(args.hours, args.seed)
+    clock = SimClock()
+    adaptive = PollScheduler(min_interval=0.1, max_latency=args.max_latency_ms / 1000,
+                             wakeups_per_minute=args.budget, clock=clock)
+
+    print(f"{args.hours:g} h armed, {len(changes)} lid changes, "
+          f"budget {args.budget:g}/min, latency target {args.max_latency_ms:g} ms")
+    print(f"{'schedule':>18} {'wakeups':>9} {'worst min':>10} {'max latency':>12}")
+    for name, scheduler in (('fixed 0.5 s', FixedInterval(0.5)),
+                            ('fixed 0.1 s', FixedInterval(0.1)),
+                            ('adaptive', adaptive)):
+        total, worst_minute, latencies = simulate(scheduler, clock, args.hours, changes, timeouts)
+        print(f"{name:>18} {total:>9} {worst_minute:>10} {max(latencies) * 1000:>9.0f} ms")
+    stats = adaptive.stats()
+    print(f"adaptive: {stats['budget_delays']} budget delays, "
+          f"{stats['latency_misses']} gaps over the latency target")
+
+
+if __name__ == '__main__':
+    main()
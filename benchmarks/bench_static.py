@@ -0,0 +1,110 @@
+"""Bytes transferred loading the dashboard, first visit versus repeat visits.
+
+Runs app.py in-process with Flask's test client and loads the page the way a
+browser with an HTTP cache would: `/`, then every asset it links to. A first
+visit downloads everything (gzip-compressed where that helps). A repeat
+visit revalidates the page (304) and skips the fingerprinted assets, which
+are cached as immutable, so almost nothing is sent. For comparison it also
+reports what the old `no-cache, no-store` headers cost: every visit
+downloaded everything uncompressed. Finally it checks that the alarm sound
+answers Range requests with 206. Byte counts are response bodies; headers
+are not counted.
+
+    python benchmarks/bench_static.py [--visits 10]
+"""
+import argparse
+import os
+import re
+import sys
+import tempfile
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(HERE, '..'))
+
+ASSET_URL = re.compile(r'(?:href|src)="(/static/[^"]+)"')
+
+
+class BrowserCache:
+    """Just enough of an HTTP cache: stores responses, honours immutable, revalidates the rest"""
+
+    def __init__(self, client):
+        self.client = client
+        self.entries = {}  # url -> (etag, immutable?, body)
+
+    def get(self, url):
+        """(body, bytes sent over the wire) for url"""
+        cached = self.entries.get(url)
+        if cached is not None and cached[1]:
+            return cached[2], 0
+        headers = {'Accept-Encoding': 'gzip, deflate, br'}
+        if cached is not None and cached[0]:
+            headers['If-None-Match'] = f'"{cached[0]}"'
+        response = self.client.get(url, headers=headers)
+        sent = len(response.data)
+        if response.status_code == 304:
+            return cached[2], sent
+        etag, _ = response.get_etag()
+        immutable = response.cache_control.immutable
+        if not response.cache_control.no_store:
+            self.entries[url] = (etag, immutable, response.data)
+        return response.data, sent
+
+
+def visit(cache):
+    """(requests, bytes) for one load of the dashboard"""
+    page, total = cache.get('/')
+    requests = 1
+    for url in ASSET_URL.findall(page.decode()):
+        _, sent = cache.get(url)
+        total += sent
+        requests += 1
+    return requests, total
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--visits', type=int, default=10)
+    args = parser.parse_args()
+
+    os.environ['MACSENTINEL_AUDIO'] = 'null'
+    # Host our own engine, whatever else runs on this machine
+    os.environ['MACSENTINEL_RUN_DIR'] = tempfile.mkdtemp()
+
+    import app
+    app.start()
+    from flask import url_for
+    client = app.app.test_client()
+
+    page = client.get('/').data
+    plain = len(page) + sum(app.assets.lookup(url[len('/static/'):])[0].size
+                            for url in ASSET_URL.findall(page.decode()))
+
+    cache = BrowserCache(client)
+    requests, first = visit(cache)
+    repeats = [visit(cache)[1] for _ in range(args.visits)]
+
+    print(f"first visit:          {first:8d} bytes ({requests} requests)")
+    print(f"repeat visit:         {max(repeats):8d} bytes (max of {args.visits})")
+    print(f"no-store (before):    {plain:8d} bytes every visit, "
+          f"{plain * (args.visits + 1)} over {args.visits + 1} visits")
+    print(f"with caching:         {first + sum(repeats):8d} bytes over {args.visits + 1} visits")
+
+    print("\nassets:")
+    for name, info in app.assets.stats().items():
+        encodings = ', '.join(f'{encoding} {size}' for encoding, size in info['encodings'].items())
+        print(f"  {name:<20} {info['bytes']:8d} bytes  {encodings or 'served as is'}")
+
+    with app.app.test_request_context():
+        sound = url_for('static', filename='sounds/alarm.mp3')
+    response = client.get(sound, headers={'Range': 'bytes=0-65535'})
+    print(f"\nRange on {sound}: {response.status_code} {response.headers.get('Content-Range')}")
+    app.sentinel.cleanup()
+
+    if response.status_code != 206 or max(repeats) > 1024:
+        print("FAIL")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,207 @@
+"""Scriptable stand-ins for the macOS commands MacSentinel runs.
+
+FakeMac writes small sh scripts named ioreg, pmset, log, afplay, osascript,
+say, pgrep and system_profiler into a bin directory. Put that directory first on
+PATH (FakeMac.env() does it) and the app runs on a plain Linux box. The
+scripts are driven through files in a control directory:
+
+    fake.set_lid(True)                       # ioreg reports the lid closed
+    fake.set_ioreg_output(True, text)        # ...by printing text (add depth1=True for `-d 1`)
+    fake.append_power_log(lines)             # `log stream` prints these as they come
+    fake.set_delay('ioreg', 1.0)             # every ioreg call takes 1 s
+    fake.set_failure('afplay', 'no device')  # afplay exits 1 with that message
+    fake.clear('ioreg')                      # back to normal
+    fake.calls()                             # Counter of invocations per command
+
+ioreg_dump() builds realistic `ioreg -r -k AppleClamshellState` output of
+any size to serve that way; ioreg_fixtures() is a set of them with the
+answer each should parse to.
+
+Every invocation is appended to calls.log, so forks can be counted.
+"""
+import os
+import random
+import stat
+import tempfile
+from collections import Counter
+
+
+COMMANDS = ('ioreg', 'pmset', 'log', 'afplay', 'osascript', 'say', 'pgrep', 'system_profiler')
+
+# Uses shell builtins where it can, so a stand-in costs about one fork
+SCRIPT = r'''#!/bin/sh
+name=${0##*/}
+ctl="$MACSENTINEL_FAKE_DIR"
+echo "$name $*" >> "$ctl/calls.log"
+if [ -f "$ctl/$name.delay" ]; then
+    read delay < "$ctl/$name.delay"
+    sleep "$delay"
+fi
+if [ -f "$ctl/$name.fail" ]; then
+    read message < "$ctl/$name.fail"
+    echo "$message" >&2
+    exit 1
+fi
+case "$name" in
+    ioreg)
+        read lid < "$ctl/lid"
+        case " $* " in *" -d 1 "*) depth=shallow;; *) depth=full;; esac
+        [ -f "$ctl/ioreg.$depth.$lid" ] && exec cat "$ctl/ioreg.$depth.$lid"
+        if [ "$lid" = closed ]; then state=Yes; else state=No; fi
+        echo "+-o IOPMrootDomain  <class IOPMrootDomain>"
+        echo "    | |   \"AppleClamshellState\" = $state"
+        ;;
+    pmset)
+        [ -f "$ctl/pmset.log" ] && while IFS= read -r line; do echo "$line"; done < "$ctl/pmset.log"
+        ;;
+    log)
+        [ "$1" = stream ] || exit 0
+        : >> "$ctl/power.log"
+        exec tail -n 0 -F "$ctl/power.log" 2>/dev/null
+        ;;
+    afplay)
+        duration=1
+        [ -f "$ctl/afplay.duration" ] && read duration < "$ctl/afplay.duration"
+        exec sleep "$duration"
+        ;;
+    system_profiler)
+        echo "Audio:"
+        echo "    Devices:"
+        echo "        MacBook Pro Speakers:"
+        echo "          Default Output Device: Yes"
+        ;;
+    pgrep)
+        exit 1
+        ;;
+esac
+exit 0
+'''
+
+
+class FakeMac:
+    """A bin directory of fake macOS commands plus the files that script them"""
+
+    def __init__(self, root=None):
+        self.root = root or tempfile.mkdtemp(prefix='macsentinel-fake-')
+        self.bin_dir = os.path.join(self.root, 'bin')
+        self.control_dir = os.path.join(self.root, 'control')
+        os.makedirs(self.bin_dir, exist_ok=True)
+        os.makedirs(self.control_dir, exist_ok=True)
+        for command in COMMANDS:
+            path = os.path.join(self.bin_dir, command)
+            with open(path, 'w') as f:
+                f.write(SCRIPT)
+            os.chmod(path, os.stat(path).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+        self.set_lid(False)
+        self._write('calls.log', '')
+
+    def _write(self, name, text):
+        path = os.path.join(self.control_dir, name)
+        # Replace atomically, so a stand-in never reads a half-written file
+        with open(path + '.tmp', 'w') as f:
+            f.write(text)
+        os.replace(path + '.tmp', path)
+
+    def _remove(self, name):
+        try:
+            os.remove(os.path.join(self.control_dir, name))
+        except FileNotFoundError:
+            pass
+
+    def env(self, base=None):
+        """Environment with the stand-ins first on PATH"""
+        env = dict(os.environ if base is None else base)
+        env['PATH'] = self.bin_dir + os.pathsep + env.get('PATH', '')
+        env['MACSENTINEL_FAKE_DIR'] = self.control_dir
+        return env
+
+    def set_lid(self, closed):
+        self._write('lid', 'closed\n' if closed else 'open\n')
+
+    def set_ioreg_output(self, closed, text, depth1=False):
+        """Make ioreg print text when the lid is closed (or open), instead of two lines"""
+        self._write(f"ioreg.{'shallow' if depth1 else 'full'}.{'closed' if closed else 'open'}", text)
+
+    def set_delay(self, command, seconds):
+        self._write(f'{command}.delay', f'{seconds}\n')
+
+    def set_failure(self, command, message='failed'):
+        self._write(f'{command}.fail', message + '\n')
+
+    def set_afplay_duration(self, seconds):
+        self._write('afplay.duration', f'{seconds}\n')
+
+    def set_pmset_log(self, lines):
+        self._write('pmset.log', ''.join(line + '\n' for line in lines))
+
+    def append_power_log(self, lines):
+        """Log lines from powerd: a running `log stream` prints them"""
+        with open(os.path.join(self.control_dir, 'power.log'), 'a') as f:
+            f.write(''.join(line + '\n' for line in lines))
+
+    def clear(self, command):
+        """Remove any delay or failure set for command"""
+        self._remove(f'{command}.delay')
+        self._remove(f'{command}.fail')
+
+    def calls(self):
+        """Counter of invocations per command so far"""
+        counts = Counter()
+        with open(os.path.join(self.control_dir, 'calls.log')) as f:
+            for line in f:
+                counts[line.split(' ', 1)[0].strip()] += 1
+        return counts
+
+
+def _entry(name, depth, properties):
+    """One registry entry as ioreg prints it"""
+    indent = '  | ' * depth
+    lines = [f'{indent}+-o {name}  <class {name}, id 0x{random.getrandbits(40):x}, registered, '
+             f'matched, active, busy 0 (0 ms), retain {random.randint(5, 300)}>',
+             f'{indent}  {{']
+    lines += [f'{indent}    "{key}" = {value}' for key, value in properties]
+    lines += [f'{indent}  }}', f'{indent}  ']
+    return '\n'.join(lines) + '\n'
+
+
+def _filler(count):
+    return [(f'IOPMProperty{i:04d}', random.choice(('Yes', 'No', str(random.getrandbits(32)),
+                                                     f'<{random.getrandbits(128):032x}>')))
+            for i in range(count)]
+
+
+def ioreg_dump(value, size, position='top', depth1=False):
+    """Synthetic `ioreg -r -k AppleClamshellState` output of about size bytes
+
+    value is the text after `=`, or None to leave the key out. position:
+    'top' (where ioreg's sorted keys put it), 'late' (after a large
+    property), or 'decoy' (after "AppleClamshellStateChanged" = 1).
+    """
+    properties = [('AppleClamshellCausesSleep', 'Yes')]
+    if position == 'late':
+        properties.append(('IOPMSleepWakeLog', '<' + random.randbytes(size // 4).hex() + '>'))
+    if position == 'decoy':
+        properties.append(('AppleClamshellStateChanged', '1'))
+    if value is not None:
+        properties.append(('AppleClamshellState', value))
+    properties += _filler(60)
+    parts = [_entry('IOPMrootDomain', 0, properties)]
+    total = len(parts[0])
+    while not depth1 and total < size:
+        child = _entry(f'IOPowerConnection{len(parts)}', 1 + len(parts) % 4, _filler(20))
+        parts.append(child)
+        total += len(child)
+    return ''.join(parts)
+
+
+def ioreg_fixtures(size):
+    """(name, dump, expected answer)"""
+    return [
+        ('Yes, top', ioreg_dump('Yes', size), True),
+        ('No, top', ioreg_dump('No', size), False),
+        ('1, top', ioreg_dump('1', size), True),
+        ('0, top', ioreg_dump('0', size), False),
+        ('Yes, late', ioreg_dump('Yes', size, 'late'), True),
+        ('No, after a decoy key', ioreg_dump('No', size, 'decoy'), False),
+        ('key missing', ioreg_dump(None, size), None),
+    ]
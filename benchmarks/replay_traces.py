@@ -0,0 +1,333 @@
+"""Replay lid sample / pmset traces through the detector on a virtual clock.
+
+Feeds recorded or synthetic traces through detector.LidCloseDetector (the
+logic power_monitor_loop runs) as fast as the CPU allows, and reports
+accuracy and per-sample cost. Three detector configurations are compared:
+`lid` (ioreg samples only), `lid+pmset` (also trigger on every pmset line
+classified as a close) and `race` (RacingDetector, what the monitor runs:
+ioreg against trusted pmset events, deduplicated).
+
+Trace format, one record per line, time in seconds:
+
+    12.5 arm                  monitoring starts (detector reset)
+    13.0 lid open             an ioreg sample: closed | open | unknown
+    13.2 pmset <log line>     a pmset -g log line
+    40.1 truth closed         what really happened (synthetic/annotated
+                              traces); enables the accuracy numbers
+    99.0 disarm
+
+    python benchmarks/replay_traces.py synthesize --days 7 -o week.trace
+    python benchmarks/replay_traces.py replay week.trace [more.trace ...]
+    python benchmarks/replay_traces.py replay --synthetic-days 28
+    python benchmarks/replay_traces.py record -o mine.trace --seconds 3600
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from detector import (CLOSED, INITIALIZED, POWER_CLOSE, LidCloseDetector,  # noqa: E402
+                      RacingDetector)
+from pmset_log import classify_line  # noqa: E402
+
+
+ARM, DISARM, LID, PMSET, TRUTH = range(5)
+_LID_VALUES = {'closed': True, 'open': False, 'unknown': None}
+
+# pmset lines the generator sprinkles in
+CLAMSHELL_SLEEP = "{stamp} Sleep               \tEntering Sleep state due to 'Clamshell Sleep':TCPKeepAlive=active Using BATT (Charge:81%) 2 secs"
+WAKE = "{stamp} Wake                \tWake from Deep Idle [CDNVA] : due to UserActivity Assertion/ Using AC (Charge:100%)"
+# Routine assertion noise that mentions display + sleep while the lid is open
+DISPLAY_ASSERTION = "{stamp} Assertions          \tPID 412(WindowServer) Released PreventUserIdleDisplaySleep \"com.apple.iohideventsystem.queue.tickle\" 00:00:01  id:0x0xd000b1e5 [System: PrevIdle DeclUser kDisp]"
+IDLE_NOTICE = "{stamp} Notification        \tDisplay is turned off"
+
+
+def parse_trace(lines):
+    """Parse trace lines into (time, kind, value) tuples"""
+    records = []
+    append = records.append
+    for line in lines:
+        if not line.strip() or line.startswith('#'):
+            continue
+        stamp, kind, *rest = line.rstrip('\n').split(' ', 2)
+        t = float(stamp)
+        if kind == 'lid':
+            append((t, LID, _LID_VALUES[rest[0].strip()]))
+        elif kind == 'pmset':
+            append((t, PMSET, rest[0] if rest else ''))
+        elif kind == 'truth':
+            append((t, TRUTH, rest[0].strip() == 'closed'))
+        elif kind == 'arm':
+            append((t, ARM, None))
+        elif kind == 'disarm':
+            append((t, DISARM, None))
+    return records
+
+
+def format_record(t, kind, value):
+    if kind == LID:
+        return f"{t:.3f} lid {'unknown' if value is None else ('closed' if value else 'open')}"
+    if kind == PMSET:
+        return f"{t:.3f} pmset {value}"
+    if kind == TRUTH:
+        return f"{t:.3f} truth {'closed' if value else 'open'}"
+    return f"{t:.3f} {'arm' if kind == ARM else 'disarm'}"
+
+
+def _stamp(t):
+    return time.strftime('%Y-%m-%d %H:%M:%S +0000', time.gmtime(1700000000 + t))
+
+
+def synthesize(days, sample_interval=0.5, seed=1):
+    """Generate a trace: armed sessions, lid closes (some too short to see),
+    ioreg timeouts, arming with the lid already closed, and pmset noise"""
+    rng = random.Random(seed)
+    end = days * 86400
+    records = []
+    t = 0.0
+    closed = False
+    while t < end:
+        # Disarmed gap, during which the lid may move without anyone sampling
+        t += rng.uniform(600, 4 * 3600)
+        if rng.random() < 0.15:
+            closed = not closed
+            records.append((t - 1, TRUTH, closed))
+        session_end = min(end, t + rng.uniform(3600, 10 * 3600))
+        records.append((t, ARM, None))
+        next_change = t + rng.expovariate(1 / 5400)
+        if rng.random() < 0.05:
+            next_change = t + rng.uniform(0, 1.5)  # lid closed right as it arms
+        next_noise = t + rng.expovariate(1 / 1800)
+        sample_at = t + rng.uniform(0, sample_interval)
+        # ioreg sometimes times out for the first few samples after arming
+        timeout_until = t + rng.uniform(0.5, 3) if rng.random() < 0.1 else 0.0
+        while sample_at < session_end:
+            while next_change <= sample_at:
+                closed = not closed
+                records.append((next_change, TRUTH, closed))
+                if closed:
+                    records.append((next_change + rng.uniform(1, 3), PMSET,
+                                    CLAMSHELL_SLEEP.format(stamp=_stamp(next_change))))
+                    # Mostly minutes; sometimes a flick shorter than a sample
+                    duration = (rng.uniform(0.05, sample_interval * 0.8) if rng.random() < 0.05
+                                else rng.uniform(30, 3600))
+                else:
+                    records.append((next_change + rng.uniform(0.5, 2), PMSET,
+                                    WAKE.format(stamp=_stamp(next_change))))
+                    duration = rng.expovariate(1 / 5400)
+                next_change += duration
+            while next_noise <= sample_at:
+                line = DISPLAY_ASSERTION if rng.random() < 0.5 else IDLE_NOTICE
+                records.append((next_noise, PMSET, line.format(stamp=_stamp(next_noise))))
+                next_noise += rng.expovariate(1 / 1800)
+            if timeout_until < sample_at and rng.random() < 0.0002:
+                timeout_until = sample_at + rng.uniform(2, 30)  # a stretch of ioreg timeouts
+            if sample_at < timeout_until or rng.random() < 0.005:
+                records.append((sample_at, LID, None))
+            else:
+                records.append((sample_at, LID, closed))
+            sample_at += sample_interval
+        records.append((session_end, DISARM, None))
+        t = session_end
+    records.sort(key=lambda record: record[0])
+    return records
+
+
+def _detector(mode):
+    """(detector, observe_lid(closed, t), observe_power(line, t)) for a mode"""
+    if mode == 'race':
+        detector = RacingDetector(sensor='lid')
+
+        def observe_power(line, t):
+            event = classify_line(line)
+            return detector.observe_power_event(event, t) if event is not None else None
+        return detector, detector.observe_lid, observe_power
+    detector = LidCloseDetector(use_power_log=mode == 'lid+pmset')
+    observe_power_line = detector.observe_power_line
+    return (detector, lambda closed, t: detector.observe_lid(closed),
+            lambda line, t: observe_power_line(line))
+
+
+def replay(records, mode):
+    """Run records through a detector ('lid', 'lid+pmset' or 'race');
+    returns (stats dict, seconds spent)"""
+    detector, observe_lid, observe_power = _detector(mode)
+    has_truth = False
+    armed = False
+    pending_close = None   # time of a real close not yet detected
+    missed_at = None       # when the last undetected close reopened
+    late = 0
+    latencies = []
+    triggers = 0
+    samples = 0
+    missed = 0
+    missed_before_init = 0
+    closed_at_arm = 0
+    unknown_before_init = 0
+    false_triggers = Counter()
+
+    started = time.perf_counter()
+    for t, kind, value in records:
+        if kind == LID:
+            if not armed:
+                continue
+            samples += 1
+            decision = observe_lid(value, t)
+            if decision is None:
+                if value is None and not detector.initialized:
+                    unknown_before_init += 1
+                continue
+            if decision == INITIALIZED:
+                if value:
+                    closed_at_arm += 1
+                    if pending_close is not None:
+                        # Closed after arming but before the first good sample
+                        missed_before_init += 1
+                        pending_close = None
+                continue
+            if decision != CLOSED:
+                continue
+            cause = 'lid'
+        elif kind == PMSET:
+            if not armed or observe_power(value, t) != POWER_CLOSE:
+                continue
+            cause = classify_line(value).kind
+        elif kind == TRUTH:
+            has_truth = True
+            if value:
+                pending_close = t if armed else None
+            elif pending_close is not None:
+                # Reopened before anything noticed it was closed
+                missed += 1
+                missed_at = t
+                pending_close = None
+            continue
+        elif kind == ARM:
+            detector.reset()
+            armed = True
+            continue
+        else:
+            if pending_close is not None:
+                missed += 1
+                pending_close = None
+            armed = False
+            continue
+
+        triggers += 1
+        if pending_close is not None:
+            latencies.append(t - pending_close)
+            pending_close = None
+        elif missed_at is not None and t - missed_at < 10:
+            # A close too short for the sensor, reported late by pmset
+            late += 1
+            missed_at = None
+        elif has_truth:
+            false_triggers[cause] += 1
+    elapsed = time.perf_counter() - started
+
+    stats = {'records': len(records), 'lid_samples': samples, 'triggers': triggers,
+             'closed_at_arm': closed_at_arm, 'unknown_before_init': unknown_before_init}
+    if has_truth:
+        latencies.sort()
+        stats.update({
+            'detected': len(latencies),
+            'missed': missed,
+            'late_detections': late,
+            'missed_before_init': missed_before_init,
+            'false_triggers': dict(false_triggers),
+            'latency_p50_ms': latencies[len(latencies) // 2] * 1000 if latencies else None,
+            'latency_max_ms': latencies[-1] * 1000 if latencies else None,
+        })
+    if mode == 'race':
+        stats['race'] = detector.stats()
+    return stats, elapsed
+
+
+def report(name, records):
+    print(f"{name}: {len(records)} records, "
+          f"{(records[-1][0] - records[0][0]) / 86400 if records else 0:.1f} days")
+    for label in ('lid', 'lid+pmset', 'race'):
+        stats, elapsed = replay(records, label)
+        rate = len(records) / elapsed if elapsed else float('inf')
+        print(f"  {label:>9}: {elapsed:6.2f} s, {rate / 1e6:5.2f} M records/s, "
+              f"{elapsed / max(1, len(records)) * 1e9:5.0f} ns/record")
+        for key, value in stats.items():
+            if isinstance(value, float):
+                value = f"{value:.1f}"
+            print(f"  {'':>9}  {key}: {value}")
+
+
+def record(path, seconds, interval):
+    """Capture a real trace from this machine's lid sensor and pmset log"""
+    from lid_sensor import create_lid_source
+    from pmset_log import PmsetCommandTailer
+
+    source = create_lid_source()
+    tailer = PmsetCommandTailer()
+    tailer.poll()  # skip the existing log
+    started = time.monotonic()
+    next_pmset = started
+    with open(path, 'w') as f:
+        f.write(f"# recorded with the {source.name} lid sensor\n")
+        f.write(format_record(0.0, ARM, None) + '\n')
+        while time.monotonic() - started < seconds:
+            now = time.monotonic()
+            f.write(format_record(now - started, LID, source.sample()) + '\n')
+            if now >= next_pmset:
+                for event in tailer.poll():
+                    f.write(format_record(now - started, PMSET, event.line) + '\n')
+                next_pmset = now + 5
+            time.sleep(interval)
+        f.write(format_record(time.monotonic() - started, DISARM, None) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    synth = commands.add_parser('synthesize', help='write a synthetic trace')
+    synth.add_argument('--days', type=float, default=7)
+    synth.add_argument('--interval', type=float, default=0.5, help='ioreg sample interval')
+    synth.add_argument('--seed', type=int, default=1)
+    synth.add_argument('-o', '--output', required=True)
+
+    play = commands.add_parser('replay', help='replay traces through the detector')
+    play.add_argument('traces', nargs='*')
+    play.add_argument('--synthetic-days', type=float,
+                      help='replay a synthetic trace generated in memory')
+    play.add_argument('--seed', type=int, default=1)
+
+    rec = commands.add_parser('record', help='capture a trace on a Mac')
+    rec.add_argument('-o', '--output', required=True)
+    rec.add_argument('--seconds', type=float, default=3600)
+    rec.add_argument('--interval', type=float, default=0.5)
+
+    args = parser.parse_args()
+    if args.command == 'synthesize':
+        records = synthesize(args.days, args.interval, args.seed)
+        with open(args.output, 'w') as f:
+            for t, kind, value in records:
+                f.write(format_record(t, kind, value) + '\n')
+        print(f"Wrote {len(records)} records to {args.output}")
+    elif args.command == 'record':
+        record(args.output, args.seconds, args.interval)
+    else:
+        if not args.traces and not args.synthetic_days:
+            parser.error('give trace files or --synthetic-days')
+        if args.synthetic_days:
+            report(f'synthetic ({args.synthetic_days:g} days)',
+                   synthesize(args.synthetic_days, seed=args.seed))
+        for path in args.traces:
+            with open(path) as f:
+                started = time.perf_counter()
+                records = parse_trace(f)
+            print(f"Parsed {path} in {time.perf_counter() - started:.2f} s")
+            report(path, records)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,334 @@
+"""What this Mac can do, probed once in the background and cached.
+
+Each probe answers one question - which commands are on PATH, whether the
+IOKit lid sensor loads, which way of reading the lid is fastest
+(clamshell.py), whether ioreg, `pmset -g log` and `log` on powerd work
+and how long they take, whether osascript can read the volume, which
+audio outputs system_profiler lists - and the registry keeps the answer
+with a TTL.
+
+Nothing here blocks: get() returns whatever is cached (None until the
+first probe finishes) and queues a re-probe on one background thread when
+the answer is older than its TTL or its fingerprint changed. The audio
+fingerprint is the set of files coreaudiod keeps under
+/Library/Preferences/Audio, which it rewrites when a new output device
+appears, so plugging in headphones invalidates the cached device list
+without running system_profiler on a timer. Callers that see a device
+misbehave (a failed alarm playback) call invalidate() as well.
+
+Arming reads the cache and runs no probes of its own.
+"""
+import os
+import threading
+import time
+from collections import namedtuple
+
+import metrics
+from clamshell import clamshell
+from lid_sensor import IOKitLidSource
+from pmset_log import POWER_LOG_PREDICATE
+from process_manager import ProbeInterrupted, processes
+
+
+COMMANDS = ('ioreg', 'pmset', 'log', 'afplay', 'osascript', 'say', 'pgrep', 'system_profiler')
+
+# coreaudiod rewrites its device settings here when an output appears
+AUDIO_PREFERENCES = '/Library/Preferences/Audio'
+
+# Device names that usually mean an output other than the built-in speakers
+EXTERNAL_KEYWORDS = ('bluetooth', 'usb', 'airpods', 'headphones', 'speaker')
+
+PROBE_SECONDS = metrics.Histogram('macsentinel_capability_probe_seconds',
+                                  'Time to run each capability probe', ['capability'],
+                                  buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0))
+
+# run() returns (ok, detail); fingerprint() must be cheap - get() calls it every time
+Probe = namedtuple('Probe', 'name run ttl fingerprint')
+Capability = namedtuple('Capability', 'name ok detail seconds checked_at fingerprint')
+
+
+def run_probe_command(argv, timeout):
+    """processes.run, but a signal from teardown is not an answer"""
+    result = processes.run(argv, text=True, timeout=timeout)
+    if result.returncode < 0:
+        raise ProbeInterrupted(f'{argv[0]} killed by signal {-result.returncode}')
+    return result
+
+
+def parse_audio_devices(text):
+    """Devices from `system_profiler SPAudioDataType` text output"""
+    devices = []
+    device = None
+    in_devices = False
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line:
+            continue
+        if line == 'Devices:':
+            in_devices = True
+            continue
+        if not in_devices:
+            continue
+        if line.endswith(':') and ': ' not in line:
+            device = {'name': line[:-1], 'properties': {}}
+            devices.append(device)
+        elif device is not None and ': ' in line:
+            key, value = line.split(': ', 1)
+            device['properties'][key] = value
+    return devices
+
+
+def describe_audio_device(device):
+    """Summary of one parsed device: is it an output, the default one, external?"""
+    properties = device['properties']
+    name = device['name']
+    transport = properties.get('Transport', '')
+    if transport:
+        external = transport.lower() not in ('built-in', 'builtin', 'virtual')
+    else:
+        lowered = name.lower()
+        external = (any(keyword in lowered for keyword in EXTERNAL_KEYWORDS)
+                    and 'macbook' not in lowered and 'built-in' not in lowered)
+    return {
+        'name': name,
+        'output': 'Output Channels' in properties or 'Default Output Device' in properties,
+        'default_output': properties.get('Default Output Device') == 'Yes',
+        'transport': transport or None,
+        'external': external,
+    }
+
+
+def probe_commands():
+    import shutil  # Only on the probe thread (see alarm.AfplayBackend)
+    paths = {command: shutil.which(command) for command in COMMANDS}
+    missing = sorted(command for command, path in paths.items() if path is None)
+    return not missing, {'paths': paths, 'missing': missing}
+
+
+def probe_iokit():
+    source = IOKitLidSource()
+    closed = source.sample()
+    return closed is not None, {'lid_closed': closed}
+
+
+def probe_ioreg():
+    """Benchmark the lid strategies and pick the fastest that reads the lid right"""
+    report = clamshell.select()
+    results = report['results']
+    ok = any(results[name]['correct'] for name in results if not clamshell.strategies[name].native)
+    return ok, report
+
+
+def probe_pmset_log():
+    result = run_probe_command(['pmset', '-g', 'log'], timeout=10)
+    if result.returncode != 0:
+        return False, {'returncode': result.returncode, 'error': (result.stderr or '').strip()[:200]}
+    return True, {'bytes': len(result.stdout), 'lines': result.stdout.count('\n')}
+
+
+def probe_power_log():
+    """Can `log` read powerd's messages? The monitor streams them while armed"""
+    result = run_probe_command(['log', 'show', '--last', '1m', '--style', 'syslog',
+                                '--predicate', POWER_LOG_PREDICATE], timeout=15)
+    if result.returncode != 0:
+        return False, {'returncode': result.returncode, 'error': (result.stderr or '').strip()[:200]}
+    return True, {'lines': result.stdout.count('\n')}
+
+
+def probe_osascript():
+    result = run_probe_command(['osascript', '-e', 'output volume of (get volume settings)'],
+                               timeout=3)
+    if result.returncode != 0:
+        return False, {'returncode': result.returncode, 'error': (result.stderr or '').strip()[:200]}
+    return True, {'volume': result.stdout.strip()}
+
+
+def probe_audio_outputs():
+    result = run_probe_command(['system_profiler', 'SPAudioDataType'], timeout=15)
+    if result.returncode != 0:
+        return False, {'returncode': result.returncode, 'error': (result.stderr or '').strip()[:200]}
+    devices = [describe_audio_device(device) for device in parse_audio_devices(result.stdout)]
+    outputs = [device for device in devices if device['output']]
+    default = next((device['name'] for device in outputs if device['default_output']), None)
+    return bool(outputs), {
+        'outputs': outputs,
+        'default_output': default,
+        'external': any(device['external'] for device in outputs),
+    }
+
+
+def path_fingerprint():
+    return os.environ.get('PATH', '')
+
+
+def audio_fingerprint():
+    """Names and mtimes of coreaudiod's settings files; () off macOS"""
+    try:
+        with os.scandir(AUDIO_PREFERENCES) as entries:
+            return tuple(sorted((entry.name, entry.stat().st_mtime) for entry in entries))
+    except OSError:
+        return ()
+
+
+# Cheapest first, so the answers arming needs arrive before system_profiler's
+PROBES = (
+    Probe('commands', probe_commands, 600.0, path_fingerprint),
+    Probe('iokit', probe_iokit, None, None),
+    Probe('ioreg', probe_ioreg, 600.0, path_fingerprint),
+    Probe('osascript', probe_osascript, 600.0, path_fingerprint),
+    Probe('pmset_log', probe_pmset_log, 600.0, path_fingerprint),
+    Probe('power_log', probe_power_log, 600.0, path_fingerprint),
+    Probe('audio_outputs', probe_audio_outputs, 300.0, audio_fingerprint),
+)
+
+
+class CapabilityRegistry:
+    """Cached probe results, refreshed on one background thread
+
+    Probes only run after start(); until then get() just returns what is
+    cached, so importing the registry never spawns anything.
+    """
+
+    def __init__(self, probes=PROBES, clock=time.monotonic):
+        self.probes = {probe.name: probe for probe in probes}
+        self.clock = clock
+        self.probe_runs = 0
+        self._results = {}
+        self._pending = []
+        self._probing = None
+        self._started = False
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        """Probe everything once in the background; safe to call twice"""
+        with self._condition:
+            if self._started:
+                return
+            self._started = True
+            for name in self.probes:
+                self._queue(name)
+            self._thread = threading.Thread(target=self._run, name='capabilities', daemon=True)
+            self._thread.start()
+
+    def _queue(self, name, again=False):
+        # Caller holds the condition. A probe already running counts as
+        # queued, unless its answer is known to be out of date (again)
+        if name not in self._pending and (again or name != self._probing):
+            self._pending.append(name)
+            self._condition.notify_all()
+
+    def refresh(self, *names):
+        """Re-probe names (all if none) in the background, keeping the cached answers meanwhile"""
+        with self._condition:
+            for name in names or self.probes:
+                self._queue(name)
+
+    def invalidate(self, *names):
+        """Drop cached answers for names (all if none) and re-probe them"""
+        with self._condition:
+            for name in names or self.probes:
+                self._results.pop(name, None)
+                self._queue(name, again=True)
+
+    def _stale(self, probe, result):
+        if probe.ttl is not None and self.clock() - result.checked_at > probe.ttl:
+            return True
+        return probe.fingerprint is not None and probe.fingerprint() != result.fingerprint
+
+    def get(self, name):
+        """The cached Capability for name, or None; never blocks on a probe"""
+        probe = self.probes[name]
+        with self._condition:
+            result = self._results.get(name)
+            if result is None or self._stale(probe, result):
+                self._queue(name)
+            return result
+
+    def usable(self, name):
+        """True or False once probed, None while unknown"""
+        result = self.get(name)
+        return None if result is None else result.ok
+
+    def preferred_lid_source(self):
+        """A MACSENTINEL_LID_SOURCE spec from the probes, or None to let create_lid_source decide"""
+        if self.usable('iokit'):
+            return 'iokit'
+        if self.usable('iokit') is False and self.usable('ioreg'):
+            return 'ioreg'
+        return None
+
+    def wait(self, timeout=None):
+        """Block until no probe is queued or running; True if that happened in time"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while self._pending or self._probing is not None:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _probe(self, probe):
+        started = time.perf_counter()
+        try:
+            ok, detail = probe.run()
+        except ProbeInterrupted:
+            raise
+        except Exception as e:
+            ok, detail = False, {'error': f'{type(e).__name__}: {e}'}
+        seconds = time.perf_counter() - started
+        PROBE_SECONDS.labels(capability=probe.name).observe(seconds)
+        fingerprint = probe.fingerprint() if probe.fingerprint is not None else None
+        return Capability(probe.name, ok, detail, seconds, self.clock(), fingerprint)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                name = self._probing = self._pending.pop(0)
+            try:
+                result = self._probe(self.probes[name])
+            except ProbeInterrupted:
+                result = None
+            with self._condition:
+                self._probing = None
+                if result is None:
+                    # Try again once whatever killed it is done
+                    self._queue(name)
+                else:
+                    self._results[name] = result
+                    self.probe_runs += 1
+                self._condition.notify_all()
+            if result is None:
+                time.sleep(0.5)
+
+    def snapshot(self):
+        """Everything cached, for /api/capabilities"""
+        now = self.clock()
+        capabilities = {}
+        for name in self.probes:
+            result = self.get(name)
+            if result is None:
+                capabilities[name] = {'ok': None, 'probed': False}
+                continue
+            capabilities[name] = {
+                'ok': result.ok,
+                'probed': True,
+                'detail': result.detail,
+                'probe_ms': result.seconds * 1000,
+                'age_seconds': now - result.checked_at,
+            }
+        with self._condition:
+            pending = list(self._pending)
+            probing = self._probing
+        return {
+            'capabilities': capabilities,
+            'probing': probing,
+            'pending': pending,
+            'probe_runs': self.probe_runs,
+        }
+
+
+capabilities = CapabilityRegistry()
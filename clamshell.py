@@ -0,0 +1,373 @@
+"""Reading AppleClamshellState, by whichever strategy is fastest on this Mac.
+
+Strategies:
+  - iokit: IORegistryEntryCreateCFProperty on IOPMrootDomain, in-process
+    (macOS only; no fork)
+  - ioreg-stream: `ioreg -r -k AppleClamshellState`, reading its output as
+    it arrives and killing ioreg as soon as the key has gone past, before
+    it dumps the rest of the subtree
+  - ioreg-narrow: `ioreg -r -d 1 -k AppleClamshellState`, only the
+    matching entries and no children
+  - ioreg-class: `ioreg -r -d 1 -c IOPMrootDomain`, matching on the class
+    name instead of searching every entry for the key
+  - ioreg: the original full subtree dump; the fallback until a selection
+    has run
+
+Every strategy parses with find_clamshell_state(), which scans bytes for
+the exact key and reads only the value after it.
+
+ClamshellProbe.select() microbenchmarks every strategy a few times,
+interleaved, and ranks those whose answers all agree with the consensus,
+fastest first. sample() uses the winner. A strategy that returns nothing
+(a timeout, unparsable output) `recheck_after` times in a row is dropped
+from the ranking, so the next one takes over, and selection runs again in
+the background. The ioreg fallback used while nothing is ranked counts its
+failures the same way, re-checking less often each time a selection still
+finds nothing that works. A helper killed by a signal from outside is no
+answer either way: it neither counts as a failure nor marks a strategy
+wrong, and select() raises ProbeInterrupted instead of ranking. The
+capability probes (capabilities.py) run the first selection at startup.
+"""
+import subprocess
+import threading
+import time
+from collections import Counter
+
+from logs import get_logger
+import metrics
+from process_manager import ProbeInterrupted, processes
+
+
+log = get_logger('clamshell')
+
+
+KEY = b'AppleClamshellState'
+TRUE_VALUES = (b'yes', b'1', b'true')
+FALSE_VALUES = (b'no', b'0', b'false')
+
+IOREG_SECONDS = metrics.Histogram('macsentinel_ioreg_duration_seconds',
+                                  'Time taken by one ioreg lid sample')
+IOREG_TIMEOUTS = metrics.Counter('macsentinel_ioreg_timeouts_total',
+                                 'ioreg lid samples that hit the timeout')
+
+
+def _value(data, start, end):
+    """True/False for the ` = Yes` after a key at data[start:end], None if it isn't one"""
+    rest = data[start:end].lstrip(b'" \t')
+    if not rest.startswith(b'='):
+        return None
+    token = rest[1:].split(None, 1)
+    if not token:
+        return None
+    token = token[0].lower()
+    if token in TRUE_VALUES:
+        return True
+    if token in FALSE_VALUES:
+        return False
+    return None
+
+
+def _scan(data, final):
+    """(answer, resume) for data: answer True/False/None, resume where to carry on from
+
+    resume is None once answered; otherwise the offset of the first byte a
+    later chunk might still need (a key cut off, or a value not yet ended).
+    """
+    start = 0
+    while True:
+        found = data.find(KEY, start)
+        if found == -1:
+            return None, max(start, len(data) - len(KEY) + 1)
+        after = found + len(KEY)
+        if after < len(data) and (data[after:after + 1].isalnum() or data[after:after + 1] == b'_'):
+            start = after  # A longer key that starts the same
+            continue
+        end = data.find(b'\n', after)
+        if end == -1:
+            if not final:
+                return None, found
+            end = len(data)
+        answer = _value(data, after, end)
+        if answer is not None:
+            return answer, None
+        start = end
+
+
+def find_clamshell_state(data):
+    """AppleClamshellState from ioreg output (bytes or str): True = closed, None if not found"""
+    if isinstance(data, str):
+        data = data.encode('utf-8', 'replace')
+    return _scan(data, final=True)[0]
+
+
+class ClamshellScanner:
+    """find_clamshell_state() over output that arrives in chunks"""
+
+    def __init__(self):
+        self._pending = b''
+
+    def feed(self, chunk):
+        """The answer once it has been seen, else None"""
+        data = self._pending + chunk if self._pending else chunk
+        answer, resume = _scan(data, final=False)
+        if answer is None:
+            self._pending = data[resume:]
+        return answer
+
+    def finish(self):
+        return _scan(self._pending, final=True)[0]
+
+
+class IOKitClamshell:
+    """Reads AppleClamshellState from IOPMrootDomain through IOKit"""
+
+    _UTF8 = 0x08000100  # kCFStringEncodingUTF8
+
+    def __init__(self):
+        self._iokit, self._cf = self._load()
+        self._service = self._iokit.IOServiceGetMatchingService(
+            0, self._iokit.IOServiceMatching(b'IOPMrootDomain'))
+        if not self._service:
+            raise OSError('IOPMrootDomain not found')
+        self._key = self._cf.CFStringCreateWithCString(None, KEY, self._UTF8)
+        self._bool_type = self._cf.CFBooleanGetTypeID()
+
+    @staticmethod
+    def _load():
+        # Imported here: ctypes.util alone costs more than the rest of this module
+        import ctypes
+        import ctypes.util
+        iokit_path = ctypes.util.find_library('IOKit')
+        cf_path = ctypes.util.find_library('CoreFoundation')
+        if not iokit_path or not cf_path:
+            raise OSError('IOKit is not available')
+        iokit = ctypes.cdll.LoadLibrary(iokit_path)
+        cf = ctypes.cdll.LoadLibrary(cf_path)
+        iokit.IOServiceMatching.restype = ctypes.c_void_p
+        iokit.IOServiceMatching.argtypes = [ctypes.c_char_p]
+        iokit.IOServiceGetMatchingService.restype = ctypes.c_uint32
+        iokit.IOServiceGetMatchingService.argtypes = [ctypes.c_uint32, ctypes.c_void_p]
+        iokit.IORegistryEntryCreateCFProperty.restype = ctypes.c_void_p
+        iokit.IORegistryEntryCreateCFProperty.argtypes = [
+            ctypes.c_uint32, ctypes.c_void_p, ctypes.c_void_p, ctypes.c_uint32]
+        cf.CFStringCreateWithCString.restype = ctypes.c_void_p
+        cf.CFStringCreateWithCString.argtypes = [ctypes.c_void_p, ctypes.c_char_p, ctypes.c_uint32]
+        cf.CFGetTypeID.restype = ctypes.c_ulong
+        cf.CFGetTypeID.argtypes = [ctypes.c_void_p]
+        cf.CFBooleanGetTypeID.restype = ctypes.c_ulong
+        cf.CFBooleanGetValue.restype = ctypes.c_bool
+        cf.CFBooleanGetValue.argtypes = [ctypes.c_void_p]
+        cf.CFRelease.argtypes = [ctypes.c_void_p]
+        return iokit, cf
+
+    def read(self):
+        value = self._iokit.IORegistryEntryCreateCFProperty(self._service, self._key, None, 0)
+        if not value:
+            return None
+        try:
+            if self._cf.CFGetTypeID(value) != self._bool_type:
+                return None
+            return bool(self._cf.CFBooleanGetValue(value))
+        finally:
+            self._cf.CFRelease(value)
+
+
+class IOKitStrategy:
+    name = 'iokit'
+    native = True
+    stream = False
+    argv = None
+
+    def __init__(self):
+        self._reader = None
+
+    def sample(self, timeout):
+        if self._reader is None:
+            self._reader = IOKitClamshell()
+        return self._reader.read()
+
+
+class IoregStrategy:
+    native = False
+
+    def __init__(self, name, argv, stream=False):
+        self.name = name
+        self.argv = argv
+        self.stream = stream
+
+    def sample(self, timeout):
+        """Raises subprocess.TimeoutExpired if ioreg takes longer than timeout,
+        ProbeInterrupted if something else killed it"""
+        if self.stream:
+            closed, returncode = processes.run_until(self.argv, ClamshellScanner(), timeout=timeout)
+        else:
+            result = processes.run(self.argv, timeout=timeout)
+            returncode = result.returncode
+            closed = find_clamshell_state(result.stdout) if returncode == 0 else None
+        if returncode is not None and returncode < 0:
+            raise ProbeInterrupted(f'{self.argv[0]} killed by signal {-returncode}')
+        return closed
+
+
+BASELINE = 'ioreg'
+
+
+def default_strategies():
+    return [
+        IOKitStrategy(),
+        IoregStrategy('ioreg-stream', ['ioreg', '-r', '-k', 'AppleClamshellState'], stream=True),
+        IoregStrategy('ioreg-narrow', ['ioreg', '-r', '-d', '1', '-k', 'AppleClamshellState']),
+        IoregStrategy('ioreg-class', ['ioreg', '-r', '-d', '1', '-c', 'IOPMrootDomain']),
+        IoregStrategy(BASELINE, ['ioreg', '-r', '-k', 'AppleClamshellState']),
+    ]
+
+
+class ClamshellProbe:
+    """Picks the fastest strategy that reads the lid correctly, and re-picks when it fails"""
+
+    def __init__(self, strategies=None, rounds=3, timeout=0.5, recheck_after=3, clock=time.perf_counter):
+        self.strategies = {s.name: s for s in (strategies or default_strategies())}
+        self.rounds = rounds
+        self.timeout = timeout
+        self.recheck_after = recheck_after
+        self.clock = clock
+        self.ranking = []  # Names of the strategies that proved correct, fastest first
+        self.results = {}
+        self.selections = 0
+        self.rechecks = 0
+        self._failures = 0
+        self._recheck_at = recheck_after
+        self._lock = threading.Lock()
+        self._selecting = threading.Lock()
+
+    def select(self):
+        """Benchmark every strategy and rank the correct ones; returns the report
+
+        Raises ProbeInterrupted, keeping the current ranking, if a helper
+        was killed from outside: its answer says nothing about the strategy.
+        """
+        with self._selecting:
+            answers = {name: [] for name in self.strategies}
+            costs = {name: [] for name in self.strategies}
+            errors = {}
+            for _ in range(self.rounds):
+                # Interleaved, so a busy moment or a lid move hits every strategy alike
+                for name, strategy in self.strategies.items():
+                    if name in errors:
+                        continue  # Already out of the running
+                    started = self.clock()
+                    try:
+                        closed = strategy.sample(self.timeout)
+                    except subprocess.TimeoutExpired:
+                        closed = None
+                        errors[name] = 'timeout'
+                    except ProbeInterrupted:
+                        raise
+                    except Exception as e:
+                        errors[name] = f'{type(e).__name__}: {e}'
+                        continue
+                    costs[name].append(self.clock() - started)
+                    answers[name].append(closed)
+
+            seen = Counter(a for values in answers.values() for a in values if a is not None)
+            consensus = seen.most_common(1)[0][0] if seen else None
+            results = {}
+            for name in self.strategies:
+                timings = sorted(costs[name])
+                correct = (consensus is not None and len(answers[name]) == self.rounds
+                           and all(a == consensus for a in answers[name]))
+                results[name] = {
+                    'correct': correct,
+                    'median_ms': timings[len(timings) // 2] * 1000 if timings else None,
+                    'max_ms': timings[-1] * 1000 if timings else None,
+                    'answers': answers[name],
+                    'error': errors.get(name),
+                }
+            ranking = sorted((name for name in results if results[name]['correct']),
+                             key=lambda name: results[name]['median_ms'])
+            with self._lock:
+                self.ranking = ranking
+                self.results = results
+                self.selections += 1
+                self._failures = 0
+                # Nothing works: don't fork a selection every few samples
+                self._recheck_at = (self.recheck_after if ranking
+                                    else min(self._recheck_at * 2, self.recheck_after * 64))
+            return self.report()
+
+    def strategy(self, native=True):
+        """The strategy sample() would use"""
+        for name in self.ranking:
+            strategy = self.strategies[name]
+            if native or not strategy.native:
+                return strategy
+        return self.strategies[BASELINE]
+
+    def sample(self, native=True):
+        """The lid state (True = closed) by the best strategy, or None if unknown
+
+        native=False keeps to the ioreg strategies (MACSENTINEL_LID_SOURCE=ioreg).
+        """
+        strategy = self.strategy(native)
+        started = time.monotonic()
+        try:
+            closed = strategy.sample(self.timeout)
+        except subprocess.TimeoutExpired:
+            IOREG_TIMEOUTS.inc()
+            closed = None
+        except ProbeInterrupted:
+            return None  # Not the strategy's fault; don't count it
+        except Exception:
+            closed = None
+        finally:
+            if not strategy.native:
+                IOREG_SECONDS.observe(time.monotonic() - started)
+        self.observe(strategy, closed)
+        return closed
+
+    def observe(self, strategy, closed):
+        """Count an answer from strategy; enough failures in a row trigger a re-check
+
+        Counts for the fallback too, so an empty ranking gets re-selected.
+        """
+        with self._lock:
+            if closed is not None:
+                self._failures = 0
+                return
+            self._failures += 1
+            threshold = self.recheck_after if strategy.name in self.ranking else self._recheck_at
+            if self._failures < threshold:
+                return
+            log.warning('Lid strategy keeps failing - switching and re-checking',
+                        strategy=strategy.name, failures=self._failures)
+            self.ranking = [name for name in self.ranking if name != strategy.name]
+            self._failures = 0
+            self.rechecks += 1
+        if not self._selecting.locked():
+            threading.Thread(target=self._reselect, name='clamshell-select', daemon=True).start()
+
+    def _reselect(self, attempts=3, delay=0.5):
+        """select() in the background, again if a teardown kills its helpers"""
+        for _ in range(attempts):
+            try:
+                self.select()
+                return
+            except ProbeInterrupted:
+                time.sleep(delay)
+            except Exception:
+                log.exception('Lid strategy selection failed')
+                return
+
+    def report(self):
+        with self._lock:
+            return {
+                'strategy': self.ranking[0] if self.ranking else None,
+                'ioreg_strategy': self.strategy(native=False).name,
+                'ranking': list(self.ranking),
+                'results': dict(self.results),
+                'selections': self.selections,
+                'rechecks': self.rechecks,
+            }
+
+
+clamshell = ClamshellProbe()
@@ -0,0 +1,308 @@
+"""Fleet collector: one place to see every Mac running a fleet agent.
+
+    python -m macsentinel collect [--host 0.0.0.0] [--port 5100]
+
+Agents (fleet.py) POST gzip-compressed heartbeat batches to /api/ingest.
+FleetState merges them in memory under one lock: the latest status of
+every agent, its last few events, and a bounded feed of recent events
+across the fleet. A retried batch the collector already has is recognized
+by its event sequence numbers and not counted twice. An agent counts as
+offline once it misses three heartbeats, and it is forgotten after
+FORGET_AFTER seconds of silence.
+
+    GET /                      fleet dashboard
+    GET /api/fleet             counts by state plus agents (?state=, ?online=0|1, ?limit=, ?offset=)
+    GET /api/fleet/<agent>     one agent with its recent events
+    GET /api/fleet/events      recent events across the fleet (?after=<id>, ?limit=)
+
+If MACSENTINEL_FLEET_TOKEN is set, /api/ingest requires it as a bearer
+token. The dashboard and query API are read-only and unauthenticated, so
+run the collector on a network you trust.
+"""
+import hmac
+import json
+import os
+import threading
+import time
+import zlib
+from collections import deque
+from itertools import islice
+
+from flask import Flask, abort, jsonify, render_template, request
+
+
+MAX_BODY = 1 << 20
+MAX_DECOMPRESSED = 16 << 20
+MAX_EVENTS_PER_BATCH = 1000
+
+AGENT_EVENTS = 50
+FEED_EVENTS = 10000
+# Heartbeats an agent may miss before it shows as offline
+MISSED_HEARTBEATS = 3
+FORGET_AFTER = 7 * 24 * 3600
+
+
+class BadBatch(ValueError):
+    """An ingest body that isn't a valid heartbeat batch"""
+
+
+class BadQuery(ValueError):
+    """A query parameter that isn't a whole number"""
+
+
+class AgentRecord:
+    __slots__ = ('id', 'host', 'address', 'boot', 'interval', 'status', 'first_seen', 'last_seen',
+                 'last_seq', 'events', 'batches', 'events_received', 'duplicates', 'dropped')
+
+    def __init__(self, agent_id, now):
+        self.id = agent_id
+        self.host = self.address = self.boot = None
+        self.interval = 30.0
+        self.status = {}
+        self.first_seen = self.last_seen = now
+        self.last_seq = 0
+        self.events = deque(maxlen=AGENT_EVENTS)
+        self.batches = self.events_received = self.duplicates = self.dropped = 0
+
+    def online(self, now):
+        return now - self.last_seen <= self.interval * MISSED_HEARTBEATS
+
+    def summary(self, now):
+        return {
+            'agent': self.id,
+            'host': self.host,
+            'address': self.address,
+            'online': self.online(now),
+            'armed': self.status.get('armed'),
+            'state': self.status.get('state'),
+            'trigger_latency_ms': self.status.get('trigger_latency_ms'),
+            'last_seen_s': now - self.last_seen,
+            'first_seen': time.time() - (now - self.first_seen),
+            'batches': self.batches,
+            'events': self.events_received,
+            'duplicates': self.duplicates,
+            'dropped': self.dropped,
+        }
+
+
+def decode_body(data, encoding):
+    """The JSON text of an ingest body, decompressing gzip with a size limit"""
+    if encoding in (None, '', 'identity'):
+        return data
+    if encoding != 'gzip':
+        raise BadBatch(f'unsupported Content-Encoding {encoding!r}')
+    decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        text = decompressor.decompress(data, MAX_DECOMPRESSED)
+    except zlib.error as e:
+        raise BadBatch(f'bad gzip body: {e}') from e
+    if decompressor.unconsumed_tail:
+        raise BadBatch('body too large once decompressed')
+    return text
+
+
+class FleetState:
+    """Latest state of every agent, merged from their batches"""
+
+    def __init__(self, clock=time.monotonic):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.agents = {}
+        self.feed = deque(maxlen=FEED_EVENTS)
+        self._feed_id = 0
+        self._next_sweep = 0.0
+        self.batches = 0
+        self.rejected = 0
+
+    def ingest(self, batch, address=None):
+        """Merge one agent batch; returns the acknowledgement"""
+        if not isinstance(batch, dict):
+            raise BadBatch('batch must be a JSON object')
+        agent_id, boot = batch.get('agent'), batch.get('boot')
+        batch_events = batch.get('events') or []
+        status = batch.get('status') or {}
+        if not isinstance(agent_id, str) or not 0 < len(agent_id) <= 128:
+            raise BadBatch('"agent" must be a non-empty string')
+        if not isinstance(batch_events, list) or len(batch_events) > MAX_EVENTS_PER_BATCH:
+            raise BadBatch(f'"events" must be a list of at most {MAX_EVENTS_PER_BATCH}')
+        if not isinstance(status, dict):
+            raise BadBatch('"status" must be an object')
+
+        now = self.clock()
+        with self._lock:
+            record = self.agents.get(agent_id)
+            if record is None:
+                record = self.agents[agent_id] = AgentRecord(agent_id, now)
+            if boot != record.boot:
+                # The agent restarted: its event numbering starts over
+                record.boot = boot
+                record.last_seq = 0
+            record.host = str(batch.get('host') or agent_id)[:128]
+            record.address = address
+            interval = batch.get('interval')
+            if isinstance(interval, (int, float)) and interval > 0:
+                record.interval = float(interval)
+            record.status = status
+            record.last_seen = now
+            record.batches += 1
+            dropped = batch.get('dropped')
+            if isinstance(dropped, int):
+                record.dropped = dropped
+            accepted = 0
+            for event in batch_events:
+                if not isinstance(event, dict):
+                    continue
+                seq = event.get('seq')
+                if not isinstance(seq, int) or seq <= record.last_seq:
+                    record.duplicates += 1
+                    continue
+                record.last_seq = seq
+                accepted += 1
+                merged = (event.get('time'), str(event.get('kind')), event.get('data') or {})
+                record.events.append(merged)
+                self._feed_id += 1
+                self.feed.append((self._feed_id, agent_id) + merged)
+            record.events_received += accepted
+            self.batches += 1
+            if now >= self._next_sweep:
+                self._sweep(now)
+        return {'ok': True, 'accepted': accepted, 'last_seq': record.last_seq}
+
+    def _sweep(self, now):
+        self._next_sweep = now + 60.0
+        for agent_id in [a for a, r in self.agents.items() if now - r.last_seen > FORGET_AFTER]:
+            del self.agents[agent_id]
+
+    def summary(self, state=None, online=None, limit=100, offset=0):
+        now = self.clock()
+        with self._lock:
+            records = list(self.agents.values())
+        counts = {'agents': len(records), 'online': 0, 'offline': 0, 'armed': 0, 'states': {}}
+        selected = []
+        for record in records:
+            is_online = record.online(now)
+            record_state = (record.status.get('state') or 'unknown') if is_online else 'offline'
+            counts['online' if is_online else 'offline'] += 1
+            if is_online and record.status.get('armed'):
+                counts['armed'] += 1
+            counts['states'][record_state] = counts['states'].get(record_state, 0) + 1
+            if state is not None and record_state != state:
+                continue
+            if online is not None and is_online != online:
+                continue
+            selected.append(record)
+        # Alarming first, then whoever was heard from least recently
+        selected.sort(key=lambda r: (r.status.get('state') != 'alarming', -(now - r.last_seen), r.id))
+        return {
+            'counts': counts,
+            'matched': len(selected),
+            'agents': [r.summary(now) for r in selected[offset:offset + limit]],
+        }
+
+    def agent(self, agent_id):
+        now = self.clock()
+        with self._lock:
+            record = self.agents.get(agent_id)
+            if record is None:
+                return None
+            report = record.summary(now)
+            report['status'] = dict(record.status)
+            report['recent_events'] = [{'time': t, 'kind': kind, 'data': data}
+                                       for t, kind, data in record.events]
+        return report
+
+    def events(self, after=None, limit=100):
+        """Fleet-wide events with an id greater than after (the newest ones without it)"""
+        limit = max(limit, 0)
+        with self._lock:
+            if after is None:
+                selected = list(islice(self.feed, max(0, len(self.feed) - limit), None))
+            else:
+                # Ids are consecutive, so index straight into the feed
+                skip = len(self.feed) - (self._feed_id - after)
+                selected = list(islice(self.feed, max(skip, 0), max(skip, 0) + limit))
+            last_id = self._feed_id
+        return {
+            'events': [{'id': i, 'agent': a, 'time': t, 'kind': k, 'data': d}
+                       for i, a, t, k, d in selected],
+            'next': selected[-1][0] if selected else (after if after is not None else last_id),
+        }
+
+    def stats(self):
+        with self._lock:
+            return {'agents': len(self.agents), 'batches': self.batches, 'rejected': self.rejected,
+                    'feed_events': len(self.feed)}
+
+
+app = Flask(__name__, static_folder=None)
+app.config['MAX_CONTENT_LENGTH'] = MAX_BODY
+
+fleet = FleetState()
+TOKEN = os.environ.get('MACSENTINEL_FLEET_TOKEN') or None
+
+
+@app.after_request
+def after_request(response):
+    response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+    return response
+
+@app.route('/api/ingest', methods=['POST'])
+def ingest():
+    """One agent heartbeat batch (gzip-compressed JSON)"""
+    if TOKEN is not None:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied.encode(), f'Bearer {TOKEN}'.encode()):
+            abort(401)
+    try:
+        text = decode_body(request.get_data(cache=False), request.headers.get('Content-Encoding'))
+        ack = fleet.ingest(json.loads(text), address=request.remote_addr)
+    except ValueError as e:
+        # BadBatch, and JSON that doesn't parse
+        fleet.rejected += 1
+        return jsonify({'ok': False, 'error': str(e)}), 400
+    return jsonify(ack)
+
+def int_arg(name, default, low=None, high=None):
+    """An integer query parameter clamped to [low, high]; BadQuery if it isn't one"""
+    value = request.args.get(name)
+    if value is None or value == '':
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise BadQuery(f'{name} must be an integer, not {value[:20]!r}') from None
+    if low is not None:
+        number = max(number, low)
+    if high is not None:
+        number = min(number, high)
+    return number
+
+@app.errorhandler(BadQuery)
+def bad_query(e):
+    return jsonify({'ok': False, 'error': str(e)}), 400
+
+@app.route('/api/fleet')
+def fleet_summary():
+    online = request.args.get('online')
+    return jsonify(fleet.summary(state=request.args.get('state') or None,
+                                 online=None if online is None else online not in ('0', 'false'),
+                                 limit=int_arg('limit', 100, 0, 1000),
+                                 offset=int_arg('offset', 0, 0)))
+
+@app.route('/api/fleet/events')
+def fleet_events():
+    return jsonify(fleet.events(after=int_arg('after', None),
+                                limit=int_arg('limit', 100, 0, 1000)))
+
+@app.route('/api/fleet/<agent_id>')
+def fleet_agent(agent_id):
+    report = fleet.agent(agent_id)
+    if report is None:
+        abort(404)
+    return jsonify(report)
+
+@app.route('/')
+def dashboard():
+    return render_template('fleet.html', fleet=fleet.summary(limit=500),
+                           feed=fleet.events(limit=25)['events'], stats=fleet.stats(),
+                           now=time.time())
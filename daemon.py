@@ -0,0 +1,523 @@
+"""One monitor engine per machine, shared by every web worker.
+
+The first process to take the engine lease (an flock()ed lockfile) builds
+the engine and serves it on a Unix socket. Every other process gets a
+RemoteSentinel, which forwards commands over that socket and mirrors the
+engine's events into its own EventBroadcaster, so /api/events works in any
+worker. The kernel drops an flock when its holder dies, so a lease is never
+stale: a worker that loses the engine takes the lease over and hosts the
+engine itself, armed again if it was armed.
+
+Protocol: one JSON object per line. A request is {"op": ..., "args": {...}}
+and the reply {"ok": true, "result": ...} or {"ok": false, "error": ...}.
+"subscribe" turns the connection into a stream of {"event": [id, kind, data]}
+lines, with {"keepalive": true} every KEEPALIVE seconds.
+
+The run directory (MACSENTINEL_RUN_DIR, default /tmp/macsentinel-<uid>)
+holds engine.lock and engine.sock; both are private to the user.
+
+Importing this module pulls in nothing but the standard library, events.py,
+logs.py and scheduler.py, so command line clients (macsentinel.py) start
+fast; the engine modules are imported by create_engine(), in the process
+that hosts it, and the fleet agent only when a collector is configured.
+"""
+import errno
+import fcntl
+import json
+import os
+import socket
+import socketserver
+import threading
+import time
+
+from events import Event
+from logs import get_logger
+from scheduler import backoff_delay
+
+
+log = get_logger('daemon')
+
+
+KEEPALIVE = 15.0
+
+
+def create_engine(broadcaster):
+    """Build the monitor engine that publishes to broadcaster
+
+    MACSENTINEL_ENGINE=asyncio picks the asyncio engine, otherwise the
+    threaded Sentinel. Also starts the capability probes the engine reads,
+    journals everything the engine publishes, and reports to the fleet
+    collector if MACSENTINEL_COLLECTOR_URL names one.
+    """
+    from capabilities import capabilities
+    from journal import journal
+    # Probe commands and audio devices once, off the arming path
+    capabilities.start()
+    journal.open()
+    broadcaster.journal = journal
+    if os.environ.get('MACSENTINEL_ENGINE') == 'asyncio':
+        # Everything runs as tasks on one event loop; callers just send it commands
+        from engine import AsyncEngine
+        engine = AsyncEngine(broadcaster)
+        engine.start()
+    else:
+        from sentinel import Sentinel
+        engine = Sentinel(broadcaster)
+    if os.environ.get('MACSENTINEL_COLLECTOR_URL'):
+        from fleet import start_agent
+        start_agent(engine, broadcaster)
+    return engine
+
+
+def engine_status(engine):
+    """engine.status(), with the engine process's logging stats and, when it reports to a
+    collector, the fleet agent's"""
+    import logs
+    response = engine.status()
+    response['logging'] = logs.pipeline.stats()
+    if os.environ.get('MACSENTINEL_COLLECTOR_URL'):
+        import fleet
+        if fleet.agent is not None:
+            response['fleet'] = fleet.agent.stats()
+    return response
+
+
+class EngineUnavailable(ConnectionError):
+    """Nobody is serving the engine socket"""
+
+
+class EngineError(RuntimeError):
+    """The engine answered a request with an error"""
+
+
+def run_dir():
+    path = os.environ.get('MACSENTINEL_RUN_DIR') or f'/tmp/macsentinel-{os.getuid()}'
+    os.makedirs(path, mode=0o700, exist_ok=True)
+    return path
+
+
+def socket_path():
+    return os.path.join(run_dir(), 'engine.sock')
+
+
+def lock_path():
+    return os.path.join(run_dir(), 'engine.lock')
+
+
+class Lease:
+    """Exclusive, non-blocking flock() on a lockfile that records the holder's pid"""
+
+    def __init__(self, path=None):
+        self.path = path or lock_path()
+        self._fd = None
+
+    @property
+    def held(self):
+        return self._fd is not None
+
+    def acquire(self):
+        """Take the lease without waiting; True if this process holds it now"""
+        if self._fd is not None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError as e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EACCES):
+                return False
+            raise
+        os.ftruncate(fd, 0)
+        os.write(fd, f'{os.getpid()}\n'.encode())
+        self._fd = fd
+        return True
+
+    def release(self):
+        fd, self._fd = self._fd, None
+        if fd is not None:
+            # Closing the descriptor drops the lock
+            os.close(fd)
+
+    def holder(self):
+        """pid recorded by the last holder, or None"""
+        try:
+            with open(self.path) as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def handle(self):
+        try:
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    op, args = request['op'], request.get('args') or {}
+                except (ValueError, KeyError, TypeError) as e:
+                    self._send({'ok': False, 'error': f'bad request: {e}'})
+                    continue
+                if op == 'subscribe':
+                    self._stream(args.get('since'))
+                    return
+                try:
+                    reply = {'ok': True, 'result': self.server.dispatch(op, args)}
+                except Exception as e:
+                    reply = {'ok': False, 'error': f'{type(e).__name__}: {e}'}
+                self._send(reply)
+        except OSError:
+            pass  # Client went away
+
+    def _send(self, message):
+        self.wfile.write(json.dumps(message).encode() + b'\n')
+
+    def _stream(self, since):
+        broadcaster = self.server.broadcaster
+        last_id = broadcaster.last_id
+        if since is not None and since <= last_id:
+            last_id = since
+        self._send({'ok': True, 'result': self.server.dispatch('ping', {})})
+        while not self.server.closing:
+            pending = broadcaster.wait(last_id, timeout=KEEPALIVE)
+            if not pending:
+                self._send({'keepalive': True})
+                continue
+            for event in pending:
+                self._send({'event': list(event)})
+            last_id = pending[-1].id
+
+
+class EngineServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """Serves one engine (Sentinel or AsyncEngine) to other processes"""
+
+    daemon_threads = True
+
+    def __init__(self, engine, broadcaster, path=None):
+        self.engine = engine
+        self.broadcaster = broadcaster
+        self.path = path or socket_path()
+        self.closing = False
+        # Only the lease holder gets here, so whatever is left is ours from a crash
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        super().__init__(self.path, _Handler)
+        os.chmod(self.path, 0o600)
+        self._thread = None
+
+    def dispatch(self, op, args):
+        engine = self.engine
+        if op == 'ping':
+            return {'pid': os.getpid(), 'armed': engine.armed, 'state': engine.state.state,
+                    'last_event_id': self.broadcaster.last_id}
+        if op == 'arm':
+            return engine.arm()
+        if op == 'disarm':
+            return engine.disarm()
+        if op == 'status':
+            return engine_status(engine)
+        if op == 'trigger_alarm':
+            success = engine.trigger_alarm(detected_at=args.get('detected_at'))
+            return {'success': success, 'latency': engine.last_trigger_latency}
+        if op == 'capabilities':
+            from capabilities import capabilities
+            if args.get('refresh'):
+                capabilities.refresh()
+            return capabilities.snapshot()
+        if op == 'history':
+            from journal import journal
+            return journal.query(**args)
+        raise ValueError(f'unknown op {op!r}')
+
+    def start(self):
+        self._thread = threading.Thread(target=self.serve_forever, name='engine-ipc', daemon=True)
+        self._thread.start()
+
+    def close(self):
+        self.closing = True
+        self.shutdown()
+        self.server_close()
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class EngineClient:
+    """Talks to the engine socket; one short connection per call"""
+
+    def __init__(self, path=None, timeout=5.0):
+        self.path = path or socket_path()
+        self.timeout = timeout
+
+    def _connect(self, timeout):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(timeout)
+        try:
+            sock.connect(self.path)
+        except OSError as e:
+            sock.close()
+            raise EngineUnavailable(f'no engine at {self.path}: {e}') from e
+        return sock
+
+    def call(self, op, timeout=None, **args):
+        """Run one op on the engine and return its result"""
+        sock = self._connect(timeout or self.timeout)
+        try:
+            with sock, sock.makefile('rwb') as stream:
+                stream.write(json.dumps({'op': op, 'args': args}).encode() + b'\n')
+                stream.flush()
+                line = stream.readline()
+        except OSError as e:
+            raise EngineUnavailable(f'engine connection failed: {e}') from e
+        if not line:
+            raise EngineUnavailable('engine closed the connection')
+        reply = json.loads(line)
+        if not reply.get('ok'):
+            raise EngineError(reply.get('error'))
+        return reply['result']
+
+    def subscribe(self, since=None, hello=None):
+        """Yield the engine's Events as they happen, from after `since`
+
+        hello, if given, is called first with the engine's ping reply.
+        Raises EngineUnavailable when the stream ends.
+        """
+        sock = self._connect(self.timeout)
+        # Keepalives arrive every KEEPALIVE seconds; twice that means it's gone
+        sock.settimeout(2 * KEEPALIVE)
+        try:
+            with sock, sock.makefile('rwb') as stream:
+                stream.write(json.dumps({'op': 'subscribe', 'args': {'since': since}}).encode() + b'\n')
+                stream.flush()
+                for line in stream:
+                    message = json.loads(line)
+                    if 'event' in message:
+                        yield Event(*message['event'])
+                    elif 'result' in message and hello is not None:
+                        hello(message['result'])
+        except OSError as e:
+            raise EngineUnavailable(f'event stream failed: {e}') from e
+        raise EngineUnavailable('engine closed the event stream')
+
+
+class MirroredState:
+    """The remote engine's state, as of its last event"""
+
+    def __init__(self, state, armed):
+        self.state = state
+        self.armed = armed
+
+
+class RemoteSentinel:
+    """The engine another process hosts, with Sentinel's interface"""
+
+    def __init__(self, client, broadcaster, on_lost=None):
+        self.client = client
+        self.broadcaster = broadcaster
+        self.on_lost = on_lost
+        self.last_trigger_latency = None
+        hello = client.call('ping')
+        self.engine_pid = hello['pid']
+        self.state = MirroredState(hello['state'], hello['armed'])
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._mirror, name='engine-events', daemon=True)
+        self._thread.start()
+
+    @property
+    def armed(self):
+        return self.state.armed
+
+    def _hello(self, reply):
+        self.engine_pid = reply['pid']
+        self.state = MirroredState(reply['state'], reply['armed'])
+
+    def _mirror(self):
+        """Copy the engine's events into our broadcaster until it goes away"""
+        failures = 0
+        while not self._stopped.is_set():
+            try:
+                for event in self.client.subscribe(since=self.broadcaster.last_id, hello=self._hello):
+                    failures = 0
+                    if 'state' in event.data:
+                        self.state = MirroredState(event.data['state'], event.data.get('armed'))
+                    self.broadcaster.append(event)
+            except EngineUnavailable:
+                failures += 1
+            if self._stopped.is_set():
+                return
+            if self.on_lost is not None and self.on_lost(self):
+                return  # Replaced by a new engine
+            self._stopped.wait(backoff_delay(failures, 0.1, 2.0))
+
+    def arm(self):
+        return self.client.call('arm')
+
+    def disarm(self):
+        return self.client.call('disarm')
+
+    def status(self):
+        return self.client.call('status')
+
+    def trigger_alarm(self, detected_at=None):
+        result = self.client.call('trigger_alarm', detected_at=detected_at)
+        self.last_trigger_latency = result['latency']
+        return result['success']
+
+    def capabilities(self, refresh=False):
+        return self.client.call('capabilities', refresh=refresh)
+
+    def history(self, **query):
+        return self.client.call('history', **query)
+
+    def cleanup(self):
+        """Stop mirroring; the engine itself belongs to its host"""
+        self._stopped.set()
+
+
+class EngineHandle:
+    """This process's way to the engine: hosted here while we hold the lease, remote otherwise
+
+    create_engine(broadcaster) builds the real engine and is only called by
+    the process that holds the lease.
+    """
+
+    def __init__(self, broadcaster, create_engine=create_engine, lease=None, client=None,
+                 attach_timeout=10.0):
+        self.create_engine = create_engine
+        self.broadcaster = broadcaster
+        self.lease = lease or Lease()
+        self.client = client or EngineClient()
+        self.attach_timeout = attach_timeout
+        self.server = None
+        self.target = None
+        self.started = time.monotonic()
+        self._lock = threading.RLock()
+        self._attach()
+
+    @property
+    def role(self):
+        return 'engine' if self.server is not None else 'worker'
+
+    def _attach(self, rearm=False):
+        deadline = time.monotonic() + self.attach_timeout
+        attempts = 0
+        while True:
+            if self.lease.acquire():
+                engine = self.create_engine(self.broadcaster)
+                self.server = EngineServer(engine, self.broadcaster, self.client.path)
+                self.server.start()
+                self.target = engine
+                log.info('Hosting the monitor engine', pid=os.getpid(), socket=self.server.path)
+                if rearm:
+                    log.info('Previous engine was armed - arming again')
+                    engine.arm()
+                return
+            try:
+                self.target = RemoteSentinel(self.client, self.broadcaster, on_lost=self._engine_lost)
+                log.info('Using the monitor engine', pid=self.target.engine_pid)
+                return
+            except EngineUnavailable:
+                # The holder is still starting up, or just died and the lock is on its way out
+                attempts += 1
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(backoff_delay(attempts, 0.02, 0.5))
+
+    def _engine_lost(self, remote):
+        """Called by a RemoteSentinel whose engine went away; True if we replaced it"""
+        with self._lock:
+            if self.target is not remote:
+                return True
+            if not self.lease.acquire():
+                return False  # Someone else hosts it (or will); keep following
+            remote.cleanup()
+            self._attach(rearm=remote.armed)
+            return True
+
+    def _call(self, name, *args, **kwargs):
+        target = self.target
+        try:
+            return getattr(target, name)(*args, **kwargs)
+        except EngineUnavailable:
+            # Give the engine (or our takeover) one chance to come back
+            with self._lock:
+                if self.target is target:
+                    self._engine_lost(target) or self._wait_for_engine()
+            return getattr(self.target, name)(*args, **kwargs)
+
+    def _wait_for_engine(self):
+        deadline = time.monotonic() + self.attach_timeout
+        while time.monotonic() < deadline:
+            try:
+                self.client.call('ping', timeout=1.0)
+                return
+            except EngineUnavailable:
+                time.sleep(0.1)
+
+    # Same names as sentinel.Sentinel
+
+    @property
+    def state(self):
+        return self.target.state
+
+    @property
+    def armed(self):
+        return self.target.armed
+
+    @property
+    def last_trigger_latency(self):
+        return self.target.last_trigger_latency
+
+    def arm(self):
+        return self._call('arm')
+
+    def disarm(self):
+        return self._call('disarm')
+
+    def status(self):
+        if self.server is not None:
+            return engine_status(self.target)
+        return self._call('status')
+
+    def trigger_alarm(self, detected_at=None):
+        return self._call('trigger_alarm', detected_at=detected_at)
+
+    def capabilities(self, refresh=False):
+        if self.server is not None:
+            from capabilities import capabilities
+            if refresh:
+                capabilities.refresh()
+            return capabilities.snapshot()
+        return self._call('capabilities', refresh=refresh)
+
+    def history(self, since=None, after=None, kinds=None, limit=100):
+        """The engine's journal (see journal.EventJournal.query)"""
+        query = {'since': since, 'after': after, 'kinds': kinds, 'limit': limit}
+        if self.server is not None:
+            from journal import journal
+            return journal.query(**query)
+        return self._call('history', **query)
+
+    def health(self):
+        """Liveness of this worker and the engine it uses"""
+        report = {'role': self.role, 'pid': os.getpid(),
+                  'uptime_seconds': time.monotonic() - self.started}
+        if self.server is not None:
+            report.update(ok=True, engine_pid=os.getpid(), state=self.target.state.state)
+            return report
+        try:
+            hello = self.client.call('ping', timeout=1.0)
+            report.update(ok=True, engine_pid=hello['pid'], state=hello['state'])
+        except (EngineUnavailable, EngineError) as e:
+            report.update(ok=False, engine_pid=self.lease.holder(), error=str(e))
+        return report
+
+    def cleanup(self):
+        with self._lock:
+            server, self.server = self.server, None
+            if server is not None:
+                server.close()
+            self.target.cleanup()
+            self.lease.release()
@@ -0,0 +1,217 @@
+"""Lid close detection logic, separated from sampling, clocks and sleeps.
+
+LidCloseDetector holds the state power_monitor_loop used to keep inline
+(initialized, last_lid_state) and turns each observation into a decision.
+It does no I/O and never reads a clock, so the same object runs inside
+the monitor thread, the asyncio engine, or the trace replayer
+(benchmarks/replay_traces.py), which feeds it weeks of samples on a virtual
+clock.
+
+RacingDetector runs the lid sensor and the pmset event stream against each
+other: whichever reports a valid open -> closed first triggers, the other
+one's report of the same close is deduplicated, and the winner and its
+margin are recorded. Callers pass observation times in, so it stays
+clock-free too.
+"""
+from collections import Counter, deque
+
+import metrics
+from pmset_log import CLAMSHELL_CLOSE, CLOSE_KINDS, LID_CLOSE, classify_line
+
+
+# Decisions returned by the detectors
+INITIALIZED = 'initialized'  # first known state after arming - the baseline
+OPENED = 'opened'            # closed -> open
+CLOSED = 'closed'            # open -> closed: trigger the alarm
+POWER_CLOSE = 'power_close'  # a pmset line that means the lid closed: trigger
+
+# pmset events trusted enough to race the sensor. Display sleep is left out:
+# idle display-sleep assertions while the lid is open would false-trigger
+# (see benchmarks/replay_traces.py).
+RACE_KINDS = frozenset([CLAMSHELL_CLOSE, LID_CLOSE])
+
+PMSET = 'pmset'
+
+DETECTION_WINS = metrics.Counter('macsentinel_detection_wins_total',
+                                 'Lid closes first reported by each source', ['source'])
+DETECTION_MARGIN = metrics.Histogram('macsentinel_detection_margin_seconds',
+                                     'How long after the winner the other source reported the same close',
+                                     ['winner'], buckets=(0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+
+class LidCloseDetector:
+    """Decides when a lid close should trigger the alarm
+
+    Only transitions after arming count: the first known lid state is the
+    baseline, so a lid that is already closed when arming doesn't trigger.
+    With use_power_log, pmset events of power_kinds trigger as well while
+    the lid is believed open.
+    """
+
+    def __init__(self, use_power_log=False, power_kinds=CLOSE_KINDS):
+        self.use_power_log = use_power_log
+        self.power_kinds = power_kinds
+        self.reset()
+
+    def reset(self):
+        """Forget everything; call on every arm"""
+        self.initialized = False
+        self.last_lid_state = None
+        # A pmset close the sensor hasn't confirmed or contradicted yet
+        self.power_closed = False
+
+    def observe_lid(self, closed):
+        """Feed one lid sample (True = closed, None = unknown); returns a decision or None"""
+        if closed is None:
+            return None
+        power_closed, self.power_closed = self.power_closed, False
+        if not self.initialized:
+            # On first sample after arming, initialize the lid state
+            # This ensures we only trigger on transitions AFTER arming
+            self.initialized = True
+            self.last_lid_state = closed
+            return INITIALIZED
+        previous, self.last_lid_state = self.last_lid_state, closed
+        if closed == previous:
+            return None
+        if closed and power_closed:
+            return None  # pmset already triggered for this close
+        # Only trigger if lid transitions from OPEN to CLOSED
+        return CLOSED if closed else OPENED
+
+    def observe_power_event(self, event):
+        """Feed one classified pmset PowerEvent; returns POWER_CLOSE or None"""
+        if (not self.use_power_log or not self.initialized or self.last_lid_state
+                or self.power_closed):
+            return None
+        if event.kind not in self.power_kinds:
+            return None
+        # Believe it until the next lid sample, but leave last_lid_state to the
+        # sensor: it only reports transitions, so if pmset was wrong it would
+        # never report the "open" that undoes it, and the next real close
+        # would look like no change
+        self.power_closed = True
+        return POWER_CLOSE
+
+    def observe_power_line(self, line):
+        """Feed one raw pmset log line; returns POWER_CLOSE or None"""
+        event = classify_line(line)
+        if event is None:
+            return None
+        return self.observe_power_event(event)
+
+
+class RacingDetector:
+    """Races the lid sensor against pmset; one trigger per physical close
+
+    A close episode starts when either source reports open -> closed and
+    ends when the sensor next sees the lid open. The other source's report
+    during the episode is a duplicate, and its delay is the winner's
+    margin. pmset reports arriving within late_window seconds after an
+    episode ended are late duplicates too (pmset lags the sensor by
+    seconds), so a quick close/open doesn't alarm twice. An episode pmset
+    started ends unconfirmed if the sensor reports the lid open, or
+    reports nothing for confirm_window seconds; a close after that is a
+    new one.
+    """
+
+    def __init__(self, sensor='sensor', late_window=10.0, confirm_window=60.0,
+                 power_kinds=RACE_KINDS, history=256):
+        self.sensor = sensor
+        self.late_window = late_window
+        self.confirm_window = confirm_window
+        self.detector = LidCloseDetector(use_power_log=True, power_kinds=power_kinds)
+        self.wins = Counter()
+        self.margins = {sensor: deque(maxlen=history), PMSET: deque(maxlen=history)}
+        self.duplicates = 0
+        self.unconfirmed = 0
+        self.reset()
+
+    def reset(self):
+        """Forget the lid state (keeps the stats); call on every arm"""
+        self.detector.reset()
+        self._episode = None  # [winner, started_at, sources that reported it]
+        self._ended_at = None
+
+    @property
+    def initialized(self):
+        return self.detector.initialized
+
+    def _start(self, winner, at):
+        self._episode = [winner, at, {winner}]
+        self.wins[winner] += 1
+        DETECTION_WINS.labels(source=winner).inc()
+
+    def _also_reported(self, source, at):
+        winner, started_at, sources = self._episode
+        if source in sources:
+            return
+        sources.add(source)
+        self.duplicates += 1
+        margin = max(0.0, at - started_at)
+        self.margins[winner].append(margin)
+        DETECTION_MARGIN.labels(winner=winner).observe(margin)
+
+    def _unconfirmed(self, at):
+        """End an episode pmset started that the sensor never saw"""
+        self.unconfirmed += 1
+        self._episode = None
+        self._ended_at = at
+        self.detector.power_closed = False
+
+    def _expired(self, at):
+        episode = self._episode
+        return (episode is not None and self.sensor not in episode[2]
+                and at - episode[1] > self.confirm_window)
+
+    def observe_lid(self, closed, at):
+        """Feed one lid sensor sample observed at `at`; returns a decision or None"""
+        if closed is not None and self._episode is not None and self.sensor not in self._episode[2]:
+            if closed is False or self._expired(at):
+                # pmset said closed but the sensor says open, or never saw it
+                self._unconfirmed(at)
+        decision = self.detector.observe_lid(closed)
+        if closed and self._episode is not None:
+            # pmset won this one; the sensor is the runner-up
+            self._also_reported(self.sensor, at)
+        if decision == CLOSED:
+            self._start(self.sensor, at)
+        elif decision == OPENED:
+            self._episode = None
+            self._ended_at = at
+        return decision
+
+    def observe_power_event(self, event, at):
+        """Feed one pmset PowerEvent that arrived at `at`; returns POWER_CLOSE or None"""
+        if event.kind not in self.detector.power_kinds:
+            return None
+        if self._expired(at):
+            self._unconfirmed(at)
+        if self._episode is not None:
+            self._also_reported(PMSET, at)
+            return None
+        if self._ended_at is not None and at - self._ended_at < self.late_window:
+            self.duplicates += 1
+            return None
+        decision = self.detector.observe_power_event(event)
+        if decision == POWER_CLOSE:
+            self._start(PMSET, at)
+        return decision
+
+    def stats(self):
+        """Wins per source and the winner's margin over the other source"""
+        margins = {}
+        for winner, values in self.margins.items():
+            values = sorted(values)
+            if values:
+                margins[winner] = {
+                    'p50_ms': values[len(values) // 2] * 1000,
+                    'max_ms': values[-1] * 1000,
+                    'samples': len(values),
+                }
+        return {
+            'wins': dict(self.wins),
+            'margins': margins,
+            'duplicates': self.duplicates,
+            'unconfirmed_power_closes': self.unconfirmed,
+        }
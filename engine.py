@@ -0,0 +1,540 @@
+"""Optional asyncio engine: the whole sentinel on one event loop.
+
+AsyncEngine runs lid sampling, pmset tailing, alarm playback and state
+broadcasting as tasks on a single event loop (in one background thread),
+instead of a thread each. Helper commands run as asyncio subprocesses with
+timeouts; cancelling a task kills its subprocess.
+
+It has the same surface as sentinel.Sentinel (arm, disarm, trigger_alarm,
+status, cleanup), so the Flask routes only send commands into it. Enable it
+with MACSENTINEL_ENGINE=asyncio.
+
+All timing goes through a clock object. Pass a VirtualClock and drive the
+engine with `await engine.run()` inside your own loop to test timing
+deterministically (tests/test_engine.py does):
+
+    clock = VirtualClock()
+    engine = AsyncEngine(clock=clock, sampler=fake_sampler, audio_backend=None)
+    runner = asyncio.create_task(engine.run())
+    await engine.arm_async()
+    await clock.advance(0.5)   # samples at exactly t = 0.0, 0.1, ..., 0.5
+"""
+import asyncio
+import heapq
+import itertools
+import os
+import threading
+import time
+
+import events
+from alarm import (ALARM_CONSECUTIVE_FAILURES, ALARM_FAILURES, ALARM_RESTARTS, AfplayBackend,
+                   create_audio_backend, resolve_alarm_sound)
+from capabilities import capabilities
+from clamshell import ClamshellScanner, clamshell, find_clamshell_state
+from detector import CLOSED, INITIALIZED, POWER_CLOSE, RacingDetector
+from events import EventBroadcaster
+from lid_sensor import POLL_INTERVAL, POLL_JITTER, FileLidSource, IOKitLidSource
+from logs import get_logger
+from pmset_log import PmsetCommandTailer, classify_lines, race_interval
+from scheduler import create_scheduler
+from process_manager import SPAWNS
+from sentinel import ALARMING, ARMED, ARMING, DISARMED, TRIGGER_LATENCY, SentinelState
+
+
+log = get_logger('engine')
+
+
+class Clock:
+    """Real time"""
+
+    def time(self):
+        return time.monotonic()
+
+    async def sleep(self, seconds):
+        await asyncio.sleep(seconds)
+
+
+class VirtualClock:
+    """Deterministic clock for tests: time only moves when advance() is called"""
+
+    def __init__(self, start=0.0):
+        self.now = start
+        self._sleepers = []
+        self._seq = itertools.count()
+
+    def time(self):
+        return self.now
+
+    async def sleep(self, seconds):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._sleepers, (self.now + max(seconds, 0.0), next(self._seq), future))
+        await future
+
+    async def _settle(self):
+        # Let every task that is ready run until it blocks again
+        for _ in range(20):
+            await asyncio.sleep(0)
+
+    async def advance(self, seconds):
+        """Move time forward, waking sleepers in order"""
+        target = self.now + seconds
+        await self._settle()
+        while self._sleepers and self._sleepers[0][0] <= target:
+            wake_at, _, future = heapq.heappop(self._sleepers)
+            self.now = max(self.now, wake_at)
+            if not future.done():
+                future.set_result(None)
+            await self._settle()
+        self.now = target
+
+
+async def run_command(argv, timeout):
+    """Run argv as an asyncio subprocess; returns (returncode, stdout, stderr)
+
+    On timeout or cancellation the process is killed and reaped before the
+    exception propagates.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    SPAWNS.labels(command=os.path.basename(argv[0])).inc()
+    try:
+        stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    return process.returncode, stdout, stderr
+
+
+async def scan_command(argv, scanner, timeout):
+    """Feed argv's stdout to scanner.feed() until it answers, then kill argv
+
+    The asyncio side of ProcessManager.run_until(); returns the answer, or
+    scanner.finish() if argv exits first.
+    """
+    process = await asyncio.create_subprocess_exec(
+        *argv,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL
+    )
+    SPAWNS.labels(command=os.path.basename(argv[0])).inc()
+
+    async def scan():
+        while True:
+            chunk = await process.stdout.read(65536)
+            if not chunk:
+                return scanner.finish()
+            answer = scanner.feed(chunk)
+            if answer is not None:
+                return answer
+    try:
+        return await asyncio.wait_for(scan(), timeout)
+    finally:
+        if process.returncode is None:
+            process.kill()
+        await process.wait()
+
+
+def create_sampler(spec=None):
+    """Build an async lid sampler (returns True = closed, False, or None)"""
+    spec = spec or os.environ.get('MACSENTINEL_LID_SOURCE', '')
+    if spec.startswith('file:'):
+        path = spec[len('file:'):]
+
+        async def sample_file():
+            # Last line of the state file is the current state
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(0, os.SEEK_END)
+                    f.seek(max(0, f.tell() - 256))
+                    lines = f.read().decode('utf-8', 'replace').strip().split('\n')
+            except OSError:
+                return None
+            parts = lines[-1].split() if lines else []
+            return FileLidSource._STATES.get(parts[0].lower()) if parts else None
+        return sample_file
+
+    async def sample_ioreg():
+        # Whichever ioreg strategy the capability probe found fastest
+        strategy = clamshell.strategy(native=False)
+        closed = None
+        try:
+            if strategy.stream:
+                closed = await scan_command(strategy.argv, ClamshellScanner(), clamshell.timeout)
+            else:
+                returncode, stdout, _ = await run_command(strategy.argv, timeout=clamshell.timeout)
+                if returncode == 0:
+                    closed = find_clamshell_state(stdout)
+        except (asyncio.TimeoutError, OSError):
+            pass
+        clamshell.observe(strategy, closed)
+        return closed
+
+    if spec == 'ioreg':
+        return sample_ioreg
+    try:
+        source = IOKitLidSource()
+    except Exception as e:
+        if spec == 'iokit':
+            raise
+        log.info('IOKit lid sensor unavailable, falling back to ioreg', error=str(e))
+        return sample_ioreg
+
+    async def sample_iokit():
+        # In-process and microseconds - fine to call on the loop
+        return source.sample()
+    return sample_iokit
+
+
+class AsyncEngine:
+    """Runs the sentinel as tasks on one asyncio event loop"""
+
+    def __init__(self, broadcaster=None, clock=None, sampler=None, audio_backend='auto',
+                 sample_interval=0.1, pmset_interval=None, volume_interval=10.0,
+                 pmset_command=('pmset', '-g', 'log')):
+        self.state = SentinelState()
+        self.broadcaster = broadcaster or EventBroadcaster()
+        self.clock = clock or Clock()
+        self.sampler = sampler or create_sampler()
+        self.sample_interval = sample_interval
+        self.scheduler = create_scheduler(sample_interval, clock=self.clock.time)
+        # Shared by the lid and pmset tasks, which both run on the loop thread
+        self.detector = RacingDetector(sensor='lid')
+        # None: from MACSENTINEL_PMSET_INTERVAL; 0 leaves pmset out of the race
+        self.pmset_interval = race_interval() if pmset_interval is None else pmset_interval
+        self.volume_interval = volume_interval
+        self.pmset_command = list(pmset_command)
+        self.alarm_sound = resolve_alarm_sound()
+        if audio_backend == 'auto':
+            try:
+                audio_backend = create_audio_backend(self.alarm_sound)
+            except Exception as e:
+                log.error('Could not load alarm sound', error=str(e))
+                audio_backend = None
+        self.audio_backend = audio_backend
+        self.last_trigger_latency = None
+        self.samples = 0
+        self.power_events = 0
+        self.alarm_loops = 0
+        self._loop = None
+        self._thread = None
+        self._outbox = None
+        self._stopped = None
+        self._tasks = {}
+
+    @property
+    def armed(self):
+        return self.state.armed
+
+    # Running the loop
+
+    def start(self):
+        """Run the engine's event loop in one background thread"""
+        ready = threading.Event()
+
+        def run_loop():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            self._loop.call_soon(ready.set)
+            self._loop.run_until_complete(self.run())
+            self._loop.close()
+
+        self._thread = threading.Thread(target=run_loop, daemon=True, name='sentinel-engine')
+        self._thread.start()
+        ready.wait()
+
+    async def run(self):
+        """Serve until cleanup(); all engine work happens under this task"""
+        self._loop = asyncio.get_running_loop()
+        self._outbox = asyncio.Queue()
+        self._stopped = asyncio.Event()
+        broadcaster_task = asyncio.create_task(self._broadcast())
+        try:
+            await self._stopped.wait()
+        finally:
+            await self._disarm()
+            # Flush queued broadcasts before exiting
+            await self._outbox.join()
+            broadcaster_task.cancel()
+
+    def _call(self, coroutine, timeout=2.0):
+        """Run a coroutine on the engine loop from another thread and wait for it"""
+        if self._loop is None:
+            raise RuntimeError('engine is not running')
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result(timeout)
+
+    # Commands (thread-safe, same names as sentinel.Sentinel)
+
+    def arm(self):
+        return self._call(self.arm_async())
+
+    def disarm(self):
+        return self._call(self._disarm())
+
+    def trigger_alarm(self, detected_at=None):
+        return self._call(self._trigger(detected_at))
+
+    def cleanup(self):
+        if self._loop is not None and self._loop.is_running():
+            self._loop.call_soon_threadsafe(self._stopped.set)
+            if self._thread is not None:
+                self._thread.join(timeout=2)
+
+    def status(self):
+        response = {
+            'armed': self.state.armed,
+            'state': self.state.state,
+            'engine': 'asyncio',
+            'engine_tasks': sorted(name for name, task in list(self._tasks.items()) if not task.done()),
+            'samples': self.samples,
+            'schedule': self.scheduler.stats(),
+            'race': self.detector.stats(),
+            'power_events': self.power_events,
+            'alarm_loops': self.alarm_loops,
+        }
+        if self.last_trigger_latency is not None:
+            response['trigger_latency_ms'] = self.last_trigger_latency * 1000
+        return response
+
+    # Loop side
+
+    def _publish(self, kind, **data):
+        self._outbox.put_nowait((kind, dict(data, armed=self.state.armed, state=self.state.state)))
+
+    async def _broadcast(self):
+        """Hand state changes to the (thread-safe) broadcaster"""
+        while True:
+            kind, data = await self._outbox.get()
+            try:
+                self.broadcaster.publish(kind, **data)
+            finally:
+                self._outbox.task_done()
+
+    def _start_task(self, name, coroutine):
+        self._cancel_task(name)
+        self._tasks[name] = asyncio.create_task(coroutine, name=name)
+
+    def _cancel_task(self, name):
+        task = self._tasks.pop(name, None)
+        if task is not None and not task.done():
+            task.cancel()
+        return task
+
+    async def arm_async(self):
+        if not self.state.transition(ARMING):
+            return False  # Already armed
+        generation = self.state.generation
+        self._publish(events.ARMED)
+        self.scheduler.reset()
+        self.detector.reset()
+        self._start_task('monitor', self._monitor(generation))
+        if self.pmset_interval and capabilities.usable('pmset_log') is False:
+            log.info('pmset log unavailable (see /api/capabilities), using the lid sampler alone')
+        elif self.pmset_interval:
+            self._start_task('pmset', self._tail_pmset(generation))
+        return True
+
+    async def _disarm(self):
+        was_armed = self.state.transition(DISARMED)
+        if was_armed:
+            self._publish(events.DISARMED)
+        tasks = [self._cancel_task(name) for name in ('monitor', 'pmset', 'alarm', 'beep')]
+        tasks = [task for task in tasks if task is not None]
+        if tasks:
+            # Wait for cancellation so no subprocess outlives the disarm
+            await asyncio.gather(*tasks, return_exceptions=True)
+        if any(task.get_name() == 'alarm' for task in tasks):
+            self._publish(events.ALARM_STOPPED)
+        return was_armed
+
+    async def _monitor(self, generation):
+        """Sample the lid on the adaptive schedule and trigger on open -> closed"""
+        detector = self.detector
+        poll_interval = POLL_INTERVAL.labels(source='engine')
+        poll_jitter = POLL_JITTER.labels(source='engine')
+        previous_start = due = None
+        while True:
+            sampled_at = self.clock.time()
+            if previous_start is not None:
+                poll_interval.observe(sampled_at - previous_start)
+                poll_jitter.observe(max(0.0, sampled_at - due))
+            previous_start = sampled_at
+            try:
+                lid_state = await self.sampler()
+            except Exception as e:
+                log.warning('Error sampling lid state', error=str(e))
+                lid_state = None
+            self.samples += 1
+            decision = detector.observe_lid(lid_state, sampled_at)
+            if decision == INITIALIZED:
+                log.info('Monitoring initialized', lid='closed' if lid_state else 'open')
+                self.state.transition(ARMED, generation=generation)
+            elif decision is not None:
+                self._publish(events.LID, closed=lid_state)
+                if decision == CLOSED:
+                    log.warning('LID CLOSE DETECTED - TRIGGERING ALARM')
+                    await self._trigger(sampled_at, generation)
+            now = self.clock.time()
+            delay = self.scheduler.next_delay(changed=decision is not None,
+                                              failed=lid_state is None,
+                                              cost=now - sampled_at)
+            due = now + delay
+            await self.clock.sleep(delay)
+
+    async def _tail_pmset(self, generation):
+        """Poll pmset, publish its power events and race them against the lid sampler"""
+        tailer = PmsetCommandTailer(self.pmset_command)
+        while True:
+            try:
+                returncode, stdout, _ = await run_command(self.pmset_command, timeout=5)
+                if returncode == 0:
+                    now = self.clock.time()
+                    for event in classify_lines(tailer.feed(stdout)):
+                        self.power_events += 1
+                        self._publish('power', kind=event.kind, line=event.line[:200])
+                        # Race the lid sampler: pmset may see the close first
+                        if self.detector.observe_power_event(event, now) == POWER_CLOSE:
+                            self._publish(events.LID, closed=True, source='pmset')
+                            log.warning('LID CLOSE DETECTED BY PMSET - TRIGGERING ALARM', line=event.line[:100])
+                            await self._trigger(now, generation)
+            except (asyncio.TimeoutError, OSError) as e:
+                log.warning('pmset read failed', error=repr(e))
+            await self.clock.sleep(self.pmset_interval)
+
+    async def _trigger(self, detected_at=None, generation=None):
+        if detected_at is None:
+            detected_at = self.clock.time()
+        if generation is not None:
+            if not self.state.transition(ALARMING, generation=generation):
+                return False
+        else:
+            # Manual test alarm: counts as alarming only while armed
+            self.state.transition(ALARMING)
+        if self.audio_backend is None:
+            log.error('No alarm playback available (see startup messages)')
+            self._publish(events.FAILURE, source='alarm', error='no alarm playback available')
+            return False
+        alarm = self._tasks.get('alarm')
+        if alarm is not None and not alarm.done():
+            return True
+
+        started = self._loop.create_future()
+        # Loop until disarmed; a test alarm while disarmed plays once
+        self._start_task('alarm', self._play_alarm(started, loop=self.state.state == ALARMING))
+        try:
+            await started
+        except Exception as e:
+            log.error('Failed to start alarm process', error=str(e))
+            self._publish(events.FAILURE, source='alarm', error=str(e))
+            return False
+        self.last_trigger_latency = self.clock.time() - detected_at
+        TRIGGER_LATENCY.observe(self.last_trigger_latency)
+        # The backup beep, alongside the first playback, as Sentinel plays it
+        self._start_task('beep', self._beep())
+        log.info('Alarm started', playback=self.audio_backend.name,
+                 latency_ms=round(self.last_trigger_latency * 1000, 1))
+        self._publish(events.ALARM_STARTED, latency_ms=self.last_trigger_latency * 1000)
+        return True
+
+    async def _beep(self):
+        """System beep as a backup; it sometimes sounds when the main playback doesn't"""
+        try:
+            await run_command(['osascript', '-e', 'beep'], timeout=5)
+        except (asyncio.TimeoutError, OSError):
+            pass  # Beep is optional
+        log.info('macOS disables built-in speakers when the lid closes: the alarm plays, '
+                 'but is only heard with the lid open or on an external audio device')
+
+    async def _set_volume(self):
+        try:
+            await run_command(
+                ['osascript',
+                 '-e', 'set volume output volume 100 without output muted',
+                 '-e', 'set volume without output muted'],
+                timeout=2)
+        except (asyncio.TimeoutError, OSError) as e:
+            log.warning('Error setting volume', error=repr(e))
+
+    async def _play_alarm(self, started, loop):
+        """Keep the alarm sounding; cancelling this task stops it"""
+        backend = self.audio_backend
+        volume = asyncio.create_task(self._enforce_volume())
+        try:
+            if isinstance(backend, AfplayBackend):
+                await self._play_afplay(backend, started, loop)
+            else:
+                await self._play_in_process(backend, started, loop)
+        except Exception as e:
+            if not started.done():
+                started.set_exception(e)
+            else:
+                log.error('Error in alarm loop', error=str(e))
+        finally:
+            volume.cancel()
+            if not started.done():
+                started.set_exception(RuntimeError('alarm stopped before playback started'))
+
+    async def _enforce_volume(self):
+        while True:
+            await self._set_volume()
+            await self.clock.sleep(self.volume_interval)
+
+    async def _play_afplay(self, backend, started, loop):
+        failures = 0
+        ALARM_CONSECUTIVE_FAILURES.set(0)
+        while True:
+            process = await asyncio.create_subprocess_exec(
+                *backend.command,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.PIPE
+            )
+            SPAWNS.labels(command='afplay').inc()
+            self.alarm_loops += 1
+            if not started.done():
+                started.set_result(process.pid)
+            else:
+                ALARM_RESTARTS.labels(backend=backend.name).inc()
+            try:
+                _, stderr_output = await process.communicate()
+            except asyncio.CancelledError:
+                process.terminate()
+                await process.wait()
+                raise
+            if process.returncode > 0:
+                failures += 1
+                ALARM_FAILURES.labels(backend=backend.name).inc()
+                ALARM_CONSECUTIVE_FAILURES.set(failures)
+                log.warning('Alarm playback failed', attempt=failures,
+                            error=stderr_output.decode('utf-8', 'replace').strip())
+                if failures >= 10:
+                    log.error('Alarm playback failed too many times, stopping retries')
+                    return
+                await self.clock.sleep(1)
+            elif failures:
+                failures = 0
+                ALARM_CONSECUTIVE_FAILURES.set(0)
+            if not loop:
+                return
+
+    async def _play_in_process(self, backend, started, loop):
+        backend.play(loop=loop)
+        self.alarm_loops += 1
+        started.set_result(None)
+        try:
+            while True:
+                await self.clock.sleep(0.25)
+                if backend.wait(0):
+                    if not loop:
+                        return
+                    backend.play(loop=True)
+                    self.alarm_loops += 1
+                    ALARM_RESTARTS.labels(backend=backend.name).inc()
+        finally:
+            backend.stop()
@@ -0,0 +1,324 @@
+"""/api/events for every client from one selector thread.
+
+Werkzeug's threaded server gives each connection a thread for as long as it
+stays open, so an SSE subscriber served by a Flask route holds a thread for
+its whole lifetime. make_server() wraps that server so each accepted
+connection is looked at first: a `GET /api/events` goes to the
+EventStreamHub, anything else to a Werkzeug request thread as before.
+
+The hub runs one selector loop that:
+  - reads the request headers (for Last-Event-ID) and answers with the
+    text/event-stream headers and whatever events the client missed
+  - formats each new event once and queues the same bytes to every
+    subscriber, writing with non-blocking sends as the sockets drain
+  - sends a keepalive comment every KEEPALIVE seconds, and drops clients
+    that hung up or fell more than MAX_BUFFERED bytes behind (EventSource
+    reconnects and catches up from its Last-Event-ID)
+A relay thread blocked in broadcaster.wait() wakes the loop through a pipe,
+so serving any number of idle subscribers takes these two threads.
+
+A connection whose request line arrives in pieces too small to tell where
+it is going is handed to Werkzeug, where the Flask route still serves
+/api/events with a thread (as it does under `python app.py`).
+"""
+import os
+import selectors
+import socket
+import threading
+import time
+
+import metrics
+from events import Event, format_sse
+from logs import get_logger
+
+
+log = get_logger('event_stream')
+
+
+PREFIX = b'GET /api/events'
+KEEPALIVE = 15.0
+MAX_HEADER_BYTES = 16384
+MAX_BUFFERED = 1 << 20
+
+RESPONSE_HEAD = (b'HTTP/1.1 200 OK\r\n'
+                 b'Content-Type: text/event-stream; charset=utf-8\r\n'
+                 b'Cache-Control: no-cache, no-store, must-revalidate\r\n'
+                 b'Access-Control-Allow-Origin: *\r\n'
+                 b'X-Accel-Buffering: no\r\n'
+                 b'Connection: close\r\n\r\n')
+
+CLIENTS = metrics.Gauge('macsentinel_event_stream_clients',
+                        'Clients subscribed to /api/events through the event stream hub')
+
+
+def route(data):
+    """'events' or 'other' for the first bytes of a request, None if they can't tell yet"""
+    if data.startswith(PREFIX):
+        if len(data) == len(PREFIX):
+            return None
+        return 'events' if data[len(PREFIX):len(PREFIX) + 1] in (b' ', b'?') else 'other'
+    return None if PREFIX.startswith(data) else 'other'
+
+
+def parse_last_event_id(head):
+    """The Last-Event-ID header of a request head (bytes) as an int, or None"""
+    for line in head.split(b'\r\n')[1:]:
+        name, _, value = line.partition(b':')
+        if name.strip().lower() == b'last-event-id':
+            try:
+                return int(value.strip())
+            except ValueError:
+                return None
+    return None
+
+
+class _Client:
+    __slots__ = ('sock', 'head', 'out', 'last_id', 'streaming')
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.head = bytearray()
+        self.out = bytearray()
+        self.last_id = 0
+        self.streaming = False
+
+
+class EventStreamHub:
+    """Streams a broadcaster's events to every /api/events client from one thread
+
+    state() returns the {'armed', 'state'} snapshot a new client starts from.
+    """
+
+    def __init__(self, broadcaster, state, keepalive=KEEPALIVE, max_buffered=MAX_BUFFERED):
+        self.broadcaster = broadcaster
+        self.state = state
+        self.keepalive = keepalive
+        self.max_buffered = max_buffered
+        self.last_id = 0
+        self.served = 0
+        self.dropped = 0
+        self.handed_off = 0
+        self._clients = {}
+        self._incoming = []
+        self._lock = threading.Lock()
+        self._selector = None
+        self._wake_r = self._wake_w = None
+        self._closed = False
+        self._threads = []
+
+    def start(self):
+        if self._threads:
+            return
+        self._selector = selectors.DefaultSelector()
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_w, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ)
+        self.last_id = self.broadcaster.last_id
+        for target, name in ((self._run, 'event-stream'), (self._relay, 'event-stream-relay')):
+            thread = threading.Thread(target=target, name=name, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _wake(self):
+        try:
+            os.write(self._wake_w, b'.')
+        except BlockingIOError:
+            pass  # Already more wake-ups queued than it needs
+
+    def route(self, sock, fallback):
+        """Take sock if it is an /api/events request, else call fallback() to serve it normally
+
+        Called on the server's accept thread, so it never waits for the
+        client: if nothing has arrived yet the hub decides once it has.
+        """
+        try:
+            data = sock.recv(len(PREFIX) + 1, socket.MSG_PEEK | socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            data = None
+        except OSError:
+            data = b''
+        if data is not None and route(data) != 'events':
+            # A request for something else, or a closed connection: Werkzeug deals with it
+            self.handed_off += 1
+            fallback()
+            return
+        with self._lock:
+            self._incoming.append((sock, fallback))
+        self._wake()
+
+    def _relay(self):
+        """Wake the loop whenever the broadcaster has something new"""
+        last_id = self.broadcaster.last_id
+        while not self._closed:
+            self.broadcaster.wait(last_id, timeout=self.keepalive)
+            current = self.broadcaster.last_id
+            if current != last_id:
+                last_id = current
+                self._wake()
+
+    def _run(self):
+        next_keepalive = time.monotonic() + self.keepalive
+        while not self._closed:
+            timeout = max(0.0, next_keepalive - time.monotonic())
+            for key, mask in self._selector.select(timeout):
+                try:
+                    if key.fileobj == self._wake_r:
+                        os.read(self._wake_r, 4096)
+                        self._accept_incoming()
+                        self._fan_out()
+                    elif isinstance(key.data, _Client):
+                        self._ready(key.data, mask)
+                    else:
+                        self._routed(key.fileobj, key.data)
+                except Exception:
+                    log.exception('Error in event stream loop')
+                    if isinstance(key.data, _Client):
+                        self._drop(key.data)
+            if time.monotonic() >= next_keepalive:
+                next_keepalive = time.monotonic() + self.keepalive
+                for client in list(self._clients.values()):
+                    if client.streaming:
+                        self._send(client, b': keepalive\n\n')
+
+    def _accept_incoming(self):
+        with self._lock:
+            incoming, self._incoming = self._incoming, []
+        for sock, fallback in incoming:
+            # Not a client yet: wait until its request line has arrived
+            self._selector.register(sock, selectors.EVENT_READ, fallback)
+
+    def _routed(self, sock, fallback):
+        self._selector.unregister(sock)
+        try:
+            data = sock.recv(len(PREFIX) + 1, socket.MSG_PEEK)
+        except OSError:
+            data = b''
+        if route(data) == 'events':
+            sock.setblocking(False)
+            client = _Client(sock)
+            self._clients[sock] = client
+            self._selector.register(sock, selectors.EVENT_READ, client)
+            self._ready(client, selectors.EVENT_READ)
+        else:
+            # Something else, or too little to tell and nothing more coming
+            # (it stays readable): Werkzeug serves it
+            self.handed_off += 1
+            fallback()
+
+    def _ready(self, client, mask):
+        if mask & selectors.EVENT_READ:
+            try:
+                data = client.sock.recv(4096)
+            except BlockingIOError:
+                data = None
+            except OSError:
+                data = b''
+            if data == b'':
+                self._drop(client)  # Hung up
+                return
+            if data and not client.streaming:
+                client.head += data
+                if b'\r\n\r\n' in client.head:
+                    self._subscribe(client)
+                elif len(client.head) > MAX_HEADER_BYTES:
+                    self._drop(client)
+                    return
+        if mask & selectors.EVENT_WRITE:
+            self._send(client, b'')
+
+    def _subscribe(self, client):
+        last_id = parse_last_event_id(bytes(client.head))
+        client.head = None
+        current = self.broadcaster.last_id
+        if last_id is None or last_id > current:
+            # New client (or the server restarted): start from the current state
+            initial = [Event(current, 'state', self.state())]
+            client.last_id = current
+        else:
+            initial = self.broadcaster.events_since(last_id)
+            client.last_id = initial[-1].id if initial else last_id
+        client.streaming = True
+        self.served += 1
+        CLIENTS.set(sum(1 for c in self._clients.values() if c.streaming))
+        self._send(client, RESPONSE_HEAD + ''.join(map(format_sse, initial)).encode())
+
+    def _fan_out(self):
+        current = self.broadcaster.last_id
+        if current < self.last_id:
+            # A restarted engine numbers its events from scratch
+            self.last_id = current
+            for client in self._clients.values():
+                client.last_id = min(client.last_id, current)
+        pending = self.broadcaster.events_since(self.last_id)
+        if not pending:
+            return
+        self.last_id = pending[-1].id
+        # Formatted once, the same bytes for every client
+        chunks = [(event.id, format_sse(event).encode()) for event in pending]
+        for client in list(self._clients.values()):
+            if client.streaming and client.last_id < self.last_id:
+                self._send(client, b''.join(chunk for event_id, chunk in chunks
+                                            if event_id > client.last_id))
+                client.last_id = self.last_id
+
+    def _send(self, client, data):
+        client.out += data
+        try:
+            while client.out:
+                sent = client.sock.send(client.out)
+                del client.out[:sent]
+        except BlockingIOError:
+            pass
+        except OSError:
+            self._drop(client)
+            return
+        if len(client.out) > self.max_buffered:
+            # It can catch up from its Last-Event-ID when it reconnects
+            self._drop(client)
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if client.out else 0)
+        if self._selector.get_key(client.sock).events != events:
+            self._selector.modify(client.sock, events, client)
+
+    def _drop(self, client):
+        if self._clients.pop(client.sock, None) is None:
+            return
+        if client.streaming:
+            self.dropped += 1
+        try:
+            self._selector.unregister(client.sock)
+        except (KeyError, ValueError):
+            pass
+        client.sock.close()
+        CLIENTS.set(sum(1 for c in self._clients.values() if c.streaming))
+
+    def close(self):
+        self._closed = True
+        if self._wake_w is not None:
+            self._wake()
+        for client in list(self._clients.values()):
+            try:
+                client.sock.close()
+            except OSError:
+                pass
+
+    def stats(self):
+        return {
+            'clients': sum(1 for c in self._clients.values() if c.streaming),
+            'served': self.served,
+            'dropped': self.dropped,
+            'handed_off': self.handed_off,
+        }
+
+
+def make_server(host, port, app, hub, request_handler=None, fd=None):
+    """Werkzeug's threaded WSGI server, with /api/events connections handed to hub"""
+    from werkzeug.serving import ThreadedWSGIServer
+
+    class EventStreamServer(ThreadedWSGIServer):
+        def process_request(self, request, client_address):
+            hub.route(request, lambda: ThreadedWSGIServer.process_request(
+                self, request, client_address))
+
+    hub.start()
+    return EventStreamServer(host, port, app, handler=request_handler, fd=fd)
@@ -0,0 +1,84 @@
+"""State-change broadcasting for the web UI.
+
+EventBroadcaster keeps a short, bounded history of numbered events and one
+shared Condition. Subscribers don't register anything: they remember the id
+of the last event they saw and wait() for newer ones, so an idle subscriber
+costs nothing but a blocked wait, and a reconnecting client can catch up
+from its Last-Event-ID.
+"""
+import json
+import threading
+from collections import deque, namedtuple
+from itertools import islice
+
+
+ARMED = 'armed'
+DISARMED = 'disarmed'
+LID = 'lid'
+ALARM_STARTED = 'alarm_started'
+ALARM_STOPPED = 'alarm_stopped'
+FAILURE = 'failure'
+
+Event = namedtuple('Event', ['id', 'kind', 'data'])
+
+
+class EventBroadcaster:
+    """Fan out state changes to any number of waiting subscribers"""
+
+    def __init__(self, history=256, journal=None):
+        self._cond = threading.Condition()
+        self._events = deque(maxlen=history)
+        self._last_id = 0
+        # Keeps every published event (journal.EventJournal); set where the engine runs
+        self.journal = journal
+
+    @property
+    def last_id(self):
+        return self._last_id
+
+    def publish(self, kind, **data):
+        """Record an event and wake every waiting subscriber"""
+        with self._cond:
+            self._last_id += 1
+            event = Event(self._last_id, kind, data)
+            self._events.append(event)
+            self._cond.notify_all()
+        if self.journal is not None:
+            self.journal.record_event(event)
+
+    def append(self, event):
+        """Record an Event numbered by another broadcaster (a mirror of another process)
+
+        Ids must run on consecutively; after a gap or a restarted source the
+        old history is dropped, so events_since() never indexes across it.
+        Mirrored events are not journaled; the source process did that.
+        """
+        with self._cond:
+            if event.id != self._last_id + 1:
+                self._events.clear()
+            self._last_id = event.id
+            self._events.append(event)
+            self._cond.notify_all()
+
+    def events_since(self, last_id):
+        """Return buffered events newer than last_id without waiting"""
+        with self._cond:
+            return self._since(last_id)
+
+    def _since(self, last_id):
+        if last_id >= self._last_id:
+            return []
+        # Events are numbered consecutively, so index straight into the buffer
+        skip = len(self._events) - (self._last_id - last_id)
+        return list(islice(self._events, max(skip, 0), None))
+
+    def wait(self, last_id, timeout=None):
+        """Block until there are events newer than last_id, or timeout"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._last_id > last_id, timeout)
+            return self._since(last_id)
+
+
+def format_sse(event):
+    """Serialize an Event in text/event-stream format"""
+    return f"id: {event.id}\nevent: {event.kind}\ndata: {json.dumps(event.data)}\n\n"
@@ -0,0 +1,451 @@
+"""Bounded event journal: lid transitions, alarms, arm/disarm and failures.
+
+Every event the engine publishes is kept as one fixed-size 16-byte record:
+
+    time (float64, Unix seconds) | kind (uint8) | source (uint8) | 2 pad bytes | latency (float32 ms, NaN if none)
+
+and numbered by a sequence number that keeps counting across restarts when
+the journal has a directory. Records live in a fixed ring buffer (memory
+never grows, however long the engine runs) and, if MACSENTINEL_JOURNAL_DIR
+is set, are also appended to rotating segment files in the same format:
+journal-<first seq>.bin, SEGMENT_RECORDS records each, oldest deleted past
+MAX_SEGMENTS.
+
+record() runs inside every publish, so it only packs the record into the
+ring and a pending buffer; a writer thread appends that buffer to the
+files in one write per segment, as the log pipeline does (logs.py).
+Queries copy the ring under the record lock and scan without it, so a slow
+query or a slow disk never holds up a publish. Records only have to reach
+the files before the ring wraps (the ring serves the newest RING_RECORDS
+itself): if a ring's worth is pending, record() writes it out itself.
+
+Times are kept non-decreasing, so the records are their own time index:
+query(since=...) binary-searches for the first record, then reads forward.
+A kind filter scans only the kind bytes, a chunk at a time, so a query
+costs a few milliseconds even over millions of stored events.
+
+Kind and source codes are part of the file format: only ever append to
+KINDS and SOURCES.
+"""
+import atexit
+import math
+import os
+import struct
+import threading
+import time
+
+import events
+from logs import get_logger
+
+
+log = get_logger('journal')
+
+
+RECORD = struct.Struct('<dBBxxf')
+KIND_OFFSET = 8
+
+KINDS = ('other', events.ARMED, events.DISARMED, 'lid_opened', 'lid_closed',
+         events.ALARM_STARTED, events.ALARM_STOPPED, 'power', events.FAILURE)
+SOURCES = ('', 'iokit', 'ioreg', 'file', 'pmset', 'alarm', 'monitor')
+
+KIND_CODES = {kind: code for code, kind in enumerate(KINDS)}
+SOURCE_CODES = {source: code for code, source in enumerate(SOURCES)}
+
+RING_RECORDS = 16384
+SEGMENT_RECORDS = 65536
+MAX_SEGMENTS = 16
+
+# Records read per step when scanning for a kind
+SCAN_CHUNK = 65536
+
+MAX_LIMIT = 1000
+
+
+def classify(event):
+    """(kind, source, latency_ms) for an events.Event"""
+    data = event.data
+    kind = event.kind
+    if kind == events.LID:
+        kind = 'lid_closed' if data.get('closed') else 'lid_opened'
+    source = 'pmset' if kind == 'power' else data.get('source') or ''
+    return kind, source, data.get('latency_ms')
+
+
+def _bisect_time(records, lo, hi, since):
+    """First seq in [lo, hi) whose time is >= since; records(seq) -> time"""
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if records(mid) < since:
+            lo = mid + 1
+        else:
+            hi = mid
+    return lo
+
+
+class _Ring:
+    """The newest `capacity` records, in one preallocated buffer"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.buffer = bytearray(capacity * RECORD.size)
+        self.first = self.end = 0
+
+    def append(self, seq, packed):
+        if self.end != seq:
+            self.first = seq  # Numbering moved on (journal reopened); start over
+        offset = (seq % self.capacity) * RECORD.size
+        self.buffer[offset:offset + RECORD.size] = packed
+        self.end = seq + 1
+        self.first = max(self.first, self.end - self.capacity)
+
+    def snapshot(self):
+        """A copy to read from without the journal's lock"""
+        ring = _Ring.__new__(_Ring)
+        ring.capacity, ring.first, ring.end = self.capacity, self.first, self.end
+        ring.buffer = bytes(self.buffer)
+        return ring
+
+    def time(self, seq):
+        return RECORD.unpack_from(self.buffer, (seq % self.capacity) * RECORD.size)[0]
+
+    def read(self, lo, hi):
+        """Packed records lo..hi-1, all held in the ring"""
+        start, stop = lo % self.capacity, (hi - 1) % self.capacity + 1
+        if start < stop:
+            return bytes(self.buffer[start * RECORD.size:stop * RECORD.size])
+        return bytes(self.buffer[start * RECORD.size:]) + bytes(self.buffer[:stop * RECORD.size])
+
+
+class _Segment:
+    """One journal-<first seq>.bin file"""
+
+    def __init__(self, path, first):
+        self.path = path
+        self.first = first
+        self.fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o600)
+        size = os.fstat(self.fd).st_size
+        if size % RECORD.size:
+            # A write cut short by a crash: drop the partial record
+            size -= size % RECORD.size
+            os.ftruncate(self.fd, size)
+        self.end = first + size // RECORD.size
+        self.first_time = self.time(first) if self.end > first else None
+
+    def time(self, seq):
+        return RECORD.unpack(os.pread(self.fd, RECORD.size, (seq - self.first) * RECORD.size))[0]
+
+    def read(self, lo, hi):
+        return os.pread(self.fd, (hi - lo) * RECORD.size, (lo - self.first) * RECORD.size)
+
+    def append(self, packed):
+        """Append whole packed records"""
+        os.write(self.fd, packed)
+        if self.end == self.first:
+            self.first_time = RECORD.unpack_from(packed)[0]
+        self.end += len(packed) // RECORD.size
+
+    def close(self):
+        os.close(self.fd)
+
+
+class EventJournal:
+    """Fixed-size record of engine events, optionally backed by rotating files"""
+
+    def __init__(self, directory=None, ring_records=RING_RECORDS,
+                 segment_records=SEGMENT_RECORDS, max_segments=MAX_SEGMENTS, clock=time.time):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.max_segments = max_segments
+        self.clock = clock
+        # _lock: the ring and numbering (held briefly by record() and query());
+        # _files_lock: the segments (held by the writer and while a query reads them)
+        self._lock = threading.Lock()
+        self._files_lock = threading.Lock()
+        self._ring = _Ring(ring_records)
+        self._segments = []
+        self._opened = False
+        self._next_seq = 0
+        self._last_time = 0.0
+        # Packed records from _pending_first on, waiting for the writer
+        self._pending = bytearray()
+        self._pending_first = 0
+        self._max_pending = ring_records * RECORD.size
+        self._wake = threading.Event()
+        self._thread = None
+        self._closing = False
+        self.write_errors = 0
+
+    def open(self):
+        """Load existing segments and continue their numbering
+
+        Called once, before anything is recorded, and only in the process
+        that hosts the engine.
+        """
+        with self._files_lock, self._lock:
+            if self._opened or not self.directory:
+                return
+            self._opened = True
+            self._closing = False
+            os.makedirs(self.directory, mode=0o700, exist_ok=True)
+            firsts = sorted(int(name[len('journal-'):-len('.bin')])
+                            for name in os.listdir(self.directory)
+                            if name.startswith('journal-') and name.endswith('.bin')
+                            and name[len('journal-'):-len('.bin')].isdigit())
+            # Gaps between segments (a failed write, a deleted file) are skipped when reading
+            self._segments = [_Segment(self._segment_path(first), first) for first in firsts]
+            if self._segments:
+                last = self._segments[-1]
+                self._next_seq = max(self._next_seq, last.end)
+                if last.end > last.first:
+                    self._last_time = max(self._last_time, last.time(last.end - 1))
+            # The ring only ever holds what follows the files
+            self._ring.first = self._ring.end = self._next_seq
+        atexit.register(self.close)
+
+    def close(self, timeout=2.0):
+        """Write what is queued (for up to timeout), stop the writer and close the files"""
+        self._closing = True
+        thread, self._thread = self._thread, None
+        if thread is not None:
+            self._wake.set()
+            thread.join(timeout)
+        else:
+            self._drain()
+        with self._files_lock, self._lock:
+            for segment in self._segments:
+                segment.close()
+            self._segments = []
+            self._opened = False
+
+    def _segment_path(self, first):
+        return os.path.join(self.directory, f'journal-{first:012d}.bin')
+
+    # Writing
+
+    def record(self, kind, source='', latency_ms=None, timestamp=None):
+        """Append one event; returns its sequence number"""
+        timestamp = self.clock() if timestamp is None else timestamp
+        latency = math.nan if latency_ms is None else latency_ms
+        backlog = False
+        with self._lock:
+            # Never go back in time (clock steps), so the time index stays sorted
+            timestamp = self._last_time = max(timestamp, self._last_time)
+            packed = RECORD.pack(timestamp, KIND_CODES.get(kind, 0), SOURCE_CODES.get(source, 0), latency)
+            seq = self._next_seq
+            self._next_seq += 1
+            self._ring.append(seq, packed)
+            if self._opened:
+                if not self._pending:
+                    self._pending_first = seq
+                self._pending += packed
+                backlog = len(self._pending) >= self._max_pending
+        if self._opened:
+            if backlog:
+                self._drain()  # The writer has fallen a ring behind: catch up here
+                return seq
+            if self._thread is None:
+                self._start()
+            if not self._wake.is_set():
+                self._wake.set()
+        return seq
+
+    def record_event(self, event):
+        """Record an events.Event (EventBroadcaster calls this for every publish)"""
+        kind, source, latency_ms = classify(event)
+        return self.record(kind, source, latency_ms)
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None and not self._closing:
+                self._thread = threading.Thread(target=self._run, name='journal-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            self._drain()
+            if self._closing:
+                return
+
+    def _drain(self):
+        with self._files_lock:
+            with self._lock:
+                first, data = self._pending_first, self._pending
+                self._pending = bytearray()
+            if not data or not self._opened:
+                return
+            try:
+                self._write(first, memoryview(data))
+            except OSError as e:
+                self.write_errors += 1
+                if self.write_errors == 1:
+                    log.warning('Could not write the event journal', error=str(e))
+
+    def flush(self, timeout=2.0):
+        """Wait until everything recorded so far is in the files; False if that took too long"""
+        if self._thread is None:
+            self._drain()
+            return True
+        deadline = time.monotonic() + timeout
+        self._wake.set()
+        while (self._pending or self._files_lock.locked()) and time.monotonic() < deadline:
+            time.sleep(0.001)
+        return not self._pending
+
+    def _write(self, seq, data):
+        """Append packed records numbered from seq, one write per segment they fall in"""
+        offset = 0
+        while offset < len(data):
+            segment = self._segments[-1] if self._segments else None
+            if segment is None or segment.end != seq or segment.end - segment.first >= self.segment_records:
+                segment = _Segment(self._segment_path(seq), seq)
+                self._segments.append(segment)
+                while len(self._segments) > self.max_segments:
+                    oldest = self._segments.pop(0)
+                    oldest.close()
+                    os.unlink(oldest.path)
+            room = (self.segment_records - (segment.end - segment.first)) * RECORD.size
+            segment.append(data[offset:offset + room])
+            seq += min(room, len(data) - offset) // RECORD.size
+            offset += room
+
+    # Reading
+
+    @property
+    def first_seq(self):
+        """Oldest sequence number still stored"""
+        return self._first_seq(self._ring)
+
+    def _first_seq(self, ring):
+        if self._segments and self._segments[0].end > self._segments[0].first:
+            return min(self._segments[0].first, ring.first)
+        return ring.first
+
+    def _find_time(self, ring, since):
+        """First seq stored at or after time `since`"""
+        if ring.end > ring.first and ring.time(ring.first) <= since:
+            return _bisect_time(ring.time, ring.first, ring.end, since)
+        # Older than the ring: pick the segment from the in-memory list, then bisect its file
+        segments = [s for s in self._segments if s.first_time is not None]
+        if not segments:
+            return ring.first
+        index = len(segments) - 1
+        while index > 0 and segments[index].first_time > since:
+            index -= 1
+        segment = segments[index]
+        seq = _bisect_time(segment.time, segment.first, segment.end, since)
+        if seq == segment.end and index + 1 < len(segments):
+            seq = segments[index + 1].first
+        return max(seq, self._first_seq(ring))
+
+    def _pieces(self, ring, lo, hi):
+        """(first seq, packed records) runs covering what is stored of [lo, hi)
+
+        The ring serves what it holds; older records come from the files,
+        skipping any gap a failed write left.
+        """
+        pieces = []
+        for segment in self._segments:
+            start, stop = max(lo, segment.first), min(hi, segment.end, ring.first)
+            if start < stop:
+                pieces.append((start, segment.read(start, stop)))
+        start = max(lo, ring.first)
+        if start < hi:
+            pieces.append((start, ring.read(start, hi)))
+        return pieces
+
+    def _matches(self, ring, lo, hi, table, reverse=False):
+        """Yield (seq, packed record) for records in [lo, hi) whose kind maps to 1 in table"""
+        chunk_starts = range(lo, hi, SCAN_CHUNK)
+        for chunk in (reversed(chunk_starts) if reverse else chunk_starts):
+            pieces = self._pieces(ring, chunk, min(chunk + SCAN_CHUNK, hi))
+            for start, data in (reversed(pieces) if reverse else pieces):
+                if table is None:
+                    indexes = range(len(data) // RECORD.size)
+                else:
+                    # One byte per record, 1 where the kind is wanted: the search runs in C
+                    kinds = data[KIND_OFFSET::RECORD.size].translate(table)
+                    indexes = []
+                    position = kinds.find(1)
+                    while position != -1:
+                        indexes.append(position)
+                        position = kinds.find(1, position + 1)
+                for index in (reversed(indexes) if reverse else indexes):
+                    yield start + index, data[index * RECORD.size:(index + 1) * RECORD.size]
+
+    def query(self, since=None, after=None, kinds=None, limit=100):
+        """Stored events, oldest first
+
+        since (Unix time) or after (a sequence number, as returned in `next`)
+        reads forward from there; with neither, the newest `limit` events.
+        kinds restricts the result to those kinds.
+        """
+        limit = max(1, min(int(limit), MAX_LIMIT))
+        table = None
+        if kinds:
+            unknown = set(kinds) - set(KINDS)
+            if unknown:
+                raise ValueError(f"unknown event kind(s): {', '.join(sorted(unknown))}")
+            wanted = {KIND_CODES[kind] for kind in kinds}
+            table = bytes(1 if code in wanted else 0 for code in range(256))
+
+        with self._lock:
+            ring = self._ring.snapshot()
+        end = ring.end
+        with self._files_lock:
+            first = self._first_seq(ring)
+            if after is not None:
+                start = max(int(after) + 1, first)
+            elif since is not None:
+                start = self._find_time(ring, float(since))
+            else:
+                start = None
+            found = []
+            if start is None:
+                for match in self._matches(ring, first, end, table, reverse=True):
+                    found.append(match)
+                    if len(found) == limit:
+                        break
+                found.reverse()
+            else:
+                for match in self._matches(ring, start, end, table):
+                    found.append(match)
+                    if len(found) == limit:
+                        break
+
+        results = []
+        for seq, packed in found:
+            timestamp, kind, source, latency = RECORD.unpack(packed)
+            results.append({
+                'seq': seq,
+                'time': timestamp,
+                'kind': KINDS[kind] if kind < len(KINDS) else 'other',
+                'source': SOURCES[source] if source < len(SOURCES) else '',
+                'latency_ms': None if math.isnan(latency) else round(latency, 3),
+            })
+        return {
+            'events': results,
+            # Pass back as `after` for the next page
+            'next': results[-1]['seq'] if results else (start - 1 if start is not None else end - 1),
+            'first_seq': first,
+            'last_seq': end - 1,
+        }
+
+    def stats(self):
+        with self._files_lock, self._lock:
+            return {
+                'recorded': self._next_seq,
+                'first_seq': self.first_seq,
+                'pending': len(self._pending) // RECORD.size,
+                'ring_records': self._ring.capacity,
+                'ring_bytes': len(self._ring.buffer),
+                'directory': self.directory if self._opened else None,
+                'segments': len(self._segments),
+                'file_bytes': sum((s.end - s.first) * RECORD.size for s in self._segments),
+                'write_errors': self.write_errors,
+            }
+
+
+# One per process; only the process hosting the engine records (and opens the files)
+journal = EventJournal(directory=os.environ.get('MACSENTINEL_JOURNAL_DIR') or None)
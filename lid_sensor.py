@@ -0,0 +1,309 @@
+"""Lid state sources for the power monitor.
+
+A LidStateSource runs in the background and pushes lid transitions
+(open -> closed, closed -> open) onto a queue that power_monitor_loop
+consumes. The first observation after start() is always pushed so the
+monitor can initialize its baseline. Polling sources space their samples
+with a PollScheduler (see scheduler.py): fast after arming and activity,
+slower when quiet, within a wakeups-per-minute budget.
+
+Backends:
+  - IOKitLidSource: reads AppleClamshellState from IOPMrootDomain in-process
+    through IOKit (no fork per sample). Default on macOS.
+  - IoregLidSource: runs ioreg once per sample, with whichever ioreg
+    strategy clamshell.py found fastest. Fallback when IOKit can't be loaded.
+  - FileLidSource: reads states from a file or named pipe, one per line
+    ("closed"/"open"/"1"/"0"/"yes"/"no", optionally followed by the
+    time.time() the state was written). For testing on Linux.
+
+Select a backend with MACSENTINEL_LID_SOURCE=iokit|ioreg|file:<path>.
+"""
+import os
+import queue
+import select
+import stat
+import threading
+import time
+from collections import namedtuple
+
+from logs import get_logger
+import metrics
+from clamshell import IOKitClamshell, clamshell
+from scheduler import create_scheduler
+
+
+log = get_logger('lid_sensor')
+
+
+# closed: True if the lid is closed
+# timestamp: time.monotonic() when the state was observed
+# cost: seconds spent producing the sample
+# latency: upper bound on how long ago the transition happened
+LidSample = namedtuple('LidSample', ['closed', 'timestamp', 'cost', 'latency'])
+
+POLL_INTERVAL = metrics.Histogram('macsentinel_poll_interval_seconds',
+                                  'Time between the starts of consecutive lid samples',
+                                  ['source'])
+POLL_JITTER = metrics.Histogram('macsentinel_poll_jitter_seconds',
+                                'How late each lid sample started compared to its schedule',
+                                ['source'])
+
+
+def check_lid_state():
+    """Check current lid state with the fastest ioreg strategy (see clamshell.py)"""
+    return clamshell.sample(native=False)
+
+
+class LidStateSource:
+    """Base class: samples the lid in a background thread and queues transitions"""
+
+    name = 'base'
+
+    def __init__(self, interval=0.5, scheduler=None):
+        # Shortest interval between samples; the scheduler stretches it when quiet
+        self.interval = interval
+        self.scheduler = scheduler or create_scheduler(interval)
+        self._transitions = queue.Queue()
+        # Per run: a run stop(wait=False) left behind keeps its own, set, so
+        # the next start() can't revive it next to the new one
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.last_state = None
+        self._last_sample_at = None
+        self.samples = 0
+        self.unknown_samples = 0
+        self.transitions = 0
+        self.total_cost = 0.0
+        self.max_cost = 0.0
+        self.last_latency = None
+        self.max_latency = 0.0
+
+    def start(self):
+        """Start sampling in a background thread"""
+        self.stop()
+        stop_event = self._stop_event = threading.Event()
+        self._reset_stats()
+        self.scheduler.reset()
+        # Drop transitions left over from a previous session
+        while True:
+            try:
+                self._transitions.get_nowait()
+            except queue.Empty:
+                break
+        self._thread = threading.Thread(target=self._run, args=(stop_event,), daemon=True,
+                                        name=f'lid-{self.name}')
+        self._thread.start()
+
+    def stop(self, wait=True):
+        """Stop sampling and wake any reader blocked in read()"""
+        self._stop_event.set()
+        self._transitions.put(None)
+        if self._thread is not None:
+            if wait:
+                self._thread.join(timeout=1)
+            self._thread = None
+
+    def push(self, item):
+        """Queue an item from another source (pmset events) for read()"""
+        self._transitions.put(item)
+
+    def read(self, timeout=None):
+        """Return the next LidSample transition (or pushed item), or None on timeout or stop"""
+        try:
+            return self._transitions.get(timeout=timeout)
+        except queue.Empty:
+            return None
+
+    def sample(self):
+        """Return the current lid state (True = closed), or None if unknown"""
+        raise NotImplementedError
+
+    def _run(self, stop_event):
+        poll_interval = POLL_INTERVAL.labels(source=self.name)
+        poll_jitter = POLL_JITTER.labels(source=self.name)
+        previous_start = due = None
+        while not stop_event.is_set():
+            started = time.monotonic()
+            if previous_start is not None:
+                poll_interval.observe(started - previous_start)
+                poll_jitter.observe(max(0.0, started - due))
+            previous_start = started
+            try:
+                closed = self.sample()
+            except Exception as e:
+                log.warning('Error sampling lid state', source=self.name, error=str(e))
+                closed = None
+            if stop_event.is_set():
+                break  # Stopped mid-sample: the answer belongs to no one
+            now = time.monotonic()
+            changed = self._record(closed, now, now - started)
+            delay = self.scheduler.next_delay(changed=changed, failed=closed is None,
+                                              cost=now - started)
+            due = now + delay
+            stop_event.wait(delay)
+
+    def _record(self, closed, observed_at, cost, changed_at=None):
+        """Update stats for one sample and queue it if the state changed
+
+        Returns True if a transition was queued.
+        """
+        self.samples += 1
+        self.total_cost += cost
+        if cost > self.max_cost:
+            self.max_cost = cost
+        if closed is None:
+            self.unknown_samples += 1
+            return False
+        previous_sample_at = self._last_sample_at
+        self._last_sample_at = observed_at
+        if closed == self.last_state:
+            return False
+        if changed_at is None:
+            # The change happened somewhere since the previous good sample
+            changed_at = previous_sample_at if previous_sample_at is not None else observed_at - cost
+        latency = max(0.0, observed_at - changed_at)
+        if self.last_state is not None:
+            self.transitions += 1
+            self.last_latency = latency
+            if latency > self.max_latency:
+                self.max_latency = latency
+        self.last_state = closed
+        self._transitions.put(LidSample(closed, observed_at, cost, latency))
+        return True
+
+    def stats(self):
+        """Return sampling cost, detection latency and schedule stats"""
+        return {
+            'source': self.name,
+            'interval': self.interval,
+            'samples': self.samples,
+            'unknown_samples': self.unknown_samples,
+            'transitions': self.transitions,
+            'mean_sample_cost_ms': (self.total_cost / self.samples * 1000) if self.samples else None,
+            'max_sample_cost_ms': self.max_cost * 1000,
+            'last_latency_ms': self.last_latency * 1000 if self.last_latency is not None else None,
+            'max_latency_ms': self.max_latency * 1000,
+            'schedule': self.scheduler.stats(),
+        }
+
+
+class IoregLidSource(LidStateSource):
+    """Runs ioreg once per sample"""
+
+    name = 'ioreg'
+
+    def sample(self):
+        return check_lid_state()
+
+    def stats(self):
+        stats = super().stats()
+        stats['strategy'] = clamshell.strategy(native=False).name
+        return stats
+
+
+class IOKitLidSource(LidStateSource):
+    """Reads AppleClamshellState from IOPMrootDomain through IOKit"""
+
+    name = 'iokit'
+
+    def __init__(self, interval=0.1):
+        super().__init__(interval=interval)
+        self._reader = IOKitClamshell()
+
+    def sample(self):
+        return self._reader.read()
+
+
+class FileLidSource(LidStateSource):
+    """Reads lid states from a file or named pipe (for testing without a Mac)"""
+
+    name = 'file'
+    _STATES = {'closed': True, 'close': True, '1': True, 'yes': True,
+               'open': False, 'opened': False, '0': False, 'no': False}
+
+    def __init__(self, path, interval=0.05):
+        super().__init__(interval=interval)
+        self.path = path
+
+    def _run(self, stop_event):
+        try:
+            fd = os.open(self.path, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError as e:
+            log.error('Error opening lid state file', path=self.path, error=str(e))
+            return
+        buffer = b''
+        try:
+            if not stat.S_ISFIFO(os.fstat(fd).st_mode):
+                # Regular file: earlier lines are history, only the last one
+                # is the current state. Replaying them would fake transitions.
+                history = b''
+                while True:
+                    chunk = os.read(fd, 65536)
+                    if not chunk:
+                        break
+                    history += chunk
+                *lines, buffer = history.split(b'\n')
+                for line in reversed(lines):
+                    if self._parse(line.decode('utf-8', 'replace'))[0] is not None:
+                        self._handle_line(line.decode('utf-8', 'replace'))
+                        break
+            while not stop_event.is_set():
+                ready, _, _ = select.select([fd], [], [], self.interval)
+                data = os.read(fd, 4096) if ready else b''
+                if not data:
+                    # EOF on a regular file, or no writer on a pipe yet
+                    stop_event.wait(self.interval)
+                    continue
+                buffer += data
+                *lines, buffer = buffer.split(b'\n')
+                for line in lines:
+                    if stop_event.is_set():
+                        break
+                    self._handle_line(line.decode('utf-8', 'replace'))
+        finally:
+            os.close(fd)
+
+    def _parse(self, line):
+        """Return (closed, written_at) for one line of the state file"""
+        parts = line.strip().split()
+        if not parts:
+            return None, None
+        closed = self._STATES.get(parts[0].lower())
+        written_at = None
+        if closed is not None and len(parts) > 1:
+            try:
+                written_at = float(parts[1])
+            except ValueError:
+                pass
+        return closed, written_at
+
+    def _handle_line(self, line):
+        started = time.monotonic()
+        closed, written_at = self._parse(line)
+        if closed is None and not line.strip():
+            return
+        changed_at = None
+        if written_at is not None:
+            # Convert the writer's wall-clock timestamp to our monotonic clock
+            changed_at = started - (time.time() - written_at)
+        now = time.monotonic()
+        self._record(closed, now, now - started, changed_at=changed_at)
+
+
+def create_lid_source(spec=None):
+    """Build the lid source named by spec or MACSENTINEL_LID_SOURCE"""
+    spec = spec or os.environ.get('MACSENTINEL_LID_SOURCE', '')
+    if spec.startswith('file:'):
+        return FileLidSource(spec[len('file:'):])
+    if spec == 'ioreg':
+        return IoregLidSource()
+    try:
+        return IOKitLidSource()
+    except Exception as e:
+        if spec == 'iokit':
+            raise
+        log.info('IOKit lid sensor unavailable, falling back to ioreg', error=str(e))
+        return IoregLidSource()
@@ -0,0 +1,317 @@
+"""Non-blocking structured logging: JSON lines written by a background thread.
+
+    from logs import get_logger
+    log = get_logger('sentinel')
+    log.warning('Alarm playback failed', attempt=3, error=str(e))
+    log.exception('Error in power monitor loop')   # inside an except block
+
+A log call checks the level, appends a tuple to an in-memory deque and
+returns: no formatting, no I/O, and the only lock it takes guards a small
+dict lookup, so a slow stdout pipe or log collector can't hold up lid
+detection or the alarm. One writer thread per process formats the records
+and writes them in batches, one JSON object per line:
+
+    {"ts": 1760000000.123, "level": "warning", "src": "alarm",
+     "msg": "Alarm playback failed", "attempt": 3, "error": "..."}
+
+Messages are constant text with the details as fields, so repeats are easy
+to recognize: when a logger sends the same message at the same level with
+the same fields again, back to back, the repeats are counted instead of
+queued for up to DEDUPE_WINDOW seconds, then written once with
+"repeated": <count>. Any other line from that logger ends the run first, so
+one-off state changes (arm, disarm, re-arm) are all written, in order.
+If the writer falls MAX_QUEUED records behind, the oldest are dropped and
+counted in stats().
+
+Configured from the environment:
+    MACSENTINEL_LOG_LEVEL      debug|info|warning|error (default info)
+    MACSENTINEL_LOG_FILE       write here instead of stdout, rotating past
+                               MACSENTINEL_LOG_MAX_BYTES (default 10 MB)
+                               and keeping MACSENTINEL_LOG_BACKUPS old
+                               files (default 5)
+    MACSENTINEL_LOG_FORMAT     json (default) or text, for a terminal
+"""
+import atexit
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+
+DEBUG, INFO, WARNING, ERROR = 10, 20, 30, 40
+LEVELS = {'debug': DEBUG, 'info': INFO, 'warning': WARNING, 'error': ERROR}
+LEVEL_NAMES = {value: name for name, value in LEVELS.items()}
+
+MAX_QUEUED = 10000
+DEDUPE_WINDOW = 10.0
+MAX_BATCH = 1000
+
+
+class Pipeline:
+    """The per-process queue and writer thread behind every Logger"""
+
+    def __init__(self, sink=None, path=None, level=INFO, fmt='json', max_bytes=10 * 2**20,
+                 backups=5, max_queued=MAX_QUEUED, dedupe_window=DEDUPE_WINDOW, sync=False,
+                 clock=time.time):
+        # sink: a file object; path: a file to append to and rotate (sink wins)
+        self.sink = sink
+        self.path = path
+        self.level = level
+        self.fmt = fmt
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.dedupe_window = dedupe_window
+        # Write on the calling thread, as print() did (comparisons and debugging only)
+        self.sync = sync
+        self.clock = clock
+        self._queue = deque(maxlen=max_queued)
+        self._repeats = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._closing = False
+        self._thread = None
+        self._file = None
+        self.written = 0
+        self.dropped = 0
+        self.suppressed = 0
+        self.write_errors = 0
+
+    def emit(self, level, source, message, fields, exc_info=None):
+        now = self.clock()
+        with self._lock:
+            # One open window per logger: anything else from it closes the window
+            window = self._repeats.get(source)
+            if (window is not None and now - window[0] < self.dedupe_window
+                    and window[4] == level and window[5] == message and window[3] == fields):
+                # [window start, repeats, latest time, fields, level, message]
+                window[1] += 1
+                window[2] = now
+                self.suppressed += 1
+                return
+            self._repeats[source] = [now, 0, now, fields, level, message]
+        if window is not None and window[1]:
+            self._enqueue(self._repeated(source, window))
+        self._enqueue((now, level, source, message, fields, exc_info))
+
+    @staticmethod
+    def _repeated(source, window):
+        return (window[2], window[4], source, window[5], dict(window[3], repeated=window[1]), None)
+
+    def _enqueue(self, record):
+        if self.sync or self._closing:
+            self._write([record])
+            return
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped += 1  # The oldest record falls off
+        self._queue.append(record)
+        if self._thread is None:
+            self._start()
+        if not self._wake.is_set():
+            self._wake.set()
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None and not self._closing:
+                self._thread = threading.Thread(target=self._run, name='log-writer', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while True:
+            # Only wake on a timer while a repeat count is waiting to be written
+            self._wake.wait(self.dedupe_window if self._repeats else None)
+            self._wake.clear()
+            self._flush_repeats(self.clock())
+            self._drain()
+            if self._closing:
+                return
+
+    def _drain(self):
+        while self._queue:
+            batch = []
+            try:
+                while len(batch) < MAX_BATCH:
+                    batch.append(self._queue.popleft())
+            except IndexError:
+                pass
+            self._write(batch)
+
+    def _flush_repeats(self, now):
+        """Queue the counts of repeat windows that have closed, and forget them"""
+        pending = []
+        with self._lock:
+            for source, window in list(self._repeats.items()):
+                if now - window[0] >= self.dedupe_window:
+                    del self._repeats[source]
+                    if window[1]:
+                        pending.append(self._repeated(source, window))
+        for record in pending:
+            self._queue.append(record)
+
+    def format(self, record):
+        timestamp, level, source, message, fields, exc_info = record
+        if exc_info is not None:
+            # Only needed for the odd exception; the CLI commands never load it
+            import traceback
+            exc_text = ''.join(traceback.format_exception(*exc_info))
+        if self.fmt == 'text':
+            details = ''.join(f' {key}={value}' for key, value in fields.items())
+            line = (f"{time.strftime('%H:%M:%S', time.localtime(timestamp))} "
+                    f"{LEVEL_NAMES[level].upper():<7} {source}: {message}{details}")
+            if exc_info is not None:
+                line += '\n' + exc_text.rstrip()
+            return line + '\n'
+        entry = {'ts': round(timestamp, 3), 'level': LEVEL_NAMES[level], 'src': source, 'msg': message}
+        entry.update(fields)
+        if exc_info is not None:
+            entry['exc'] = exc_text
+        return json.dumps(entry, default=str) + '\n'
+
+    def _write(self, batch):
+        text = ''.join(self.format(record) for record in batch)
+        try:
+            sink = self._open()
+            sink.write(text)
+            sink.flush()
+            self.written += len(batch)
+        except (OSError, ValueError):
+            # Nowhere to report it; count it and keep going
+            self.write_errors += 1
+
+    def _open(self):
+        if self.sink is not None:
+            return self.sink
+        if self.path is None:
+            return sys.stdout
+        if self._file is not None:
+            try:
+                rotated = os.stat(self.path).st_ino != os.fstat(self._file.fileno()).st_ino
+            except FileNotFoundError:
+                rotated = True
+            if rotated:
+                # Another process rotated it
+                self._file.close()
+                self._file = None
+            elif self._file.tell() >= self.max_bytes:
+                self._file.close()
+                self._file = None
+                self._rotate()
+        if self._file is None:
+            self._file = open(self.path, 'a', encoding='utf-8')
+        return self._file
+
+    def _rotate(self):
+        """path -> path.1 -> ... -> path.<backups>, dropping the oldest"""
+        for index in range(self.backups - 1, 0, -1):
+            try:
+                os.replace(f'{self.path}.{index}', f'{self.path}.{index + 1}')
+            except FileNotFoundError:
+                pass
+        try:
+            if self.backups:
+                os.replace(self.path, f'{self.path}.1')
+            else:
+                os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def flush(self, timeout=2.0):
+        """Wait until everything queued so far is written; False if that took too long"""
+        self._flush_repeats(float('inf'))
+        if self._thread is None:
+            self._drain()
+            return True
+        deadline = time.monotonic() + timeout
+        self._wake.set()
+        while self._queue and time.monotonic() < deadline:
+            time.sleep(0.01)
+        return not self._queue
+
+    def close(self, timeout=2.0):
+        """Write what is queued (for up to timeout) and stop the writer"""
+        self._flush_repeats(float('inf'))
+        self._closing = True
+        thread = self._thread
+        if thread is not None:
+            self._wake.set()
+            thread.join(timeout)
+        else:
+            self._drain()
+
+    def _after_fork(self):
+        # The writer thread didn't come along; the child starts its own on first use
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._thread = None
+        self._file = None
+        self._queue.clear()
+        self._repeats.clear()
+
+    def stats(self):
+        return {
+            'level': LEVEL_NAMES.get(self.level, self.level),
+            'queued': len(self._queue),
+            'max_queued': self._queue.maxlen,
+            'written': self.written,
+            'dropped': self.dropped,
+            'suppressed': self.suppressed,
+            'write_errors': self.write_errors,
+        }
+
+
+class Logger:
+    """Logs for one part of the app (the "src" field) through the shared pipeline"""
+
+    def __init__(self, name, pipeline):
+        self.name = name
+        self.pipeline = pipeline
+
+    def log(self, level, message, exc_info=None, **fields):
+        if level >= self.pipeline.level:
+            self.pipeline.emit(level, self.name, message, fields, exc_info)
+
+    def debug(self, message, **fields):
+        if DEBUG >= self.pipeline.level:
+            self.pipeline.emit(DEBUG, self.name, message, fields)
+
+    def info(self, message, **fields):
+        if INFO >= self.pipeline.level:
+            self.pipeline.emit(INFO, self.name, message, fields)
+
+    def warning(self, message, **fields):
+        if WARNING >= self.pipeline.level:
+            self.pipeline.emit(WARNING, self.name, message, fields)
+
+    def error(self, message, **fields):
+        if ERROR >= self.pipeline.level:
+            self.pipeline.emit(ERROR, self.name, message, fields)
+
+    def exception(self, message, **fields):
+        """error() with the exception being handled; the traceback is formatted by the writer"""
+        if ERROR >= self.pipeline.level:
+            self.pipeline.emit(ERROR, self.name, message, fields, sys.exc_info())
+
+
+def create_pipeline(environ=None):
+    """A Pipeline configured from the MACSENTINEL_LOG_* variables"""
+    environ = os.environ if environ is None else environ
+    level = LEVELS.get(environ.get('MACSENTINEL_LOG_LEVEL', 'info').lower(), INFO)
+    try:
+        max_bytes = int(environ.get('MACSENTINEL_LOG_MAX_BYTES', 10 * 2**20))
+        backups = int(environ.get('MACSENTINEL_LOG_BACKUPS', 5))
+    except ValueError:
+        max_bytes, backups = 10 * 2**20, 5
+    return Pipeline(path=environ.get('MACSENTINEL_LOG_FILE') or None, level=level,
+                    fmt=environ.get('MACSENTINEL_LOG_FORMAT', 'json'),
+                    max_bytes=max_bytes, backups=backups)
+
+
+pipeline = create_pipeline()
+atexit.register(pipeline.close)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=pipeline._after_fork)
+
+
+def get_logger(name):
+    return Logger(name, pipeline)
@@ -0,0 +1,262 @@
+"""Command line entry point.
+
+    python -m macsentinel serve [--host 127.0.0.1] [--port 5000] [--workers 1]
+    python -m macsentinel daemon [--arm]
+    python -m macsentinel arm | disarm | status [--json] | watch [--json]
+    python -m macsentinel collect [--host 0.0.0.0] [--port 5100]
+
+serve runs the web app on Werkzeug's threaded WSGI server with debug and
+the reloader off; /api/events subscribers are streamed from one thread
+(event_stream.py) rather than holding a request thread each. With
+--workers N it starts N worker processes sharing one listening socket and
+restarts any that die. Whichever process takes the engine lease first
+hosts the lid monitor and alarm; the others reach it over its Unix socket
+(see daemon.py), so there is one engine however many workers there are.
+
+daemon hosts the engine without the web UI, for login items and scripts.
+arm, disarm, status and watch talk to whichever process hosts the engine;
+arm starts a daemon first if nothing does. Only serve imports Flask, and
+the client commands import nothing beyond daemon.py, events.py and logs.py.
+
+collect runs the fleet collector (collector.py) that agents report to.
+"""
+import argparse
+import importlib
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+from daemon import EngineClient, EngineError, EngineHandle, EngineUnavailable, Lease, run_dir
+from logs import get_logger
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+
+log = get_logger('macsentinel')
+
+
+def serve_socket(listener, module='app'):
+    """Serve module's Flask app on a bound, listening socket until SIGTERM or Ctrl-C"""
+    # SIGTERM raises SystemExit, so atexit cleanup (alarm, engine lease) still runs
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    started = time.perf_counter()
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    served = importlib.import_module(module)
+    if hasattr(served, 'start'):
+        served.start()  # app.py: host or attach to the engine
+    app = served.app
+
+    class RequestHandler(WSGIRequestHandler):
+        def log_request(self, code='-', size='-'):
+            pass  # Errors are still logged; one line per request is just noise
+
+    host, port = listener.getsockname()[:2]
+    hub = getattr(served, 'event_hub', None)
+    if hub is not None:
+        # /api/events clients are streamed from the hub's one thread, not one each
+        from event_stream import make_server as make_event_server
+        server = make_event_server(host, port, app, hub, request_handler=RequestHandler,
+                                   fd=listener.fileno())
+    else:
+        server = make_server(host, port, app, threaded=True, request_handler=RequestHandler,
+                             fd=listener.fileno())
+    log.info('MacSentinel serving' if module == 'app' else f'MacSentinel {module} serving',
+             url=f'http://{host}:{port}', pid=os.getpid(),
+             ready_ms=round((time.perf_counter() - started) * 1000))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if hub is not None:
+            hub.close()
+
+
+def exit_code(status):
+    """os.wait() status as a return code: negative for a signal, like Popen.returncode"""
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def serve_workers(listener, workers):
+    """Run `workers` serving processes on listener, restarting any that exit"""
+    argv = [sys.executable, '-m', 'macsentinel', 'serve', '--fd', str(listener.fileno())]
+    children = {}
+    stopping = False
+
+    def spawn():
+        child = subprocess.Popen(argv, cwd=ROOT, pass_fds=(listener.fileno(),))
+        children[child.pid] = child
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for child in children.values():
+            child.send_signal(signal.SIGTERM)
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    for _ in range(workers):
+        spawn()
+    while children:
+        pid, status = os.wait()
+        child = children.pop(pid, None)
+        if child is None or stopping:
+            continue
+        log.warning('Worker exited, restarting it', pid=pid, exit_code=exit_code(status))
+        time.sleep(1)
+        if not stopping:
+            spawn()
+
+
+def serve(args):
+    if args.fd is not None:
+        serve_socket(socket.socket(fileno=args.fd))
+        return
+    listener = socket.create_server((args.host, args.port), backlog=128)
+    if args.workers <= 1:
+        serve_socket(listener)
+    else:
+        serve_workers(listener, args.workers)
+
+
+def collect(args):
+    serve_socket(socket.create_server((args.host, args.port), backlog=1024), module='collector')
+
+
+def run_daemon(args):
+    """Host the engine without the web UI until SIGTERM or Ctrl-C"""
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    started = time.perf_counter()
+    lease = Lease()
+    if not lease.acquire():
+        print(f"The MacSentinel engine is already running (pid {lease.holder()})", file=sys.stderr)
+        return 1
+    from events import EventBroadcaster
+    handle = EngineHandle(EventBroadcaster(), lease=lease)
+    try:
+        if args.arm:
+            handle.arm()
+        log.info('MacSentinel daemon ready', ready_ms=round((time.perf_counter() - started) * 1000),
+                 armed=bool(args.arm))
+        # Short sleeps, not signal.pause(): a SIGTERM landing just before pause()
+        # would only be handled once another signal arrived
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        handle.cleanup()
+    return 0
+
+
+def start_daemon(client, timeout=5.0):
+    """Start a detached daemon and wait until it answers"""
+    log_path = os.path.join(run_dir(), 'daemon.log')
+    with open(log_path, 'ab') as log:
+        subprocess.Popen([sys.executable, '-m', 'macsentinel', 'daemon'], cwd=ROOT,
+                         stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                         start_new_session=True)
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            return client.call('ping')
+        except EngineUnavailable:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.01)
+
+
+def arm(args):
+    client = EngineClient()
+    try:
+        armed = client.call('arm')
+    except EngineUnavailable:
+        start_daemon(client)
+        armed = client.call('arm')
+    print('Armed' if armed else 'Already armed')
+    return 0
+
+
+def disarm(args):
+    was_armed = EngineClient().call('disarm')
+    print('Disarmed' if was_armed else 'Not armed')
+    return 0
+
+
+def status(args):
+    client = EngineClient()
+    if args.json:
+        print(json.dumps(client.call('status'), indent=2, sort_keys=True))
+        return 0
+    hello = client.call('ping')
+    print(f"{hello['state']} (engine pid {hello['pid']})")
+    return 0
+
+
+def watch(args):
+    """Print the engine's events as they happen"""
+    try:
+        for event in EngineClient().subscribe():
+            if args.json:
+                print(json.dumps({'id': event.id, 'kind': event.kind, 'data': event.data}), flush=True)
+            else:
+                details = ' '.join(f'{key}={value}' for key, value in sorted(event.data.items()))
+                print(f"{time.strftime('%H:%M:%S')} {event.kind:<14} {details}", flush=True)
+    except KeyboardInterrupt:
+        return 0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='macsentinel', description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    serve_parser = commands.add_parser('serve', help='run the web app and the monitor engine')
+    serve_parser.add_argument('--host', default='127.0.0.1')
+    serve_parser.add_argument('--port', type=int, default=5000)
+    serve_parser.add_argument('--workers', type=int, default=1,
+                              help='web worker processes (one engine is shared by all)')
+    # Internal: serve on a listening socket inherited from the parent
+    serve_parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+    serve_parser.set_defaults(handler=serve)
+
+    collect_parser = commands.add_parser('collect', help='run the fleet collector agents report to')
+    collect_parser.add_argument('--host', default='0.0.0.0')
+    collect_parser.add_argument('--port', type=int, default=5100)
+    collect_parser.set_defaults(handler=collect)
+
+    daemon_parser = commands.add_parser('daemon', help='run the monitor engine without the web UI')
+    daemon_parser.add_argument('--arm', action='store_true', help='arm as soon as it starts')
+    daemon_parser.set_defaults(handler=run_daemon)
+
+    commands.add_parser('arm', help='arm (starting a daemon if none is running)').set_defaults(handler=arm)
+    commands.add_parser('disarm', help='disarm and stop the alarm').set_defaults(handler=disarm)
+    status_parser = commands.add_parser('status', help='show the engine state')
+    status_parser.add_argument('--json', action='store_true', help='full status as JSON')
+    status_parser.set_defaults(handler=status)
+    watch_parser = commands.add_parser('watch', help='print events as they happen')
+    watch_parser.add_argument('--json', action='store_true', help='one JSON object per line')
+    watch_parser.set_defaults(handler=watch)
+
+    args = parser.parse_args(argv)
+    if args.command is None:
+        parser.print_help()
+        return 2
+    try:
+        return args.handler(args)
+    except EngineUnavailable:
+        print("MacSentinel is not running (start it with `macsentinel daemon` or `macsentinel serve`)",
+              file=sys.stderr)
+        return 1
+    except EngineError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
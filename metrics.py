@@ -0,0 +1,246 @@
+"""Counters, gauges and histograms, rendered in the Prometheus text format.
+
+Recording is meant for hot paths (every lid sample, every spawn):
+  - each thread writes into its own fixed-size array of doubles, so the
+    recording side takes no locks and never races another thread
+  - a histogram is one array of bucket counts plus the sum, allocated once
+    per thread; observe() is a bisect and two in-place adds
+  - when a thread exits its array goes on a free list, counts intact, and
+    the next new thread takes it over: a thread-per-request server reuses
+    arrays instead of allocating one per request, and there are never more
+    than the most threads that were recording at once
+  - render() (a /metrics scrape) sums the arrays
+
+Metrics register themselves in REGISTRY when created; define them at module
+level next to the code that records them. For labelled metrics, bind the
+child once (`SAMPLES.labels(source='iokit')`) outside the hot loop.
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from collections import deque
+
+
+# Latency buckets in seconds, 0.5 ms to 10 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+class _Lease:
+    """Holds a thread's array in its threading.local; hands it back when the thread exits"""
+
+    __slots__ = ('cells', '_free')
+
+    def __init__(self, cells, free):
+        self.cells = cells
+        self._free = free
+
+    def __del__(self):
+        # deque.append is atomic, so this takes no lock wherever it runs
+        self._free.append(self.cells)
+
+
+class _Shards:
+    """Per-thread arrays of doubles, summed when collected"""
+
+    def __init__(self, size):
+        self._size = size
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._shards = []  # Every array ever handed out, owned or free
+        self._free = deque()
+
+    def cells(self):
+        """This thread's array; only the owning thread ever writes to it"""
+        try:
+            return self._local.lease.cells
+        except AttributeError:
+            try:
+                # A thread that exited left its array, counts and all
+                cells = self._free.pop()
+            except IndexError:
+                cells = array('d', [0.0]) * self._size
+                with self._lock:
+                    self._shards.append(cells)
+            self._local.lease = _Lease(cells, self._free)
+            return cells
+
+    def totals(self):
+        with self._lock:
+            shards = list(self._shards)
+        totals = array('d', [0.0]) * self._size
+        for cells in shards:
+            for i, value in enumerate(cells):
+                totals[i] += value
+        return totals
+
+
+class _Metric:
+    """Base class: a named metric with optional labels"""
+
+    kind = 'untyped'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, **kwargs):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._kwargs = kwargs
+        self._children = {}
+        self._lock = threading.Lock()
+        if not self.labelnames:
+            self._init_child()
+        if registry is None:
+            registry = REGISTRY
+        if registry is not False:
+            registry.register(self)
+
+    def _init_child(self):
+        pass
+
+    def labels(self, **labelvalues):
+        """Return the child metric for these label values"""
+        key = tuple(str(labelvalues[name]) for name in self.labelnames)
+        child = self._children.get(key)
+        if child is None:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    # Children render through their parent, so aren't registered
+                    child = type(self)(self.name, self.documentation, registry=False,
+                                       **self._kwargs)
+                    self._children[key] = child
+        return child
+
+    def _samples(self):
+        """Yield (suffix, labels dict, value)"""
+        if not self.labelnames:
+            yield from self._own_samples({})
+            return
+        for key, child in sorted(self._children.items()):
+            yield from child._own_samples(dict(zip(self.labelnames, key)))
+
+    def _own_samples(self, labels):
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    """Monotonically increasing count; name it with a _total suffix"""
+
+    kind = 'counter'
+
+    def _init_child(self):
+        self._shards = _Shards(1)
+
+    def inc(self, amount=1):
+        self._shards.cells()[0] += amount
+
+    @property
+    def value(self):
+        return self._shards.totals()[0]
+
+    def _own_samples(self, labels):
+        yield '', labels, self.value
+
+
+class Gauge(_Metric):
+    """Current value, last write wins"""
+
+    kind = 'gauge'
+
+    def _init_child(self):
+        self.value = 0.0
+
+    def set(self, value):
+        self.value = value
+
+    def _own_samples(self, labels):
+        yield '', labels, self.value
+
+
+class Histogram(_Metric):
+    """Counts of observations in fixed buckets, plus their sum"""
+
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), registry=None,
+                 buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames, registry, buckets=tuple(buckets))
+
+    def _init_child(self):
+        self.buckets = self._kwargs['buckets']
+        # One count per bucket, one for +Inf, then the sum
+        self._shards = _Shards(len(self.buckets) + 2)
+
+    def observe(self, value):
+        cells = self._shards.cells()
+        cells[bisect_left(self.buckets, value)] += 1
+        cells[-1] += value
+
+    def _own_samples(self, labels):
+        totals = self._shards.totals()
+        cumulative = 0.0
+        for bound, count in zip(self.buckets + (float('inf'),), totals):
+            cumulative += count
+            yield '_bucket', dict(labels, le=_format_value(bound)), cumulative
+        yield '_sum', labels, totals[-1]
+        yield '_count', labels, cumulative
+
+
+class Registry:
+    """A set of metrics that render together"""
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            if metric.name in self._metrics:
+                raise ValueError(f'metric {metric.name} is already registered')
+            self._metrics[metric.name] = metric
+
+    def get(self, name):
+        return self._metrics.get(name)
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format (0.0.4)"""
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {_escape_help(metric.documentation)}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for suffix, labels, value in metric._samples():
+                lines.append(f'{metric.name}{suffix}{_format_labels(labels)} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape_help(text):
+    return text.replace('\\', '\\\\').replace('\n', '\\n')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    pairs = []
+    for name, value in labels.items():
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+def render():
+    """Render the default registry"""
+    return REGISTRY.render()
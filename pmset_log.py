@@ -0,0 +1,333 @@
+"""Incremental pmset log reading and power event classification.
+
+classify_line() turns one pmset log line into a PowerEvent (or None) with a
+single precompiled pattern instead of lower-casing and substring-testing
+each line a dozen times.
+
+PowerLogStream is the source the monitor races against the lid sensor:
+it keeps one `log stream` process open on powerd's messages for the whole
+armed session and classifies each line as it arrives. Nothing is re-read,
+so an entry costs the same however big the power log has grown, and a
+close reaches the monitor as soon as powerd logs it.
+
+PmsetCommandTailer runs `pmset -g log` and keeps the last entry it saw as
+its cursor, so each poll only returns entries that are new since the
+previous one. pmset has no way to print only those, so every poll still
+forks it and reads the whole log; PmsetEventSource polls a tailer that way
+every MACSENTINEL_PMSET_INTERVAL seconds, for Macs where `log stream`
+doesn't work, and the trace replayer reads a real log with it.
+"""
+import os
+import re
+import subprocess
+import threading
+import time
+from collections import namedtuple
+
+from logs import get_logger
+from process_manager import processes
+
+
+log = get_logger('pmset')
+
+
+CLAMSHELL_CLOSE = 'clamshell_close'
+DISPLAY_SLEEP = 'display_sleep'
+LID_CLOSE = 'lid_close'
+LID_OPEN = 'lid_open'
+WAKE = 'wake'
+
+# Event kinds that mean the lid (probably) just closed
+CLOSE_KINDS = frozenset([CLAMSHELL_CLOSE, DISPLAY_SLEEP, LID_CLOSE])
+
+# kind: one of the constants above
+# stamp: leading "YYYY-MM-DD HH:MM:SS +ZZZZ" of the line, or None
+# line: the raw log line
+PowerEvent = namedtuple('PowerEvent', ['kind', 'stamp', 'line'])
+
+# event: the PowerEvent
+# timestamp: time.monotonic() when the poll that found it finished
+PowerSample = namedtuple('PowerSample', ['event', 'timestamp'])
+
+# Lookahead so overlapping keywords are all found, matching plain substring tests
+_KEYWORDS = re.compile(r'(?=(clamshell|display|sleep|lid|closing|close|open|wake|woke|waking))')
+_STAMP = re.compile(r'^(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d [+-]\d{4})')
+_WAKE_WORDS = frozenset(['wake', 'woke', 'waking'])
+
+
+def classify_line(line):
+    """Classify a pmset log line, returning a PowerEvent or None"""
+    found = set(_KEYWORDS.findall(line.lower()))
+    if not found:
+        return None
+    kind = None
+    # Check for clamshell close events (various patterns)
+    if ('clamshell' in found and ('close' in found or 'closing' in found)
+            and 'open' not in found and 'wake' not in found):
+        kind = CLAMSHELL_CLOSE
+    # "Entering Sleep state due to 'Clamshell Sleep'" - how pmset logs a lid close
+    elif 'clamshell' in found and 'sleep' in found and not (found & _WAKE_WORDS):
+        kind = CLAMSHELL_CLOSE
+    # Check for display sleep (which happens when lid closes)
+    elif 'display' in found and 'sleep' in found and not (found & _WAKE_WORDS):
+        kind = DISPLAY_SLEEP
+    # Check for lid-related events
+    elif 'lid' in found and 'close' in found and 'open' not in found and 'wake' not in found:
+        kind = LID_CLOSE
+    elif ('clamshell' in found or 'lid' in found) and 'open' in found:
+        kind = LID_OPEN
+    elif found & _WAKE_WORDS:
+        kind = WAKE
+    if kind is None:
+        return None
+    match = _STAMP.match(line)
+    return PowerEvent(kind, match.group(1) if match else None, line)
+
+
+def classify_lines(lines):
+    """Classify many lines, returning only the ones that are power events"""
+    return [event for event in map(classify_line, lines) if event is not None]
+
+
+def race_interval(environ=None):
+    """Seconds between pmset polls while armed (MACSENTINEL_PMSET_INTERVAL); 0, the default, is off"""
+    environ = os.environ if environ is None else environ
+    try:
+        return max(0.0, float(environ.get('MACSENTINEL_PMSET_INTERVAL', 0)))
+    except ValueError:
+        return 0.0
+
+
+# powerd's own messages, and the kernel's power management lines about the lid
+POWER_LOG_PREDICATE = ('process == "powerd" OR '
+                       '(process == "kernel" AND eventMessage CONTAINS[c] "clamshell")')
+POWER_LOG_COMMAND = ('log', 'stream', '--style', 'syslog', '--predicate', POWER_LOG_PREDICATE)
+# What `log stream` prints before the first entry
+_STREAM_HEADERS = (b'Filtering the log data', b'Timestamp')
+
+
+class PowerLogStream:
+    """Keeps `log stream` open on powerd and hands each new power event to a callback
+
+    Same surface as PmsetEventSource. If the stream exits while running it
+    is started again, after restart_delay doubling up to a minute; if the
+    command doesn't exist the source gives up and says so once.
+    """
+
+    name = 'powerd'
+
+    def __init__(self, callback, command=POWER_LOG_COMMAND, restart_delay=1.0):
+        self.callback = callback
+        self.command = list(command)
+        self.restart_delay = restart_delay
+        self.lines = 0
+        self.events = 0
+        self.restarts = 0
+        self.available = None  # False once the command turned out to be missing
+        self._lock = threading.Lock()
+        self._stop_event = None
+        self._process = None
+        self._thread = None
+
+    def start(self):
+        self.stop()
+        # Each run has its own stop event, so a run stop(wait=False) left
+        # behind can't be revived by the next start()
+        stop_event = self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(stop_event,), daemon=True,
+                                        name='power-log-stream')
+        self._thread.start()
+
+    def stop(self, wait=True):
+        with self._lock:
+            if self._stop_event is not None:
+                self._stop_event.set()
+            process = self._process
+        if process is not None:
+            # Ends the stream, which wakes the reader out of readline()
+            process.kill()
+        thread, self._thread = self._thread, None
+        if thread is not None and wait and thread is not threading.current_thread():
+            thread.join(timeout=1)
+
+    def _spawn(self, stop_event):
+        process = processes.spawn(self.command, essential=True, group=False,
+                                  stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        with self._lock:
+            if stop_event.is_set():
+                process.kill()
+            else:
+                self._process = process
+        return process
+
+    def _run(self, stop_event):
+        delay = self.restart_delay
+        while not stop_event.is_set():
+            try:
+                process = self._spawn(stop_event)
+            except FileNotFoundError:
+                self.available = False
+                log.info('log stream unavailable, pmset events are not raced', command=self.command[0])
+                return
+            except Exception as e:
+                log.warning('Could not start log stream', error=str(e))
+            else:
+                self.available = True
+                if self._read(process, stop_event):
+                    delay = self.restart_delay
+                with self._lock:
+                    if self._process is process:
+                        self._process = None
+                process.stdout.close()
+                if process.poll() is None:
+                    process.kill()
+                returncode = processes.wait(process)
+                if stop_event.is_set():
+                    return
+                log.warning('log stream exited, restarting', returncode=returncode, delay=delay)
+                self.restarts += 1
+            stop_event.wait(delay)
+            delay = min(delay * 2, 60.0)
+
+    def _read(self, process, stop_event):
+        """Classify lines until the stream ends; True if any arrived"""
+        got_lines = False
+        for raw in iter(process.stdout.readline, b''):
+            if stop_event.is_set():
+                break
+            got_lines = True
+            if raw.startswith(_STREAM_HEADERS):
+                continue
+            self.lines += 1
+            event = classify_line(raw.rstrip(b'\n').decode('utf-8', 'replace'))
+            if event is not None:
+                self.events += 1
+                self.callback(PowerSample(event, time.monotonic()))
+        return got_lines
+
+    def stats(self):
+        with self._lock:
+            process = self._process
+        return {
+            'source': self.name,
+            'running': process is not None,
+            'lines': self.lines,
+            'events': self.events,
+            'restarts': self.restarts,
+        }
+
+
+class PmsetCommandTailer:
+    """Runs `pmset -g log` and returns only entries after the last one seen"""
+
+    def __init__(self, command=('pmset', '-g', 'log'), timeout=5):
+        self.command = list(command)
+        self.timeout = timeout
+        self.cursor = None  # last complete line seen, as bytes
+
+    def read_lines(self):
+        """Return log lines newer than the cursor"""
+        try:
+            result = processes.run(self.command, timeout=self.timeout)
+        except Exception as e:
+            log.warning('Error reading pmset log', error=str(e))
+            return []
+        if result.returncode != 0:
+            log.warning('pmset command failed', returncode=result.returncode)
+            return []
+        return self.feed(result.stdout)
+
+    def feed(self, output):
+        """Take a full `pmset -g log` output (bytes); return lines newer than the cursor"""
+        data = output.rstrip(b'\n')
+        last_break = data.rfind(b'\n')
+        last_line = data[last_break + 1:]
+        cursor, self.cursor = self.cursor, last_line
+        if cursor is None or not data:
+            # First poll only sets the cursor
+            return []
+        pos = data.rfind(b'\n' + cursor)
+        if pos != -1:
+            start = pos + 1 + len(cursor) + 1
+        elif data.startswith(cursor):
+            start = len(cursor) + 1
+        else:
+            start = self._find_start_by_stamp(data, cursor)
+        if start >= len(data):
+            return []
+        return data[start:].decode('utf-8', 'replace').split('\n')
+
+    @staticmethod
+    def _find_start_by_stamp(data, cursor):
+        """Cursor line is gone (log rolled over): keep entries stamped after it"""
+        match = _STAMP.match(cursor.decode('utf-8', 'replace'))
+        if not match:
+            return 0
+        cursor_stamp = match.group(1)
+        end = len(data)
+        while end > 0:
+            start = data.rfind(b'\n', 0, end) + 1
+            line_match = _STAMP.match(data[start:end].decode('utf-8', 'replace'))
+            if line_match and line_match.group(1) <= cursor_stamp:
+                return end + 1
+            end = start - 1
+        return 0
+
+    def poll(self):
+        """Return PowerEvents for entries logged since the previous call"""
+        return classify_lines(self.read_lines())
+
+
+class PmsetEventSource:
+    """Polls pmset for new power events in a background thread"""
+
+    name = 'pmset'
+
+    def __init__(self, callback, interval=5.0, tailer=None):
+        self.callback = callback
+        self.interval = interval
+        self.tailer = tailer or PmsetCommandTailer()
+        self.polls = 0
+        self.events = 0
+        self.total_cost = 0.0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.stop()
+        # Per run, as in PowerLogStream
+        stop_event = self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(stop_event,), daemon=True,
+                                        name='pmset-events')
+        self._thread.start()
+
+    def stop(self, wait=True):
+        self._stop_event.set()
+        if self._thread is not None:
+            if wait:
+                self._thread.join(timeout=1)
+            self._thread = None
+
+    def _run(self, stop_event):
+        # The first poll only sets the tailer's cursor - it doubles as the check that pmset works
+        while not stop_event.is_set():
+            started = time.monotonic()
+            events = self.tailer.poll()
+            now = time.monotonic()
+            self.polls += 1
+            self.total_cost += now - started
+            for event in events:
+                if stop_event.is_set():
+                    return
+                self.events += 1
+                self.callback(PowerSample(event, now))
+            stop_event.wait(self.interval)
+
+    def stats(self):
+        return {
+            'source': self.name,
+            'interval': self.interval,
+            'polls': self.polls,
+            'events': self.events,
+            'mean_poll_cost_ms': (self.total_cost / self.polls * 1000) if self.polls else None,
+        }
@@ -0,0 +1,246 @@
+"""Child process management for macOS helper commands.
+
+Every helper (afplay, osascript, ioreg, pmset, ...) is started through the
+shared `processes` ProcessManager, which:
+  - puts the long-lived ones it spawn()s (the alarm player, backup beeps)
+    in one process group, so teardown is a single killpg()
+  - gives each short one that run()/run_until() waits for (probes, lid and
+    pmset reads, volume) a group of its own: they end by themselves or at
+    their timeout, and a disarm's killpg() doesn't cut them short
+  - reaps finished group members in a background thread (no zombies) that
+    blocks in waitid() until one exits, instead of polling
+  - caps how many optional helpers run at once
+  - counts spawns per command
+"""
+import os
+import select
+import signal
+import subprocess
+import sys
+import threading
+import time
+from collections import Counter
+
+from logs import get_logger
+import metrics
+
+
+log = get_logger('process_manager')
+
+
+SPAWNS = metrics.Counter('macsentinel_spawns_total', 'Helper processes started, by command',
+                         ['command'])
+
+
+class ProbeInterrupted(Exception):
+    """A probe's helper was killed by a signal from outside, so its output is no answer"""
+
+
+class ProcessManager:
+    """Launches helpers in one process group and reaps them in the background"""
+
+    def __init__(self, max_children=8, reap_interval=0.5):
+        self.max_children = max_children
+        # Only where os.waitid() is missing; otherwise the reaper sleeps until a child exits
+        self.reap_interval = reap_interval
+        self.pgid = None
+        self.spawn_counts = Counter()
+        self.rejected = 0
+        self.reaped = 0
+        self._children = set()
+        self._grouped = set()  # The ones in pgid, which terminate_all() signals
+        self._cond = threading.Condition()
+        self._reaper = None
+
+    def _popen_in_group(self, argv, **kwargs):
+        """Start argv in our process group, creating the group if needed"""
+        pgid = self.pgid
+        if pgid is not None:
+            try:
+                return subprocess.Popen(argv, **kwargs, **self._group_kwargs(pgid))
+            except (OSError, subprocess.SubprocessError):
+                # Every member exited since we last looked - start a new group
+                pass
+        process = subprocess.Popen(argv, **kwargs, **self._group_kwargs(0))
+        self.pgid = process.pid
+        return process
+
+    @staticmethod
+    def _group_kwargs(pgid):
+        if sys.version_info >= (3, 11):
+            return {'process_group': pgid}
+        return {'preexec_fn': lambda: os.setpgid(0, pgid)}
+
+    def spawn(self, argv, essential=False, group=True, **kwargs):
+        """Start a helper; returns the Popen, or None if an optional one was capped
+
+        Essential helpers (the alarm player) are always started. Optional
+        ones (backup beeps) are dropped once max_children are running.
+        group=False starts it in a group of its own, out of reach of
+        terminate_all(), for a caller that waits for it itself (wait()).
+        """
+        kwargs.setdefault('stdin', subprocess.DEVNULL)
+        with self._cond:
+            if not essential and len(self._children) >= self.max_children:
+                self.rejected += 1
+                return None
+            if group:
+                process = self._popen_in_group(argv, **kwargs)
+                self._grouped.add(process)
+                self._ensure_reaper()
+            else:
+                process = subprocess.Popen(argv, **kwargs, **self._group_kwargs(0))
+            self._children.add(process)
+            command = os.path.basename(argv[0])
+            self.spawn_counts[command] += 1
+            SPAWNS.labels(command=command).inc()
+            self._cond.notify_all()
+        return process
+
+    def run(self, argv, timeout=None, text=False):
+        """Like subprocess.run with captured output, in a process group of its own"""
+        process = self.spawn(argv, essential=True, group=False, stdout=subprocess.PIPE,
+                             stderr=subprocess.PIPE, text=text)
+        try:
+            stdout, stderr = process.communicate(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.communicate()
+            raise
+        finally:
+            self._forget(process)
+        return subprocess.CompletedProcess(argv, process.returncode, stdout, stderr)
+
+    def run_until(self, argv, scanner, timeout=None, chunk_size=65536):
+        """Feed a helper's stdout to scanner.feed() as it arrives, until it answers
+
+        Kills the helper as soon as feed() returns something other than None,
+        instead of waiting for the rest of its output. Returns (answer,
+        returncode); returncode is None if the helper was cut short, and the
+        answer is scanner.finish() if it exited first. Raises
+        subprocess.TimeoutExpired like run().
+        """
+        process = self.spawn(argv, essential=True, group=False, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        fd = process.stdout.fileno()
+        try:
+            while True:
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0 or not select.select([fd], [], [], remaining)[0]:
+                        raise subprocess.TimeoutExpired(argv, timeout)
+                chunk = os.read(fd, chunk_size)
+                if not chunk:
+                    break
+                answer = scanner.feed(chunk)
+                if answer is not None:
+                    process.kill()
+                    process.wait()
+                    return answer, None
+            process.wait(timeout=None if deadline is None else max(0.0, deadline - time.monotonic()))
+            return scanner.finish(), process.returncode
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+            raise
+        finally:
+            process.stdout.close()
+            self._forget(process)
+
+    def wait(self, process, timeout=None):
+        """Wait for a helper spawned with group=False to exit, then forget it"""
+        try:
+            return process.wait(timeout=timeout)
+        finally:
+            if process.returncode is not None:
+                self._forget(process)
+
+    def _forget(self, process):
+        with self._cond:
+            if process in self._children:
+                self._children.discard(process)
+                self._grouped.discard(process)
+                self.reaped += 1
+                if not self._grouped:
+                    self.pgid = None
+                self._cond.notify_all()
+
+    def _ensure_reaper(self):
+        if self._reaper is None or not self._reaper.is_alive():
+            self._reaper = threading.Thread(target=self._reap_loop, daemon=True,
+                                             name='process-reaper')
+            self._reaper.start()
+
+    def _reap_loop(self):
+        while True:
+            with self._cond:
+                # Sleep until there is something to reap
+                self._cond.wait_for(lambda: self._grouped)
+                pgid = self.pgid
+            if pgid is not None and hasattr(os, 'waitid'):
+                try:
+                    # Until a member exits; WNOWAIT leaves reaping (and its
+                    # exit status) to Popen, which may be waiting for it too
+                    os.waitid(os.P_PGID, pgid, os.WEXITED | os.WNOWAIT)
+                except ChildProcessError:
+                    pass  # No member left to wait for: someone else reaped them
+            with self._cond:
+                members = list(self._grouped)
+            reaped = False
+            for process in members:
+                if process.poll() is not None:
+                    self._forget(process)
+                    reaped = True
+            if not reaped:
+                # No waitid, or a member exited that we have no Popen for
+                time.sleep(self.reap_interval)
+
+    @property
+    def running(self):
+        with self._cond:
+            return len(self._children)
+
+    def terminate_all(self, timeout=1.0):
+        """SIGTERM the whole group, then SIGKILL whatever is left after timeout
+
+        Only what spawn() put in the group; run() and run_until() helpers
+        finish on their own.
+        """
+        with self._cond:
+            pgid = self.pgid
+            children = list(self._grouped)
+        if pgid is None:
+            return 0
+        self._signal_group(pgid, signal.SIGTERM)
+        deadline = time.monotonic() + timeout
+        for process in children:
+            try:
+                process.wait(timeout=max(0.0, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                self._signal_group(pgid, signal.SIGKILL)
+                process.wait()
+            self._forget(process)
+        return len(children)
+
+    @staticmethod
+    def _signal_group(pgid, sig):
+        try:
+            os.killpg(pgid, sig)
+        except ProcessLookupError:
+            pass
+        except Exception as e:
+            log.warning('Error signalling process group', pgid=pgid, error=str(e))
+
+    def stats(self):
+        with self._cond:
+            return {
+                'running': len(self._children),
+                'pgid': self.pgid,
+                'reaped': self.reaped,
+                'rejected': self.rejected,
+                'spawns': dict(self.spawn_counts),
+            }
+
+
+processes = ProcessManager()
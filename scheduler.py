@@ -0,0 +1,158 @@
+"""Adaptive sampling schedule for the lid monitor.
+
+PollScheduler decides how long to sleep before the next lid sample:
+  - min_interval right after arming and after recent activity (a transition)
+  - slowing down geometrically during quiet periods, up to max_latency, so a
+    lid close is still seen within the detection-latency target
+  - exponential backoff after repeated failed samples (ioreg timeouts)
+
+On top of that a token bucket enforces the wakeups-per-minute budget: bursts
+of fast sampling are allowed while tokens last, and the bucket refills
+slowly enough that no 60 s window ever holds more than the budget. When
+the budget and the latency target conflict (budget pace slower than
+max_latency) the budget wins and stats() reports the latency misses.
+
+Configure with MACSENTINEL_WAKEUPS_PER_MINUTE and MACSENTINEL_MAX_LATENCY_MS.
+"""
+import os
+import time
+from collections import deque
+
+from logs import get_logger
+
+
+log = get_logger('scheduler')
+
+
+def backoff_delay(failures, base, cap):
+    """base * 2**(failures - 1), capped; 0 for no failures"""
+    if failures <= 0:
+        return 0.0
+    return min(cap, base * 2 ** min(failures - 1, 16))
+
+
+class PollScheduler:
+    """Chooses the delay before each sample within a wakeup budget"""
+
+    def __init__(self, min_interval=0.1, max_latency=1.0, wakeups_per_minute=120,
+                 boost_seconds=30.0, quiet_growth=1.5, max_backoff=30.0,
+                 burst=None, clock=time.monotonic):
+        self.min_interval = min_interval
+        self.max_latency = max(max_latency, min_interval)
+        self.wakeups_per_minute = wakeups_per_minute
+        self.boost_seconds = boost_seconds
+        self.quiet_growth = quiet_growth
+        self.max_backoff = max_backoff
+        # Tokens available for bursts above the budget pace
+        self.burst = burst if burst is not None else max(1.0, wakeups_per_minute / 4)
+        self.clock = clock
+        self.reset()
+
+    @property
+    def rate(self):
+        """Token refill rate: a full burst plus a minute of refill fits the budget"""
+        return max(0.0, self.wakeups_per_minute - self.burst) / 60.0
+
+    def reset(self):
+        """Start a new session: sample fast, with a full token bucket"""
+        now = self.clock()
+        self.interval = self.min_interval
+        self.failures = 0
+        self.boost_until = now + self.boost_seconds
+        self._tokens = self.burst
+        self._refilled_at = now
+        self._last_wakeup = None
+        self._recent = deque()
+        self.wakeups = 0
+        self.max_gap = 0.0
+        self.latency_misses = 0
+        self.budget_delays = 0
+
+    def boost(self):
+        """Sample at min_interval for the next boost_seconds (recent activity)"""
+        self.boost_until = self.clock() + self.boost_seconds
+        self.interval = self.min_interval
+
+    def _take_token(self, now):
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.rate)
+        self._refilled_at = now
+        self._tokens -= 1
+
+    def next_delay(self, changed=False, failed=False, cost=0.0):
+        """Record a sample that just finished and return the delay until the next
+
+        changed: the sample saw a transition (activity - speed up)
+        failed: the sample couldn't read the lid (timeout/error - back off)
+        cost: seconds the sample took; the gap between sample starts is what
+        bounds detection latency, so it is taken off the delay
+        """
+        now = self.clock()
+        started = now - cost
+        if self._last_wakeup is not None:
+            gap = started - self._last_wakeup
+            self.max_gap = max(self.max_gap, gap)
+            if gap > self.max_latency * 1.05:  # allow for timer slack
+                self.latency_misses += 1
+        self._last_wakeup = started
+        self.wakeups += 1
+        self._recent.append(now)
+        while self._recent[0] <= now - 60:
+            self._recent.popleft()
+        self._take_token(now)
+
+        if changed:
+            self.boost()
+        if failed:
+            self.failures += 1
+        else:
+            self.failures = 0
+
+        if now < self.boost_until:
+            self.interval = self.min_interval
+        else:
+            self.interval = min(self.max_latency, self.interval * self.quiet_growth)
+        delay = max(0.0, self.interval - cost)
+        if self.failures > 1:
+            # ioreg keeps timing out: don't pile more forks onto a busy system
+            delay = max(delay, backoff_delay(self.failures - 1, self.min_interval * 2,
+                                             self.max_backoff))
+        if self._tokens < 1 and self.rate > 0:
+            # Out of budget: wait for the next token
+            budget_delay = (1 - self._tokens) / self.rate
+            if budget_delay > delay:
+                self.budget_delays += 1
+                delay = budget_delay
+        return delay
+
+    def stats(self):
+        """Current interval and how well the budget and latency target are met"""
+        now = self.clock()
+        recent = sum(1 for t in list(self._recent) if t > now - 60)
+        return {
+            'interval_ms': self.interval * 1000,
+            'boosted': now < self.boost_until,
+            'consecutive_failures': self.failures,
+            'wakeups': self.wakeups,
+            'wakeups_last_minute': recent,
+            'wakeups_per_minute_budget': self.wakeups_per_minute,
+            'budget_met': recent <= self.wakeups_per_minute,
+            'budget_delays': self.budget_delays,
+            'max_latency_target_ms': self.max_latency * 1000,
+            'max_gap_ms': self.max_gap * 1000,
+            'latency_misses': self.latency_misses,
+            'latency_target_met': self.latency_misses == 0,
+        }
+
+
+def create_scheduler(min_interval, clock=time.monotonic):
+    """PollScheduler configured from MACSENTINEL_WAKEUPS_PER_MINUTE/_MAX_LATENCY_MS"""
+    kwargs = {}
+    try:
+        if os.environ.get('MACSENTINEL_WAKEUPS_PER_MINUTE'):
+            kwargs['wakeups_per_minute'] = float(os.environ['MACSENTINEL_WAKEUPS_PER_MINUTE'])
+        if os.environ.get('MACSENTINEL_MAX_LATENCY_MS'):
+            kwargs['max_latency'] = float(os.environ['MACSENTINEL_MAX_LATENCY_MS']) / 1000
+    except ValueError as e:
+        log.warning('Invalid polling budget setting, using defaults', error=str(e))
+        kwargs = {}
+    return PollScheduler(min_interval=min_interval, clock=clock, **kwargs)
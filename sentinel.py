@@ -0,0 +1,408 @@
+"""Sentinel core: arming state machine, lid monitoring and alarm control.
+
+SentinelState is the single source of truth for DISARMED/ARMING/ARMED/
+ALARMING. Transitions happen under one Condition, so waiters wake the moment
+the state changes instead of sleep-polling a flag. Every arm starts a new
+generation; work that belongs to an older generation (a trigger that was
+already in flight when the user disarmed) is refused.
+"""
+import os
+import subprocess
+import threading
+import time
+
+import events
+import metrics
+from alarm import AudioWorker, create_audio_backend, resolve_alarm_sound
+from capabilities import capabilities
+from detector import CLOSED, INITIALIZED, POWER_CLOSE, RacingDetector
+from events import EventBroadcaster
+from lid_sensor import create_lid_source
+from logs import get_logger
+from pmset_log import PmsetEventSource, PowerLogStream, PowerSample, race_interval
+from process_manager import processes
+from scheduler import backoff_delay
+
+
+log = get_logger('sentinel')
+
+DISARMED = 'disarmed'
+ARMING = 'arming'
+ARMED = 'armed'
+ALARMING = 'alarming'
+
+TRIGGER_LATENCY = metrics.Histogram('macsentinel_trigger_latency_seconds',
+                                    'Time from lid close detection to alarm playback starting')
+
+
+class SentinelState:
+    """Thread-safe DISARMED/ARMING/ARMED/ALARMING state machine"""
+
+    _ALLOWED = {
+        DISARMED: (ARMING,),
+        ARMING: (ARMED, ALARMING, DISARMED),
+        ARMED: (ALARMING, DISARMED),
+        ALARMING: (ARMED, DISARMED),
+    }
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._state = DISARMED
+        self.generation = 0
+        # Set while disarmed, so monitor threads can wait on it instead of sleeping
+        self.disarmed = threading.Event()
+        self.disarmed.set()
+
+    @property
+    def state(self):
+        return self._state
+
+    @property
+    def armed(self):
+        return self._state != DISARMED
+
+    def transition(self, to, generation=None, expected=None):
+        """Move to state `to` if allowed; returns False if it isn't
+
+        With generation set, the transition only happens if no arm/disarm
+        has happened since that generation started. With expected set, it
+        only happens from that state.
+        """
+        with self._cond:
+            if generation is not None and generation != self.generation:
+                return False
+            if expected is not None and self._state != expected:
+                return False
+            if to not in self._ALLOWED[self._state]:
+                return False
+            self._state = to
+            if to == ARMING:
+                self.generation += 1
+            if to == DISARMED:
+                self.disarmed.set()
+            else:
+                self.disarmed.clear()
+            self._cond.notify_all()
+            return True
+
+    def is_current(self, generation, *states):
+        """True if still in generation and in one of states"""
+        with self._cond:
+            return self.generation == generation and self._state in states
+
+    def call_if_current(self, generation, states, function):
+        """Call function() under the state lock if still in generation and in one of states
+
+        Returns whether it was called: a disarm can't slip in between the
+        check and the call.
+        """
+        with self._cond:
+            if self.generation != generation or self._state not in states:
+                return False
+            function()
+            return True
+
+    def wait_for(self, *states, timeout=None):
+        """Block until the state is one of states; returns False on timeout"""
+        with self._cond:
+            return self._cond.wait_for(lambda: self._state in states, timeout)
+
+
+class Sentinel:
+    """Owns the lid monitor and the alarm, driven by SentinelState"""
+
+    def __init__(self, broadcaster=None):
+        self.state = SentinelState()
+        self.broadcaster = broadcaster or EventBroadcaster()
+        self.lid_source = None
+        self.power_source = None
+        self.detector = None
+        self.monitor_thread = None
+        self.last_trigger_latency = None
+        self.alarm_sound = resolve_alarm_sound()
+        self.audio_worker = None
+        # Loading the playback backend (AppKit, for NSSound) is the slowest part
+        # of startup, so it happens in the background; a trigger waits for it
+        self.audio_loaded = threading.Event()
+        threading.Thread(target=self._load_audio, name='audio-loader', daemon=True).start()
+
+    def _load_audio(self):
+        try:
+            backend = create_audio_backend(self.alarm_sound)
+            if backend is not None:
+                self.audio_worker = AudioWorker(backend)
+                log.info('Alarm sound loaded', path=self.alarm_sound, playback=backend.name)
+        except Exception as e:
+            log.error('Could not load alarm sound', error=str(e))
+        finally:
+            self.audio_loaded.set()
+
+    @property
+    def armed(self):
+        return self.state.armed
+
+    def _publish(self, kind, **data):
+        self.broadcaster.publish(kind, armed=self.state.armed, state=self.state.state, **data)
+
+    # Arming
+
+    def arm(self):
+        """Arm and start monitoring in the background; returns immediately"""
+        if not self.state.transition(ARMING):
+            return False  # Already armed
+        generation = self.state.generation
+        self._publish(events.ARMED)
+        # Start setup in background thread to respond immediately
+        threading.Thread(target=self._arm_background, args=(generation,), name='sentinel-arm',
+                         daemon=True).start()
+        return True
+
+    def _arm_background(self, generation):
+        """Background function to start power monitoring"""
+        try:
+            if self.start_power_monitoring(generation):
+                # Not from ALARMING: a close seen while arming keeps its alarm
+                self.state.transition(ARMED, generation=generation, expected=ARMING)
+        except Exception:
+            log.exception('Error in background arm setup')
+
+    def disarm(self):
+        """Disarm, stop the alarm and let the monitor exit; does not block on threads"""
+        was_armed = self.state.transition(DISARMED)
+        if was_armed:
+            self._publish(events.DISARMED)
+        self.stop_alarm()
+        self.stop_power_monitoring(wait=False)
+        # Reset alarm trigger state when disarming
+        log.info('System disarmed - resetting all detection states')
+        return was_armed
+
+    # Alarm
+
+    def _alarm_side_effects(self):
+        """Backup beep, run alongside the first playback"""
+        # Also try to use system beep as backup (works even with lid closed on some Macs)
+        # This will run in parallel and might work when the main playback doesn't
+        try:
+            processes.spawn(['osascript', '-e', 'beep'],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except Exception:
+            pass  # Beep is optional
+
+        # Note: macOS disables built-in speakers when lid is closed (hardware limitation)
+        log.info('macOS disables built-in speakers when the lid closes: the alarm plays, '
+                 'but is only heard with the lid open or on an external audio device')
+
+    def trigger_alarm(self, detected_at=None, generation=None):
+        """Start playing alarm sound at maximum volume
+
+        detected_at is the time.monotonic() at which the trigger condition
+        was seen; the time from then until playback starts is recorded in
+        last_trigger_latency. Triggers from the monitor pass the generation
+        they were armed in, so a trigger racing a disarm is dropped.
+        """
+        if detected_at is None:
+            detected_at = time.monotonic()
+
+        if generation is not None:
+            if not self.state.transition(ALARMING, generation=generation):
+                return False
+        else:
+            # Manual test alarm: counts as alarming only while armed
+            generation = self.state.generation
+            self.state.transition(ALARMING)
+
+        self.audio_loaded.wait(timeout=5)
+        worker = self.audio_worker
+        if worker is None:
+            log.error('No alarm playback available (see startup messages)')
+            self._publish(events.FAILURE, source='alarm', error='no alarm playback available')
+            return False
+
+        alarming = self.state.is_current(generation, ALARMING)
+        if alarming and worker.keep_looping():
+            pass  # A test alarm was playing once; it now loops until disarmed
+        elif worker.is_playing:
+            # Already alarming - the worker keeps it going
+            return True
+        else:
+            try:
+                # Loop until disarmed; a test alarm while disarmed plays once
+                worker.start(loop=alarming)
+            except Exception as e:
+                log.error('Failed to start alarm process', error=str(e))
+                self._publish(events.FAILURE, source='alarm', error=str(e))
+                return False
+        self.last_trigger_latency = time.monotonic() - detected_at
+        TRIGGER_LATENCY.observe(self.last_trigger_latency)
+
+        if alarming and not self.state.is_current(generation, ALARMING):
+            # Disarmed while we were starting playback
+            self.stop_alarm()
+            return False
+
+        # The worker raises the volume right away; the backup beep runs alongside
+        threading.Thread(target=self._alarm_side_effects, daemon=True).start()
+
+        log.info('Alarm started', playback=worker.backend.name, path=self.alarm_sound,
+                 latency_ms=round(self.last_trigger_latency * 1000, 1))
+        self._publish(events.ALARM_STARTED, latency_ms=self.last_trigger_latency * 1000)
+        return True
+
+    def stop_alarm(self):
+        """Stop playing alarm sound"""
+        worker = self.audio_worker
+        was_alarming = worker is not None and worker.is_playing
+
+        # Stop the worker (and the player it owns)
+        if worker is not None:
+            worker.stop()
+
+        # Kill the alarm helpers (backup beeps, stray players) with one group signal;
+        # probes and lid reads run in groups of their own and finish by themselves
+        killed = processes.terminate_all()
+        if killed:
+            log.info('Stopped helper processes', count=killed)
+
+        if worker is not None:
+            worker.join()
+
+        log.info('Alarm fully stopped')
+        if was_alarming:
+            self._publish(events.ALARM_STOPPED)
+
+    # Monitoring
+
+    def power_monitor_loop(self, generation, lid_source, detector):
+        """Background thread that races lid sensor transitions against pmset events"""
+        errors = 0
+
+        while self.state.is_current(generation, ARMING, ARMED, ALARMING):
+            try:
+                # Wait for the lid source to push a transition (or be woken by stop)
+                sample = lid_source.read(timeout=5)
+                errors = 0
+                if sample is None:
+                    continue
+                if isinstance(sample, PowerSample):
+                    if detector.observe_power_event(sample.event, sample.timestamp) == POWER_CLOSE:
+                        self._publish(events.LID, closed=True, source='pmset')
+                        log.warning('LID CLOSE DETECTED BY PMSET - TRIGGERING ALARM', line=sample.event.line[:100])
+                        self.trigger_alarm(detected_at=sample.timestamp, generation=generation)
+                    continue
+                decision = detector.observe_lid(sample.closed, sample.timestamp)
+                if decision is None:
+                    continue
+                if decision == INITIALIZED:
+                    log.info('Monitoring initialized', lid='closed' if sample.closed else 'open')
+                    continue
+
+                self._publish(events.LID, closed=sample.closed, latency_ms=sample.latency * 1000,
+                              source=lid_source.name)
+                if decision == CLOSED:
+                    log.warning('LID CLOSE DETECTED - TRIGGERING ALARM',
+                                sensor_latency_ms=round(sample.latency * 1000))
+                    self.trigger_alarm(detected_at=sample.timestamp, generation=generation)
+
+            except Exception as e:
+                log.exception('Error in power monitor loop')
+                # Back off (0.25 s, doubling up to 5 s), but wake immediately on disarm
+                errors += 1
+                if errors == 1:
+                    self._publish(events.FAILURE, source='monitor', error=str(e))
+                self.state.disarmed.wait(backoff_delay(errors, 0.25, 5.0))
+
+    def start_power_monitoring(self, generation):
+        """Start the power monitoring thread for this arm generation
+
+        Returns False, with nothing left running, if the generation was
+        disarmed while the sources were starting.
+        """
+        self.stop_power_monitoring()
+
+        # Reset any alarm trigger state when starting fresh
+        log.info('Starting fresh power monitoring session')
+
+        # A fresh source per session, so a stale monitor can't steal its samples.
+        # The startup probes already know which sensor works; no trial runs here.
+        spec = os.environ.get('MACSENTINEL_LID_SOURCE') or capabilities.preferred_lid_source()
+        lid_source = create_lid_source(spec)
+        log.info('Using lid sensor', source=lid_source.name)
+        lid_source.start()
+        detector = RacingDetector(sensor=lid_source.name)
+
+        # powerd's log races the sensor; its events go through the same queue.
+        # Streamed unless MACSENTINEL_PMSET_INTERVAL asks for polling pmset instead;
+        # skipped when the startup probe found that source broken.
+        power_source = None
+        interval = race_interval()
+        if os.environ.get('MACSENTINEL_POWER_LOG', 'stream') == 'off':
+            pass
+        elif interval > 0:
+            if capabilities.usable('pmset_log') is False:
+                log.info('pmset log unavailable (see /api/capabilities), using the lid sensor alone')
+            else:
+                power_source = PmsetEventSource(lid_source.push, interval=interval)
+        elif capabilities.usable('power_log') is False:
+            log.info('log stream unavailable (see /api/capabilities), using the lid sensor alone')
+        else:
+            power_source = PowerLogStream(lid_source.push)
+        if power_source is not None:
+            power_source.start()
+
+        monitor_thread = threading.Thread(
+            target=self.power_monitor_loop, args=(generation, lid_source, detector), daemon=True)
+
+        def install():
+            # Under the state lock: a disarm either comes after this and stops
+            # these sources, or came before and they are stopped below
+            self.lid_source, self.power_source = lid_source, power_source
+            self.detector, self.monitor_thread = detector, monitor_thread
+            monitor_thread.start()
+
+        if not self.state.call_if_current(generation, (ARMING, ALARMING), install):
+            # On the arm thread, so nothing is waiting for this
+            if power_source is not None:
+                power_source.stop()
+            lid_source.stop()
+            log.info('Disarmed while arming - monitoring not started')
+            return False
+        log.info('Power monitoring started - watching for lid close events')
+        return True
+
+    def stop_power_monitoring(self, wait=True):
+        """Stop the lid source and let the monitor thread exit"""
+        lid_source, monitor_thread = self.lid_source, self.monitor_thread
+        power_source, self.power_source = self.power_source, None
+        if power_source is not None:
+            power_source.stop(wait=wait)
+        if lid_source is not None:
+            # Also wakes the monitor thread out of read()
+            lid_source.stop(wait=wait)
+        if monitor_thread is not None:
+            if wait:
+                monitor_thread.join(timeout=2)
+            self.monitor_thread = None
+            log.info('Power monitoring stopped',
+                     sensor=lid_source.stats() if lid_source is not None else None)
+
+    def cleanup(self):
+        """Called when the app exits"""
+        self.state.transition(DISARMED)
+        self.stop_alarm()
+        self.stop_power_monitoring()
+
+    def status(self):
+        response = {'armed': self.state.armed, 'state': self.state.state}
+        if self.lid_source is not None:
+            response['sensor'] = self.lid_source.stats()
+        if self.power_source is not None:
+            response['power_log'] = self.power_source.stats()
+        if self.detector is not None:
+            response['race'] = self.detector.stats()
+        if self.audio_worker is not None:
+            response['audio'] = self.audio_worker.stats()
+        response['processes'] = processes.stats()
+        if self.last_trigger_latency is not None:
+            response['trigger_latency_ms'] = self.last_trigger_latency * 1000
+        return response
@@ -113,7 +113,50 @@ function disarm() {
     });
 }
 
+// Fallback polling, only used while the event stream is down
+let pollTimer = null;
+
+function startPolling() {
+    if (pollTimer === null) {
+        updateStatus();
+        pollTimer = setInterval(updateStatus, 3000);
+    }
+}
+
+function stopPolling() {
+    if (pollTimer !== null) {
+        clearInterval(pollTimer);
+        pollTimer = null;
+    }
+}
+
+// function to subscribe to pushed state changes
+function connectEvents() {
+    if (!window.EventSource) {
+        startPolling();
+        return;
+    }
+
+    const source = new EventSource('/api/events');
+    const kinds = ['state', 'armed', 'disarmed', 'lid', 'alarm_started', 'alarm_stopped'];
+
+    kinds.forEach(kind => {
+        source.addEventListener(kind, event => {
+            const data = JSON.parse(event.data);
+            updateUI(data.armed);
+        });
+    });
+
+    source.onopen = () => {
+        stopPolling();
+    };
+
+    source.onerror = () => {
+        // EventSource keeps retrying on its own; poll until it reconnects
+        startPolling();
+    };
+}
+
 // Initialize on page load
 updateStatus();
-// Reduce polling frequency to every 3 seconds (less frequent updates)
-setInterval(updateStatus, 3000);
+connectEvents();
@@ -0,0 +1,7 @@
+import os
+import sys
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+# fakemac.py: stand-in macOS commands and synthetic ioreg output
+sys.path.insert(1, os.path.join(ROOT, 'benchmarks'))
@@ -0,0 +1,81 @@
+"""Volume enforcement runs beside playback, not in its loop"""
+import os
+import threading
+import time
+
+from alarm import AudioWorker, SinkBackend
+
+
+def test_hung_osascript_does_not_stall_playback(monkeypatch, tmp_path):
+    osascript = tmp_path / 'osascript'
+    osascript.write_text('#!/bin/sh\nexec sleep 30\n')
+    osascript.chmod(0o755)
+    monkeypatch.setenv('PATH', f"{tmp_path}{os.pathsep}{os.environ['PATH']}")
+    sound = tmp_path / 'alarm.mp3'
+    sound.write_bytes(b'\0' * 64)
+
+    worker = AudioWorker(SinkBackend(str(sound), duration=0.02), volume_interval=0.05)
+    worker.volume.timeout = 0.3
+    worker.start()
+    time.sleep(0.5)
+    loops = worker.loops
+    worker.stop()
+    worker.join()
+
+    # Each loop takes 20 ms; stuck behind osascript there would be one
+    assert loops >= 10
+    # The hung osascript was killed at its timeout and enforcement carried on
+    assert worker.volume.enforcements >= 2
+    deadline = time.monotonic() + 2
+    while any(t.name == 'volume-enforcer' for t in threading.enumerate()):
+        assert time.monotonic() < deadline
+        time.sleep(0.05)
+
+
+class HangingBackend:
+    """The first wait() hangs until released, ignoring stop(), like a wedged player"""
+
+    name = 'hanging'
+    spawns = 0
+
+    def __init__(self):
+        self.plays = 0
+        self.release = threading.Event()
+        self.waits = 0
+
+    def play(self, loop):
+        self.plays += 1
+
+    def wait(self, timeout):
+        self.waits += 1
+        if self.waits == 1:
+            self.release.wait(5)
+            return True
+        time.sleep(timeout)
+        return False
+
+    def stop(self):
+        pass
+
+
+def test_restart_after_join_timeout_does_not_revive_the_old_thread():
+    backend = HangingBackend()
+    worker = AudioWorker(backend, volume_interval=60)
+    worker.volume.start = threading.Event  # No osascript here
+    worker.start()
+    time.sleep(0.05)
+    worker.stop()
+    worker.join(timeout=0.1)
+    # Still running, so still the worker's thread
+    assert worker._thread is not None and worker._thread.is_alive()
+    assert not worker.is_playing
+
+    assert worker.start()
+    backend.release.set()
+    time.sleep(0.3)
+    # The old thread woke up stopped and left; only the new run played
+    assert backend.plays == 2
+    assert [t.name for t in threading.enumerate()].count('audio-worker') == 1
+    worker.stop()
+    worker.join(timeout=2)
+    assert worker._thread is None
@@ -0,0 +1,175 @@
+"""Lid state parsing and ClamshellProbe strategy selection and re-checks"""
+import random
+import subprocess
+import time
+
+import pytest
+
+from clamshell import (BASELINE, ClamshellProbe, ClamshellScanner, IoregStrategy,
+                       default_strategies, find_clamshell_state)
+from fakemac import FakeMac, ioreg_dump, ioreg_fixtures
+from process_manager import ProbeInterrupted
+
+
+DUMP_SIZE = 64 * 1024
+
+
+@pytest.mark.parametrize('name, dump, expected', ioreg_fixtures(DUMP_SIZE),
+                         ids=[name for name, _, _ in ioreg_fixtures(0)])
+def test_find_clamshell_state(name, dump, expected):
+    data = dump.encode()
+    assert find_clamshell_state(data) is expected
+    assert find_clamshell_state(dump) is expected
+
+    # Fed in chunks, as the streaming strategy reads it
+    rng = random.Random(name)
+    for _ in range(20):
+        scanner = ClamshellScanner()
+        answer = None
+        position = 0
+        while answer is None and position < len(data):
+            size = rng.choice((1, 7, 19, 4096, 65536))
+            answer = scanner.feed(data[position:position + size])
+            position += size
+        if answer is None:
+            answer = scanner.finish()
+        assert answer is expected
+
+
+class FakeStrategy:
+    """Answers from a list; an exception instance in it is raised instead"""
+
+    native = False
+    stream = False
+    argv = None
+
+    def __init__(self, name, answers, cost=0.01):
+        self.name = name
+        self.answers = answers
+        self.cost = cost
+        self.calls = 0
+
+    def sample(self, timeout):
+        answer = self.answers[min(self.calls, len(self.answers) - 1)]
+        self.calls += 1
+        if isinstance(answer, Exception):
+            raise answer
+        return answer
+
+
+def make_probe(*strategies):
+    names = {strategy.name: strategy for strategy in strategies}
+    clock_now = [0.0]
+
+    def clock():
+        return clock_now[0]
+
+    for strategy in strategies:
+        sample = strategy.sample
+
+        def timed(timeout, sample=sample, cost=strategy.cost):
+            clock_now[0] += cost
+            return sample(timeout)
+        strategy.sample = timed
+    probe = ClamshellProbe(list(names.values()), rounds=3, clock=clock)
+    return probe
+
+
+def wait_for_selections(probe, count):
+    deadline = time.monotonic() + 5
+    while probe.selections < count:
+        assert time.monotonic() < deadline, 'background selection did not run'
+        time.sleep(0.01)
+
+
+def test_select_ranks_correct_strategies_fastest_first():
+    probe = make_probe(FakeStrategy('slow', [True], cost=0.05),
+                       FakeStrategy('fast', [True], cost=0.01),
+                       FakeStrategy('wrong', [False], cost=0.001),
+                       FakeStrategy('timeout', [subprocess.TimeoutExpired('x', 1)]),
+                       FakeStrategy(BASELINE, [True], cost=0.1))
+    report = probe.select()
+    assert report['ranking'] == ['fast', 'slow', BASELINE]
+    assert report['results']['timeout']['error'] == 'timeout'
+    assert not report['results']['wrong']['correct']
+
+
+def test_failing_strategy_is_dropped_and_reselected():
+    fast = FakeStrategy('fast', [True] * 3 + [None] * 3 + [True])
+    probe = make_probe(fast, FakeStrategy(BASELINE, [True], cost=0.1))
+    probe.select()
+    assert probe.strategy().name == 'fast'
+    for _ in range(probe.recheck_after):
+        assert probe.sample() is None
+    assert probe.rechecks == 1
+    wait_for_selections(probe, 2)
+    # Working again by the time it was re-checked
+    assert probe.strategy().name == 'fast'
+
+
+def test_fallback_failures_reselect_an_empty_ranking():
+    # Nothing worked at startup (say ioreg was busy), so sample() uses the fallback
+    baseline = FakeStrategy(BASELINE, [None] * 9 + [True])
+    probe = make_probe(baseline)
+    probe.select()
+    assert probe.ranking == []
+    # Twice the failures: that selection already found nothing
+    for _ in range(probe.recheck_after * 2):
+        assert probe.sample() is None
+    wait_for_selections(probe, 2)
+    assert probe.rechecks == 1
+    assert probe.sample() is True
+
+
+def test_empty_ranking_rechecks_back_off():
+    probe = make_probe(FakeStrategy(BASELINE, [None]))
+    probe.select()
+    probe.select()
+    # Each selection that found nothing doubles the failures before the next
+    for _ in range(probe.recheck_after * 4 - 1):
+        probe.sample()
+    assert probe.rechecks == 0
+    probe.sample()
+    assert probe.rechecks == 1
+
+
+def test_interrupted_select_keeps_the_ranking():
+    fast = FakeStrategy('fast', [True] * 3 + [ProbeInterrupted('killed')])
+    probe = make_probe(fast, FakeStrategy(BASELINE, [True], cost=0.1))
+    probe.select()
+    with pytest.raises(ProbeInterrupted):
+        probe.select()
+    assert probe.ranking == ['fast', BASELINE]
+    assert probe.selections == 1
+
+
+def test_interrupted_sample_is_not_a_failure():
+    fast = FakeStrategy('fast', [True] * 3 + [ProbeInterrupted('killed')])
+    probe = make_probe(fast)
+    probe.select()
+    for _ in range(probe.recheck_after + 1):
+        assert probe.sample() is None
+    assert probe.ranking == ['fast'] and probe.rechecks == 0
+
+
+def test_killed_helper_raises_probe_interrupted():
+    strategy = IoregStrategy('ioreg-test', ['sh', '-c', 'kill -TERM $$'])
+    with pytest.raises(ProbeInterrupted):
+        strategy.sample(timeout=2)
+
+
+def test_selection_with_fake_ioreg(monkeypatch):
+    fake = FakeMac()
+    for name in ('PATH', 'MACSENTINEL_FAKE_DIR'):
+        monkeypatch.setenv(name, fake.env()[name])
+    for closed, value in ((True, 'Yes'), (False, 'No')):
+        fake.set_ioreg_output(closed, ioreg_dump(value, DUMP_SIZE))
+        fake.set_ioreg_output(closed, ioreg_dump(value, DUMP_SIZE, depth1=True), depth1=True)
+    fake.set_lid(True)
+    # Only the ioreg strategies: on a real Mac, IOKit would read the real lid
+    probe = ClamshellProbe([s for s in default_strategies() if not s.native], timeout=2.0)
+    report = probe.select()
+    assert set(report['ranking']) == set(probe.strategies)
+    for closed in (False, True, False):
+        fake.set_lid(closed)
+        assert probe.sample() is closed
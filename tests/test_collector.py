@@ -0,0 +1,27 @@
+"""Query parameters on the collector's read API"""
+import gzip
+import json
+
+import collector
+
+
+def test_limit_is_clamped_and_bad_values_are_rejected(monkeypatch):
+    monkeypatch.setattr(collector, 'fleet', collector.FleetState())
+    client = collector.app.test_client()
+    batch = {'agent': 'mac-1', 'events': [{'seq': i, 'time': 1000.0 + i, 'kind': 'armed'}
+                                              for i in range(1, 4)]}
+    response = client.post('/api/ingest', data=gzip.compress(json.dumps(batch).encode()),
+                           headers={'Content-Encoding': 'gzip'})
+    assert response.status_code == 200
+
+    for path in ('/api/fleet/events?limit=-5', '/api/fleet?limit=-5&offset=-1'):
+        response = client.get(path)
+        assert response.status_code == 200
+    assert client.get('/api/fleet/events?limit=-5').get_json()['events'] == []
+    assert len(client.get('/api/fleet/events?limit=99999').get_json()['events']) == 3
+
+    for path in ('/api/fleet/events?limit=ten', '/api/fleet?limit=1.5',
+                 '/api/fleet?offset=x', '/api/fleet/events?after=latest'):
+        response = client.get(path)
+        assert response.status_code == 400
+        assert response.get_json()['ok'] is False
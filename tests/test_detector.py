@@ -0,0 +1,34 @@
+"""RacingDetector with a sensor that only reports transitions"""
+from detector import CLOSED, INITIALIZED, POWER_CLOSE, RacingDetector
+from pmset_log import CLAMSHELL_CLOSE, PowerEvent
+
+CLOSE = PowerEvent(CLAMSHELL_CLOSE, None, "Entering Sleep state due to 'Clamshell Sleep'")
+
+
+def armed_detector():
+    detector = RacingDetector(sensor='lid', confirm_window=60.0)
+    assert detector.observe_lid(False, 0.0) == INITIALIZED
+    return detector
+
+
+def test_pmset_close_the_sensor_never_saw_does_not_hide_the_next_close():
+    detector = armed_detector()
+    assert detector.observe_power_event(CLOSE, 10.0) == POWER_CLOSE
+    # The lid never moved, so the sensor pushes nothing until the real close
+    assert detector.observe_lid(True, 100.0) == CLOSED
+    assert detector.stats()['unconfirmed_power_closes'] == 1
+
+
+def test_sensor_confirming_a_pmset_close_is_a_duplicate():
+    detector = armed_detector()
+    assert detector.observe_power_event(CLOSE, 10.0) == POWER_CLOSE
+    assert detector.observe_lid(True, 11.0) is None
+    assert detector.wins == {'pmset': 1}
+    assert detector.duplicates == 1
+
+
+def test_sensor_open_ends_an_unconfirmed_pmset_close():
+    detector = armed_detector()
+    assert detector.observe_power_event(CLOSE, 10.0) == POWER_CLOSE
+    assert detector.observe_lid(False, 11.0) is None
+    assert detector.observe_lid(True, 30.0) == CLOSED
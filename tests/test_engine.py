@@ -0,0 +1,73 @@
+"""AsyncEngine on a VirtualClock: sample timing, triggering and disarm"""
+import asyncio
+
+from alarm import SinkBackend
+from engine import AsyncEngine, VirtualClock
+from sentinel import ALARMING, ARMED, DISARMED
+
+
+def run_engine(scenario, lid, **kwargs):
+    """Run scenario(engine, clock, samples) against an engine reading the lid from lid['closed']"""
+    async def main():
+        clock = VirtualClock()
+        samples = []
+
+        async def sampler():
+            samples.append(clock.time())
+            return lid['closed']
+
+        engine = AsyncEngine(clock=clock, sampler=sampler, pmset_interval=0, **kwargs)
+        runner = asyncio.create_task(engine.run())
+        await asyncio.sleep(0)
+        try:
+            return await scenario(engine, clock, samples)
+        finally:
+            engine._stopped.set()
+            await runner
+    return asyncio.run(main())
+
+
+def test_samples_at_exact_virtual_times():
+    async def scenario(engine, clock, samples):
+        await engine.arm_async()
+        await clock.advance(0.5)
+        return [round(t, 6) for t in samples], engine.state.state
+
+    for _ in range(2):
+        times, state = run_engine(scenario, {'closed': False}, audio_backend=None)
+        assert times == [0.0, 0.1, 0.2, 0.3, 0.4, 0.5]
+        assert state == ARMED
+
+
+def test_open_to_closed_triggers_and_disarm_cancels_every_task(tmp_path):
+    sound = tmp_path / 'alarm.mp3'
+    sound.write_bytes(b'\0' * 64)
+    lid = {'closed': False}
+
+    async def scenario(engine, clock, samples):
+        await engine.arm_async()
+        await clock.advance(0.3)
+        assert engine.state.state == ARMED
+        lid['closed'] = True
+        await clock.advance(0.3)
+        assert engine.state.state == ALARMING
+        loops = engine.alarm_loops
+        assert loops >= 1
+        await clock.advance(2.0)
+        # The clip (no length here) keeps being restarted until disarmed
+        assert engine.alarm_loops > loops
+
+        tasks = [task for task in engine._tasks.values() if not task.done()]
+        assert {task.get_name() for task in tasks} >= {'monitor', 'alarm'}
+        assert await engine._disarm()
+        assert engine.state.state == DISARMED
+        assert all(task.cancelled() or task.done() for task in tasks)
+        assert engine.status()['engine_tasks'] == []
+        # Nothing of the engine's left but run() and its broadcaster
+        others = asyncio.all_tasks() - {asyncio.current_task()}
+        assert len(others) == 2
+        sampled = len(samples)
+        await clock.advance(5.0)
+        assert len(samples) == sampled
+
+    run_engine(scenario, lid, audio_backend=SinkBackend(str(sound), duration=0.0))
@@ -0,0 +1,104 @@
+"""/api/events subscribers served by the event stream hub's one thread"""
+import socket
+import threading
+import time
+
+import pytest
+
+from event_stream import EventStreamHub, route
+from events import EventBroadcaster
+
+
+@pytest.fixture
+def hub():
+    broadcaster = EventBroadcaster()
+    hub = EventStreamHub(broadcaster, lambda: {'armed': False, 'state': 'DISARMED'})
+    hub.start()
+    yield hub
+    hub.close()
+
+
+def subscribe(hub, request=b'GET /api/events HTTP/1.1\r\nHost: x\r\n\r\n'):
+    """A client socket whose server end the hub has taken"""
+    client, server = socket.socketpair()
+    client.settimeout(5)
+    client.sendall(request)
+    hub.route(server, lambda: pytest.fail('handed an /api/events request to Werkzeug'))
+    return client
+
+
+def read_until(sock, marker):
+    data = b''
+    while marker not in data:
+        chunk = sock.recv(65536)
+        assert chunk, f'closed before {marker!r}; got {data!r}'
+        data += chunk
+    return data
+
+
+def test_route():
+    assert route(b'GET /api/events HTTP/1.1') == 'events'
+    assert route(b'GET /api/events?x=1') == 'events'
+    assert route(b'GET /api/eventsfoo') == 'other'
+    assert route(b'GET /api/status HTTP') == 'other'
+    assert route(b'POST /api/events ') == 'other'
+    assert route(b'GET /api/ev') is None
+    assert route(b'') is None
+
+
+def test_subscribers_share_one_thread(hub):
+    threads = threading.active_count()
+    clients = [subscribe(hub) for _ in range(50)]
+    for client in clients:
+        head = read_until(client, b'event: state')
+        assert head.startswith(b'HTTP/1.1 200 OK\r\n')
+        assert b'Content-Type: text/event-stream' in head
+
+    hub.broadcaster.publish('armed', at=1)
+    for client in clients:
+        assert b'event: armed' in read_until(client, b'event: armed')
+    assert threading.active_count() == threads
+    assert hub.stats()['clients'] == 50
+
+    for client in clients:
+        client.close()
+    deadline = time.monotonic() + 5
+    while hub.stats()['clients'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hub.stats()['clients'] == 0
+
+
+def test_catches_up_from_last_event_id(hub):
+    for n in range(3):
+        hub.broadcaster.publish('lid', n=n)
+    client = subscribe(hub, b'GET /api/events HTTP/1.1\r\nLast-Event-ID: 1\r\n\r\n')
+    data = read_until(client, b'id: 3')
+    assert b'id: 2' in data and b'event: state' not in data
+    client.close()
+
+
+def test_other_requests_go_to_werkzeug(hub):
+    client, server = socket.socketpair()
+    client.sendall(b'GET /api/status HTTP/1.1\r\n\r\n')
+    handed = threading.Event()
+    hub.route(server, handed.set)
+    assert handed.is_set()
+    client.close()
+    server.close()
+
+
+def test_slow_client_is_dropped(hub):
+    hub.max_buffered = 64 * 1024
+    client = subscribe(hub)
+    read_until(client, b'event: state')
+    # Never read again: the socket buffers fill, then the hub's
+    for n in range(2000):
+        hub.broadcaster.publish('lid', padding='x' * 1024, n=n)
+        if not hub.stats()['clients']:
+            break
+        time.sleep(0.001)
+    deadline = time.monotonic() + 5
+    while hub.stats()['clients'] and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert hub.stats()['dropped'] == 1
+    client.close()
@@ -0,0 +1,50 @@
+"""Journal records reach the files from the writer thread, without blocking record()"""
+import threading
+import time
+
+from journal import EventJournal
+
+
+def test_writer_thread_persists_records(tmp_path):
+    journal = EventJournal(str(tmp_path), ring_records=64, segment_records=100)
+    journal.open()
+    for i in range(250):
+        journal.record('lid_closed' if i % 2 else 'lid_opened', 'iokit', float(i), timestamp=1000.0 + i)
+    assert journal.flush()
+    journal.close()
+
+    reopened = EventJournal(str(tmp_path), ring_records=64, segment_records=100)
+    reopened.open()
+    assert reopened.stats()['segments'] == 3
+    assert reopened.record('armed') == 250
+    # Everything before the ring comes back from the files
+    result = reopened.query(after=-1, kinds=['lid_closed'], limit=1000)
+    assert [event['seq'] for event in result['events']] == list(range(1, 250, 2))
+    reopened.close()
+
+
+def test_record_does_not_wait_for_a_query_or_the_disk(tmp_path):
+    journal = EventJournal(str(tmp_path))
+    journal.open()
+    journal.record('armed')
+    journal.flush()
+    done = threading.Event()
+    # A query reading the files (or the writer in a slow write) holds this lock
+    with journal._files_lock:
+        threading.Thread(target=lambda: (journal.record('disarmed'), done.set())).start()
+        assert done.wait(1)
+    assert journal.flush()
+    assert [event['kind'] for event in journal.query()['events']] == ['armed', 'disarmed']
+    journal.close()
+
+
+def test_backlog_is_written_by_record_itself(tmp_path):
+    journal = EventJournal(str(tmp_path), ring_records=16)
+    journal.open()
+    journal._start = lambda: None  # No writer thread: only the backlog path writes
+    started = time.time()
+    for i in range(40):
+        journal.record('lid_closed', timestamp=started + i)
+    assert journal.stats()['pending'] < 16
+    assert journal.stats()['file_bytes'] >= 32 * 16
+    journal.close()
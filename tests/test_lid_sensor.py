@@ -0,0 +1,46 @@
+"""Lid sources across a fast disarm -> arm"""
+import threading
+import time
+
+from lid_sensor import LidStateSource
+
+
+class SlowSource(LidStateSource):
+    """The first sample hangs until released, like an ioreg stuck past a disarm"""
+
+    name = 'slow'
+
+    def __init__(self):
+        super().__init__(interval=0.01)
+        self.release = threading.Event()
+        self.calls = 0
+
+    def sample(self):
+        self.calls += 1
+        if self.calls == 1:
+            self.release.wait(5)
+            return True
+        return False
+
+
+def sampler_threads():
+    return [t for t in threading.enumerate() if t.name == 'lid-slow']
+
+
+def test_restart_after_stop_without_waiting_runs_one_sampler():
+    source = SlowSource()
+    source.start()
+    time.sleep(0.05)
+    source.stop(wait=False)
+    source.start()
+    source.release.set()
+    time.sleep(0.2)
+    try:
+        assert len(sampler_threads()) == 1
+        # Only the new run's samples: the stale "closed" was dropped
+        first = source.read(timeout=1)
+        assert first is not None and first.closed is False
+        assert source.read(timeout=0.1) is None
+    finally:
+        source.stop()
+    assert not sampler_threads()
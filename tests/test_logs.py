@@ -0,0 +1,50 @@
+"""Repeat suppression collapses floods without losing one-off lines"""
+import io
+import json
+
+from logs import Logger, Pipeline
+
+
+def lines(sink):
+    return [json.loads(line) for line in sink.getvalue().splitlines()]
+
+
+def test_quick_arm_disarm_rearm_keeps_every_line():
+    sink = io.StringIO()
+    pipeline = Pipeline(sink=sink, sync=True)
+    log = Logger('sentinel', pipeline)
+    for _ in range(2):
+        log.info('Power monitoring started - watching for lid close events')
+        log.info('System disarmed - resetting all detection states')
+    log.warning('LID CLOSE DETECTED - TRIGGERING ALARM', lid='closed')
+    log.warning('LID CLOSE DETECTED - TRIGGERING ALARM', lid='open')
+    pipeline.close()
+
+    assert [(line['msg'], line.get('lid')) for line in lines(sink)] == [
+        ('Power monitoring started - watching for lid close events', None),
+        ('System disarmed - resetting all detection states', None),
+        ('Power monitoring started - watching for lid close events', None),
+        ('System disarmed - resetting all detection states', None),
+        ('LID CLOSE DETECTED - TRIGGERING ALARM', 'closed'),
+        ('LID CLOSE DETECTED - TRIGGERING ALARM', 'open'),
+    ]
+    assert pipeline.suppressed == 0
+
+
+def test_identical_flood_is_counted():
+    sink = io.StringIO()
+    pipeline = Pipeline(sink=sink, sync=True)
+    log = Logger('alarm', pipeline)
+    for _ in range(100):
+        log.warning('Alarm playback failed', error='no output device')
+    log.info('Alarm fully stopped')
+    pipeline.close()
+
+    written = lines(sink)
+    assert [(line['msg'], line.get('repeated')) for line in written] == [
+        ('Alarm playback failed', None),
+        ('Alarm playback failed', 99),
+        ('Alarm fully stopped', None),
+    ]
+    assert pipeline.suppressed == 99
+    assert [line['level'] for line in written] == ['warning', 'warning', 'info']
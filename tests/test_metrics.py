@@ -0,0 +1,42 @@
+"""Per-thread metric arrays under a thread-per-request workload"""
+import threading
+
+from metrics import Counter, Histogram
+
+
+def test_short_lived_threads_reuse_arrays():
+    counter = Counter('test_requests_total', 'requests', registry=False)
+    histogram = Histogram('test_request_seconds', 'latency', registry=False)
+
+    def request():
+        counter.inc()
+        histogram.observe(0.003)
+
+    for _ in range(2000):
+        thread = threading.Thread(target=request)
+        thread.start()
+        thread.join()
+
+    assert counter.value == 2000
+    assert len(counter._shards._shards) == 1
+    assert len(histogram._shards._shards) == 1
+    assert abs(histogram._shards.totals()[-1] - 2000 * 0.003) < 1e-9
+
+
+def test_concurrent_threads_each_own_an_array():
+    counter = Counter('test_concurrent_total', 'ops', registry=False)
+    barrier = threading.Barrier(4)
+
+    def worker():
+        counter.inc()
+        barrier.wait()  # All four hold an array at once
+        for _ in range(10000):
+            counter.inc()
+
+    workers = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    assert counter.value == 4 * 10001
+    assert len(counter._shards._shards) == 4
@@ -0,0 +1,81 @@
+"""PowerLogStream reads only new powerd entries from one long-lived process"""
+import threading
+import time
+
+import pytest
+
+from fakemac import FakeMac
+from pmset_log import CLAMSHELL_CLOSE, PowerLogStream
+
+CLOSE = "2024-05-01 10:00:00 +0000 Sleep  \tEntering Sleep state due to 'Clamshell Sleep'"
+NOISE = '2024-05-01 10:00:00 +0000 Assertions  \tPID 412(WindowServer) Released PreventUserIdleSleep'
+
+
+@pytest.fixture
+def fake(monkeypatch):
+    fake = FakeMac()
+    for name in ('PATH', 'MACSENTINEL_FAKE_DIR'):
+        monkeypatch.setenv(name, fake.env()[name])
+    return fake
+
+
+def wait_for(condition, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+def started(stream):
+    wait_for(lambda: stream.stats()['running'])
+    time.sleep(0.3)  # The stand-in's tail has opened the log
+
+
+def test_only_new_entries_from_one_process(fake):
+    fake.append_power_log([CLOSE] * 3)  # Before arming: history, not news
+    events = []
+    stream = PowerLogStream(events.append)
+    stream.start()
+    started(stream)
+    for _ in range(5):
+        fake.append_power_log([NOISE] * 10 + [CLOSE])
+    wait_for(lambda: len(events) == 5)
+    stream.stop()
+
+    assert {sample.event.kind for sample in events} == {CLAMSHELL_CLOSE}
+    assert stream.lines == 55
+    # One process for the whole session, not one per poll
+    assert fake.calls()['log'] == 1
+
+
+def test_restarts_a_stream_that_exits(fake):
+    events = []
+    stream = PowerLogStream(events.append, restart_delay=0.05)
+    stream.start()
+    started(stream)
+    stream._process.kill()
+    wait_for(lambda: stream.restarts == 1 and stream.stats()['running'])
+    time.sleep(0.3)
+    fake.append_power_log([CLOSE])
+    wait_for(lambda: events)
+    stream.stop()
+    assert fake.calls()['log'] == 2
+
+
+def test_restart_after_stop_without_waiting_leaves_one_reader(fake):
+    stream = PowerLogStream(lambda sample: None)
+    stream.start()
+    started(stream)
+    stream.stop(wait=False)
+    stream.start()
+    wait_for(lambda: [t.name for t in threading.enumerate()].count('power-log-stream') == 1)
+    stream.stop()
+    wait_for(lambda: 'power-log-stream' not in [t.name for t in threading.enumerate()])
+
+
+def test_missing_command_gives_up():
+    stream = PowerLogStream(lambda sample: None, command=['/nonexistent/log', 'stream'])
+    stream.start()
+    wait_for(lambda: stream.available is False)
+    stream._thread.join(1)
+    assert not stream._thread.is_alive()
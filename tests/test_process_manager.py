@@ -0,0 +1,39 @@
+"""Helper process groups and reaping"""
+import threading
+import time
+
+from process_manager import ProcessManager
+
+
+def test_terminate_all_spares_helpers_run_waits_for():
+    manager = ProcessManager()
+    player = manager.spawn(['sleep', '30'], essential=True)
+    result = {}
+
+    def probe():
+        result['probe'] = manager.run(['sh', '-c', 'sleep 0.3; echo done'], timeout=5)
+
+    thread = threading.Thread(target=probe)
+    thread.start()
+    time.sleep(0.1)
+    assert manager.terminate_all() == 1
+    thread.join(5)
+
+    assert player.returncode is not None
+    assert result['probe'].returncode == 0 and result['probe'].stdout == b'done\n'
+    assert manager.running == 0
+
+
+def test_reaper_wakes_when_a_child_exits():
+    # The reaper never sleeps its interval when it can block in waitid()
+    manager = ProcessManager(reap_interval=30)
+    manager.spawn(['sleep', '30'], essential=True)  # Keeps the group alive meanwhile
+    time.sleep(0.1)  # The reaper is waiting by now
+    quick = manager.spawn(['true'], essential=True)
+    deadline = time.monotonic() + 2
+    while quick in manager._children:
+        assert time.monotonic() < deadline, 'exited child was not reaped'
+        time.sleep(0.01)
+    assert quick.returncode == 0
+    assert manager.running == 1
+    manager.terminate_all()
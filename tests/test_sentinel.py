@@ -0,0 +1,137 @@
+"""Arm/disarm races in the threaded Sentinel"""
+import threading
+import time
+
+import pytest
+
+import sentinel as sentinel_module
+from capabilities import capabilities
+from fakemac import FakeMac
+from lid_sensor import FileLidSource
+from sentinel import ALARMING, ARMED, ARMING, DISARMED, Sentinel
+
+
+@pytest.fixture
+def gated_sentinel(monkeypatch, tmp_path):
+    """A Sentinel whose lid source is created only once the test opens the gate"""
+    lid_path = tmp_path / 'lid'
+    lid_path.write_text('open\n')
+    monkeypatch.setenv('MACSENTINEL_AUDIO', 'null')
+    monkeypatch.setenv('MACSENTINEL_POWER_LOG', 'off')
+    gate = threading.Event()
+    created = []
+
+    def create_lid_source(spec=None):
+        gate.wait(5)
+        source = FileLidSource(str(lid_path))
+        created.append(source)
+        return source
+
+    monkeypatch.setattr(sentinel_module, 'create_lid_source', create_lid_source)
+    sentinel = Sentinel()
+    yield sentinel, gate, created
+    gate.set()
+    sentinel.cleanup()
+
+
+def join_arm_thread():
+    for thread in threading.enumerate():
+        if thread.name == 'sentinel-arm':
+            thread.join(5)
+            assert not thread.is_alive()
+
+
+def test_disarm_before_arm_setup_leaves_nothing_running(gated_sentinel):
+    sentinel, gate, created = gated_sentinel
+    assert sentinel.arm()
+    assert sentinel.disarm()
+    gate.set()
+    join_arm_thread()
+
+    assert sentinel.state.state == DISARMED
+    assert len(created) == 1
+    assert created[0]._thread is None
+    assert sentinel.lid_source is None and sentinel.monitor_thread is None
+    assert not any(thread.name.startswith('lid-') for thread in threading.enumerate())
+
+
+def test_rearm_after_a_disarmed_arm_monitors(gated_sentinel):
+    sentinel, gate, created = gated_sentinel
+    sentinel.arm()
+    sentinel.disarm()
+    assert sentinel.arm()
+    gate.set()
+    join_arm_thread()
+    assert sentinel.state.wait_for(ARMED, timeout=5)
+    # Both arm threads waited on the gate; only the current one's source is kept
+    assert len(created) == 2 and sentinel.lid_source in created
+    assert all(source._thread is None for source in created if source is not sentinel.lid_source)
+    assert sentinel.monitor_thread.is_alive()
+
+
+def test_alarm_while_arming_is_not_overwritten(gated_sentinel):
+    sentinel, gate, created = gated_sentinel
+    sentinel.arm()
+    assert sentinel.state.state == ARMING
+    assert sentinel.state.transition(ALARMING, generation=sentinel.state.generation)
+    gate.set()
+    join_arm_thread()
+    assert sentinel.state.state == ALARMING
+    assert sentinel.monitor_thread.is_alive()
+
+
+def test_power_log_triggers_while_the_sensor_is_stalled(monkeypatch, tmp_path):
+    fake = FakeMac(str(tmp_path / 'fake'))
+    for name in ('PATH', 'MACSENTINEL_FAKE_DIR'):
+        monkeypatch.setenv(name, fake.env()[name])
+    lid_path = tmp_path / 'lid'
+    lid_path.write_text('open\n')
+    monkeypatch.setenv('MACSENTINEL_LID_SOURCE', f'file:{lid_path}')
+    monkeypatch.setenv('MACSENTINEL_AUDIO', 'null')
+    monkeypatch.delenv('MACSENTINEL_PMSET_INTERVAL', raising=False)
+    monkeypatch.delenv('MACSENTINEL_POWER_LOG', raising=False)
+    # An earlier test may have probed `log` without the stand-ins on PATH
+    capabilities.invalidate('power_log')
+    sentinel = Sentinel()
+    try:
+        sentinel.arm()
+        assert sentinel.state.wait_for(ARMED, timeout=5)
+        # Racing is on by default, on the streamed log
+        deadline = time.monotonic() + 5
+        while not sentinel.power_source.stats()['running']:
+            assert time.monotonic() < deadline
+            time.sleep(0.01)
+        time.sleep(0.3)
+        # The lid file never says "closed": only powerd reports this close
+        fake.append_power_log(["2024-05-01 10:00:00 +0000 Sleep  \t"
+                               "Entering Sleep state due to 'Clamshell Sleep'"])
+        assert sentinel.state.wait_for(ALARMING, timeout=5)
+        assert sentinel.detector.stats()['wins'] == {'pmset': 1}
+    finally:
+        sentinel.cleanup()
+
+
+def test_close_during_a_test_alarm_keeps_the_alarm_looping(monkeypatch, tmp_path):
+    lid_path = tmp_path / 'lid'
+    lid_path.write_text('open\n')
+    monkeypatch.setenv('MACSENTINEL_LID_SOURCE', f'file:{lid_path}')
+    monkeypatch.setenv('MACSENTINEL_AUDIO', 'null')
+    monkeypatch.setenv('MACSENTINEL_POWER_LOG', 'off')
+    sentinel = Sentinel()
+    try:
+        assert sentinel.audio_loaded.wait(5)
+        worker = sentinel.audio_worker
+        worker.backend.duration = 0.5
+        # Test alarm while disarmed: plays once
+        assert sentinel.trigger_alarm()
+        sentinel.arm()
+        assert sentinel.state.wait_for(ARMED, timeout=5)
+        with open(lid_path, 'a') as f:
+            f.write('closed\n')
+        assert sentinel.state.wait_for(ALARMING, timeout=5)
+        time.sleep(1.2)
+        # Past the end of the test clip: the alarm is still going
+        assert worker.is_playing
+        assert worker.loops >= 2
+    finally:
+        sentinel.cleanup()